@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Multi-process load benchmark for the sqlite cache backends
+# Run from the repository root: python benchmarks/cache_load.py --processes 4 --threads 4
+
+import argparse
+import multiprocessing
+import random
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from topiclib.cache import cachenames  # noqa: E402
+
+VALUE = "x" * 2048
+
+
+def worker(backend: str, db_path: str, threads: int, duration: float, read_ratio: float, n_keys: int, results):
+    cache = cachenames[backend](db_path)
+    counts = []
+
+    def run(seed):
+        rng = random.Random(seed)
+        ops = errors = 0
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            key = f"provider_{rng.randrange(n_keys)}"
+            try:
+                if rng.random() < read_ratio:
+                    cache.get(key)
+                else:
+                    cache.set(key, VALUE)
+                ops += 1
+            except Exception:
+                errors += 1
+        counts.append((ops, errors))
+
+    pool = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    results.put((sum(c[0] for c in counts), sum(c[1] for c in counts)))
+
+
+def bench(backend: str, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = str(Path(tmp) / "cache.db")
+        cache = cachenames[backend](db_path)
+        for i in range(args.keys):
+            cache.set(f"provider_{i}", VALUE)
+        del cache
+
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=worker,
+                args=(backend, db_path, args.threads, args.duration, args.read_ratio, args.keys, results),
+            )
+            for _ in range(args.processes)
+        ]
+        for p in processes:
+            p.start()
+        totals = [results.get() for _ in processes]
+        for p in processes:
+            p.join()
+
+    ops = sum(t[0] for t in totals)
+    errors = sum(t[1] for t in totals)
+    print(f"{backend:>16}: {ops / args.duration:10.0f} ops/s  errors={errors}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backends", nargs="+", default=["SqliteCache", "WalSqliteCache"])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--read_ratio", type=float, default=0.9)
+    parser.add_argument("--keys", type=int, default=2000)
+    args = parser.parse_args()
+    for backend in args.backends:
+        bench(backend, args)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Compares the copy based graph pruning with the vectorized prune_edges on synthetic graphs
+# Run from the repository root: python benchmarks/prune.py
+
+import random
+import sys
+import time
+from pathlib import Path
+
+import networkx as nx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from topiclib.graphs import aggregate_edges, build_graph, prune_edges  # noqa: E402
+
+
+def legacy_prune(graph: nx.DiGraph, w_min) -> nx.DiGraph:
+    weight_totals = nx.get_edge_attributes(graph, "weight_total")
+    full_graph = graph.copy()
+    graph.remove_edges_from((e for e, w in weight_totals.items() if w < w_min))
+    graph.remove_nodes_from(list(nx.isolates(graph)))
+    for node in full_graph.nodes():
+        if node not in graph.nodes():
+            continue
+        for edge in full_graph.edges(node):
+            if (
+                edge not in graph.edges()
+                and edge[0] in graph.nodes()
+                and edge[1] in graph.nodes()
+            ):
+                graph.add_edge(edge[0], edge[1], **full_graph[edge[0]][edge[1]])
+    return graph
+
+
+def synthetic(n_nodes: int, n_edges: int, seed: int = 0):
+    rng = random.Random(seed)
+    nodes = [f"topic {i}" for i in range(n_nodes)]
+    edges = [(*rng.sample(nodes, 2), rng.randint(2, 50)) for _ in range(n_edges)]
+    return nodes, edges
+
+
+def bench(n_nodes: int, n_edges: int):
+    nodes, edges = synthetic(n_nodes, n_edges)
+    index, src, dst, weight, weight_total = aggregate_edges(nodes, edges)
+    w_min = sorted(weight_total.tolist())[int(len(weight_total) * 0.7)]
+
+    graph = build_graph(nodes, index, src, dst, weight, weight_total)
+    start = time.perf_counter()
+    expected = legacy_prune(graph, w_min)
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    node_mask, m = prune_edges(len(index), src, dst, weight_total, w_min)
+    kept = [name for name, i in index.items() if node_mask[i]]
+    pruned = build_graph(kept, index, src[m], dst[m], weight[m], weight_total[m])
+    vectorized = time.perf_counter() - start
+
+    assert set(pruned.nodes()) == set(expected.nodes())
+    assert dict(pruned.edges.items()) == dict(expected.edges.items())
+    print(
+        f"nodes={n_nodes:>5} edges={len(src):>7}  legacy={legacy * 1000:10.1f}ms  "
+        f"vectorized={vectorized * 1000:8.1f}ms  ({legacy / vectorized:.0f}x)"
+    )
+
+
+if __name__ == "__main__":
+    for n_nodes, n_edges in ((50, 500), (200, 5000), (500, 30000), (1000, 100000)):
+        bench(n_nodes, n_edges)
@@ -9,8 +9,96 @@ PORT = 8000
 LOGLEVEL = logging.DEBUG
 
 CACHE_PATH = "cache.db"
+# Any class registered with topiclib.cacheclass, e.g. "SqliteCache", "WalSqliteCache" or
+# "FileCache" (CACHE_PATH is then a directory)
+CACHE_BACKEND = "WalSqliteCache"
+# Time to live in seconds by key prefix (the longest matching prefix wins), keys without one never expire
+CACHE_TTLS = {
+    "search_": 7 * 24 * 3600,
+    "body_": 30 * 24 * 3600,
+    "layout_": 30 * 24 * 3600,
+    "provider_": 180 * 24 * 3600,
+}
+# Maximum size of the cache file in bytes (0 for no limit). When it grows over it keys are evicted
+# by CACHE_EVICTION: "lru" (least recently used) or "lfu" (least frequently used). FileCache only
+# does "lru" (and warns if set to "lfu")
+CACHE_MAX_SIZE = 2 * 1024**3
+CACHE_EVICTION = "lru"
+# Seconds between background runs that expire and evict keys and incrementally vacuum the file
+CACHE_MAINTENANCE_INTERVAL = 60
+# With CACHE_WRITE_BEHIND = 1 cache writes are queued and flushed in a single transaction when
+# CACHE_FLUSH_SIZE writes are queued or every CACHE_FLUSH_INTERVAL seconds
+CACHE_WRITE_BEHIND = 1
+CACHE_FLUSH_SIZE = 256
+CACHE_FLUSH_INTERVAL = 1.0
+# Bytes of recently used keys kept in memory in front of the cache file (0 disables it). Values
+# are kept for CACHE_MEMORY_TTL seconds at most, so writes of other workers are seen after it, and
+# missing keys are remembered for CACHE_NEGATIVE_TTL seconds
+CACHE_MEMORY_SIZE = 64 * 1024**2
+CACHE_MEMORY_TTL = 60.0
+CACHE_NEGATIVE_TTL = 5.0
+# Cache values of at least CACHE_COMPRESS_MIN bytes are compressed with zlib (0 disables it)
+CACHE_COMPRESS_MIN = 1024
+CACHE_COMPRESS_LEVEL = 1
+# Threads per worker that run the cache reads and writes of the async endpoints
+CACHE_ASYNC_WORKERS = 4
+# With CACHE_STATS = 1 hits, misses, bytes and latencies are recorded by key prefix (GET /stats/cache)
+CACHE_STATS = 1
+# Seconds a worker can hold the lease of a computation (topics of a text, a provider page) that
+# other workers wait for instead of repeating it
+CACHE_LEASE_TTL = 120.0
 TMP_PATH = "/tmp/topicapi/"
 
+# ##############################################################################################
+# Provider fetches (e.g. wikipedia pages). Timeout is per attempt in seconds, failed attempts are
+# retried with exponential backoff plus jitter starting at FETCH_BACKOFF seconds.
+# With FETCH_HEDGE = 1 a duplicate request is fired when the first one has not answered by the
+# FETCH_HEDGE_PERCENTILE latency of that provider.
+FETCH_TIMEOUT = 10.0
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 0.5
+FETCH_HEDGE = 0
+FETCH_HEDGE_PERCENTILE = 95
+
+# Topic extraction, corpus expansion, layouts and images of the api endpoints run in a pool of
+# COMPUTE_WORKERS processes (per api worker) so the event loop stays free. At most COMPUTE_LIMITS
+# requests of an endpoint (COMPUTE_LIMIT if not listed) use the pool at once, others wait.
+COMPUTE_WORKERS = 2
+COMPUTE_LIMIT = 2
+COMPUTE_LIMITS = {"topics": 4, "wordcloud": 2, "graph": 2, "graph_image": 2, "layout": 2}
+
+# Background commands (/command/*) are queued in the sqlite database JOBS_PATH, shared by the api
+# workers, and run by JOB_WORKERS processes per api worker. With JOB_QUEUE commands waiting new
+# ones are refused (503). Results are removed JOB_RETENTION seconds after they finish and commands
+# running for more than JOB_TIMEOUT seconds are failed. A worker that dies is restarted and its
+# command failed right away.
+JOBS_PATH = "jobs.db"
+JOB_WORKERS = 2
+JOB_QUEUE = 32
+JOB_RETENTION = 3600.0
+JOB_TIMEOUT = 900.0
+
+# Every process (api, compute and job workers) publishes its cache stats and fetch latencies to
+# the sqlite database STATS_PATH every STATS_INTERVAL seconds, /stats/* merge them
+STATS_PATH = "stats.db"
+STATS_INTERVAL = 5.0
+
+# Unix socket of the nlp sidecar (python -m topiclib nlp). When set the api, compute and job
+# workers send their text preprocessing to it instead of each loading the spacy model
+NLP_SOCKET = ""
+# When the sidecar can't be reached the preprocessing fails, with NLP_FALLBACK = 1 the worker loads
+# its own copy of the model instead
+NLP_FALLBACK = 0
+# .npy file the word vectors of the spacy model are exported to once and memory mapped from, so
+# the processes loading the model share one copy. Empty to keep a copy per process. A relative
+# path is taken from the directory of CACHE_PATH (see the end of this file), not the working one
+VECTORS_PATH = "vectors.npy"
+
+# With WARM_UP = 1 the nlp models are loaded and each stage runs once on a tiny text when a compute
+# or job worker starts, and the providers are primed when an api worker starts. GET /ready answers
+# 200 once its compute workers and providers are ready.
+WARM_UP = 1
+
 
 # ##############################################################################################
 # Authorization header: If not set anyone can access the API (Except by IP whitelist/blacklisting bellow)
@@ -40,7 +128,13 @@ for key, value in os.environ.items():
     if key in globals() and key.isupper():
         if isinstance(globals()[key], str):
             globals()[key] = value
-        if isinstance(globals()[key], int):
+        elif isinstance(globals()[key], float):
+            globals()[key] = float(value)
+        elif isinstance(globals()[key], int):
             globals()[key] = value
-        if isinstance(globals()[key], list):
+        elif isinstance(globals()[key], list):
             globals()[key] = value.split(",")
+
+# Same file whatever the working directory of the process
+if VECTORS_PATH and not os.path.isabs(VECTORS_PATH):
+    VECTORS_PATH = os.path.join(os.path.dirname(os.path.abspath(CACHE_PATH)), VECTORS_PATH)
@@ -1,23 +1,29 @@
+import concurrent.futures
 import json
 import logging
-import multiprocessing
-import os
 import pathlib
+import threading
 from collections import Counter
 from enum import auto
-from typing import Union
+from typing import List, Union
 from uuid import uuid4
 
-from fastapi import FastAPI, Request, Response, status
+from fastapi import Depends, FastAPI, Query, Request, Response, status
 from fastapi.responses import JSONResponse, FileResponse
 from fastapi_utils.enums import StrEnum
 from networkx.readwrite import json_graph
 
-from config import (AUTH_HEADER, BLACKLISTED_IPS, CACHE_PATH, HOST, LOGLEVEL,
-                    PORT, PROXY_IP, TMP_PATH, WHITELISTED_IPS)
-from topiclib import (Cache, SqliteCache, TopicExtractor, expand_corpus, gsd,
-                      hash_text, plot_graph, providers_map, wordcloud)
+from config import (AUTH_HEADER, BLACKLISTED_IPS, COMPUTE_LIMIT, COMPUTE_LIMITS, COMPUTE_WORKERS,
+                    HOST, JOB_QUEUE, JOB_RETENTION, JOB_TIMEOUT, JOB_WORKERS, JOBS_PATH, PORT,
+                    PROXY_IP, TMP_PATH, WARM_UP, WHITELISTED_IPS)
+from topiclib import (MISSING, Cache, ComputePool, TopicExtractor, expand_corpus, providers_map,
+                      wordcloud)
+from topiclib import codec, preload, singleflight, stats
+from topiclib.jobs import DONE, FAILED, JobQueue, JobWorkers
 from topiclib.parser import get_text
+from topiclib.utils import topics_key
+from worker import (configure, generate_graph, generate_graph_image, graph_image_job, graph_job,
+                    init_worker, layout_job, topics_job)
 
 app = FastAPI(
     title="Topic API",
@@ -26,17 +32,45 @@ app = FastAPI(
 )
 
 logger = logging.getLogger("topiclib")
-logger.setLevel(LOGLEVEL)
-command_line_handler = logging.StreamHandler()
-command_line_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(levelname)s- api - %(asctime)s - %(message)s")
-command_line_handler.setFormatter(formatter)
-logger.addHandler(command_line_handler)
-
-commands = {}
+configure()
+
 pathlib.Path(TMP_PATH).mkdir(parents=True, exist_ok=True)
 
-Cache.set_cache(SqliteCache(CACHE_PATH))
+compute_pool = ComputePool(
+    int(COMPUTE_WORKERS), COMPUTE_LIMITS, int(COMPUTE_LIMIT), initializer=init_worker
+)
+job_queue = JobQueue(JOBS_PATH, int(JOB_QUEUE), float(JOB_RETENTION), float(JOB_TIMEOUT))
+job_workers = JobWorkers(job_queue, int(JOB_WORKERS), initializer=init_worker)
+
+# The models are only used by the spawned compute and job workers, which load them in their
+# initializer (worker.init_worker). The api processes don't load them
+
+warmed_up = threading.Event()
+
+
+def finish_warm_up(workers: [concurrent.futures.Future]):
+    """Waits for the compute workers and primes the providers, then this worker is ready"""
+    concurrent.futures.wait(workers)
+    preload.prime_providers()
+    warmed_up.set()
+
+
+@app.on_event("startup")
+def startup():
+    workers = compute_pool.start()
+    job_workers.start()
+    stats.stats_table.start()
+    if int(WARM_UP):
+        threading.Thread(target=finish_warm_up, args=(workers,), daemon=True).start()
+    else:
+        warmed_up.set()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    job_workers.shutdown()
+    compute_pool.shutdown()
+    Cache.instance().close()
 
 
 @app.middleware("http")
@@ -72,6 +106,14 @@ def error_resp(message: str) -> JSONResponse:
     )
 
 
+def queue_full_resp() -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"message": "Too many commands queued, retry later"},
+        headers={"Retry-After": "30"},
+    )
+
+
 # Api test
 
 
@@ -80,6 +122,30 @@ async def root():
     return {"message": "Hi. You seeing this message means the api is running!"}
 
 
+@app.get("/ready")
+async def ready():
+    """200 once this worker warmed up (see WARM_UP in config.py), 503 before"""
+    if not warmed_up.is_set():
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"ready": False}
+        )
+    return {"ready": True}
+
+
+@app.get("/stats/latency")
+async def latency_stats():
+    """Provider fetch latency percentiles (seconds) measured by every api, compute and job
+    worker (see topiclib.stats)"""
+    return await stats.stats_table.alatency_percentiles()
+
+
+@app.get("/stats/cache")
+async def cache_stats():
+    """Cache hits, misses, evictions, bytes and latency histograms (ms) by key prefix
+    recorded by every api, compute and job worker. Empty if CACHE_STATS is off"""
+    return await stats.stats_table.acache_snapshot()
+
+
 async def get_json(request: Request) -> dict:
     try:
         return await request.json()
@@ -93,28 +159,24 @@ class TopicExtractionMethod(StrEnum):
     anygram = auto()
 
 
-def get_topics(
+async def aget_topics(
     text: str, method: TopicExtractionMethod, ngram_size: int = 1
 ) -> Union[dict, Counter]:
+    """get_topics with the cache reads and writes run off the event loop, the extraction in the
+    compute pool and concurrent requests for the same text coalesced"""
     cache = Cache.instance()
-    cache_key = f"body_{method}_{ngram_size}" + repr(hash_text(text))
-    if cache_key in cache:
+    cache_key = topics_key(text, method, ngram_size)
+    cached = await cache.aget(cache_key, MISSING)
+    if cached is not MISSING:
         logger.debug(f"Cache hit for {cache_key}")
-        return Counter(json.loads(cache[cache_key]))
+        return Counter(codec.decode(cached))
 
-    if method == TopicExtractionMethod.gsdmm:
-        counter = gsd(text)
-    elif method == TopicExtractionMethod.ngram:
-        counter = TopicExtractor(text, ngram_range=(ngram_size,)).count_vectorizer(
-            ngram_size=ngram_size
-        )
-    elif method == TopicExtractionMethod.anygram:
-        counter = TopicExtractor(text).count()
+    async def compute():
+        return await compute_pool.run(topics_job, text, method, ngram_size)
 
-    # Store in cache
-    cache[cache_key] = json.dumps(counter)
-
-    return counter
+    # Identical texts posted at the same time are processed once, the result is stored in cache
+    value = await singleflight.flight.ado(cache_key, compute, cache)
+    return Counter(codec.decode(value))
 
 
 @app.post(
@@ -147,13 +209,44 @@ async def wordcloud_image(
         return error_resp("Missing Items key in body")
 
     text = get_text(body)
-    d = get_topics(text, method, ngram_size)
-    image_bytes: bytes = wordcloud(d, width, height, limit)
+    async with compute_pool.slot("wordcloud"):
+        d = await aget_topics(text, method, ngram_size)
+        image_bytes: bytes = await compute_pool.run(wordcloud, d, width, height, limit)
     return Response(content=image_bytes, media_type="image/png")
 
 
 ProviderStr = StrEnum("ProviderStr", {k: auto() for k in providers_map})
 
+
+class ProviderPolicy(StrEnum):
+    merge = auto()
+    first = auto()
+
+
+DEFAULT_PROVIDERS = [list(providers_map.keys())[0]]
+
+
+class InvalidParams(Exception):
+    """Raised by the dependencies of the endpoints, answered with error_resp"""
+
+
+@app.exception_handler(InvalidParams)
+async def invalid_params(request: Request, e: InvalidParams):
+    return error_resp(str(e))
+
+
+def provider_params(
+    provider: List[ProviderStr] = Query(DEFAULT_PROVIDERS),
+    provider_policy: ProviderPolicy = ProviderPolicy.merge,
+    provider_weights: List[float] = Query(None),
+) -> dict:
+    """Provider parameters of the graph endpoints, as expand_corpus arguments"""
+    if provider_weights is not None and len(provider_weights) != len(provider):
+        raise InvalidParams("provider_weights must have one weight per provider")
+    return dict(
+        provider=provider, provider_policy=provider_policy, provider_weights=provider_weights
+    )
+
 # Simple List
 
 
@@ -184,7 +277,8 @@ async def topics(
 
     # Get the text from the request
     text = get_text(body)
-    d = get_topics(text, method, ngram_size).most_common(limit)
+    async with compute_pool.slot("topics"):
+        d = (await aget_topics(text, method, ngram_size)).most_common(limit)
     return d
 
 
@@ -206,8 +300,9 @@ async def graph_image(
     limit: int = 10,
     graph_type: GraphType = GraphType.network,
     full: bool = False,
-    provider: ProviderStr = list(providers_map.keys())[0],
+    providers: dict = Depends(provider_params),
     method: TopicExtractionMethod = TopicExtractionMethod.anygram,
+    budget_ms: int = None,
 ):
     """Graph png image representing the network of topic hierarchy.
 
@@ -225,22 +320,37 @@ async def graph_image(
         - **tree**: Tree graph
 
     - **full**: If true, will return the full graph without supressing unlikely (low ammount of connections) topics
-    - **provider**: The document provider atlas for corpus expansion.
+    - **provider**: The document provider atlas for corpus expansion. Can be repeated to query several providers at once.
+    - **provider_policy**: How the graphs of several providers are combined
+        - **merge**: Edges of every provider are added up. Default
+        - **first**: The edges of a topic come from the first provider (in the given order) that found its page
+
+    - **provider_weights**: Weight multiplying the edges of each provider (one per provider). Defaults to 1
+    - **budget_ms**: Time budget for the corpus expansion. When set the graph is drawn only with the pages that were ready in time and the `X-Expansion` header lists the skipped and pending pages. Pending pages keep loading in background so the next call is complete.
     """
     body = await get_json(request)
     if "Items" not in body:
         return error_resp("Missing Items key in body")
 
     text = get_text(body)
-    d = get_topics(text, method, ngram_size).most_common(limit)
-    graph = expand_corpus(d, provider, full)
+    style = 0 if graph_type == GraphType.network else 1
+    async with compute_pool.slot("graph_image"):
+        d = (await aget_topics(text, method, ngram_size)).most_common(limit)
+        image_bytes, expansion = await compute_pool.run(
+            graph_image_job,
+            d,
+            width,
+            height,
+            style,
+            full=full,
+            budget_ms=budget_ms,
+            **providers,
+        )
 
-    if graph_type == GraphType.network:
-        image_bytes: bytes = plot_graph(graph, width, height)
-        return Response(content=image_bytes, media_type="image/png")
-    elif graph_type == GraphType.tree:
-        image_bytes: bytes = plot_graph(graph, width, height, 1)
-        return Response(content=image_bytes, media_type="image/png")
+    headers = {}
+    if expansion is not None:
+        headers["X-Expansion"] = json.dumps(expansion)
+    return Response(content=image_bytes, media_type="image/png", headers=headers)
 
 
 # Topic Structure
@@ -250,8 +360,9 @@ async def graph(
     ngram_size: int = 2,
     limit: int = 10,
     full: bool = False,
-    provider: ProviderStr = list(providers_map.keys())[0],
+    providers: dict = Depends(provider_params),
     method: TopicExtractionMethod = TopicExtractionMethod.anygram,
+    budget_ms: int = None,
 ):
     """Graph json representing the network of topic hierarchy.
 
@@ -263,78 +374,70 @@ async def graph(
     - **ngram_size**: size of ngrams to use (only for ngram method)
     - **limit**: Max of topics to display. Defaults to 10
     - **full**: If true, will return the full graph without supressing unlikely (low ammount of connections) topics
-    - **provider**: The document provider atlas for corpus expansion.
+    - **provider**: The document provider atlas for corpus expansion. Can be repeated to query several providers at once.
+    - **provider_policy**: How the graphs of several providers are combined
+        - **merge**: Edges of every provider are added up. Default
+        - **first**: The edges of a topic come from the first provider (in the given order) that found its page
+
+    - **provider_weights**: Weight multiplying the edges of each provider (one per provider). Defaults to 1
+    - **budget_ms**: Time budget for the corpus expansion. When set the graph contains only the pages that were ready in time and `graph.expansion` lists the skipped and pending pages. Pending pages keep loading in background so the next call is complete.
     """
     body = await get_json(request)
     if "Items" not in body:
         return error_resp("Missing Items key in body")
 
     text = get_text(body)
-    d = get_topics(text, method, ngram_size).most_common(limit)
-    graph = expand_corpus(d, provider, full)
+    async with compute_pool.slot("graph"):
+        d = (await aget_topics(text, method, ngram_size)).most_common(limit)
+        graph = await compute_pool.run(
+            graph_job,
+            d,
+            full=full,
+            budget_ms=budget_ms,
+            **providers,
+        )
     return json_graph.node_link_data(graph)
 
 
-# File system based command backgrounding and chaching system
-
-
-def write_placeholder(path: str):
-    """Write a placeholder file to path."""
-    pathlib.Path(path).touch()
-
-
-def is_empty_file(path: str):
-    """Check if a file is empty."""
-    return os.path.exists(path) and os.stat(path).st_size == 0
-
-
-def generate_graph_image(
-    body: dict,
-    width: int = 600,
-    height: int = 600,
+@app.post("/layout/graph")
+async def graph_layout_json(
+    request: Request,
     ngram_size: int = 2,
     limit: int = 10,
     graph_type: GraphType = GraphType.network,
     full: bool = False,
-    provider: ProviderStr = list(providers_map.keys())[0],
+    providers: dict = Depends(provider_params),
     method: TopicExtractionMethod = TopicExtractionMethod.anygram,
-    path: str = None,
+    budget_ms: int = None,
+    svg: bool = False,
 ):
-    """Generate a graph from a request body and writes to a temporary file"""
-    write_placeholder(path)
-
-    text = get_text(body)
-    d = get_topics(text, method, ngram_size).most_common(limit)
-    graph = expand_corpus(d, provider, full)
+    """Graph json like `/graph` but with the layout already computed so clients can draw it themselves.
+    Each node has `x` and `y` coordinates and each link has the `thickness` used in `/image/graph`.
 
-    if graph_type == GraphType.network:
-        image_bytes: bytes = plot_graph(graph, width, height)
-    elif graph_type == GraphType.tree:
-        image_bytes: bytes = plot_graph(graph, width, height, 1)
+    - **graph_type**: Layout to compute
+        - **network**: dot layout. Default
+        - **tree**: patchwork layout
 
-    # Write image to file
-    with open(path, "wb") as f:
-        f.write(image_bytes)
-
-
-def generate_graph(
-    body: dict,
-    provider: str,
-    full: bool = False,
-    limit: int = 10,
-    ngram_size: int = 2,
-    method: str = "anygram",
-    path: str = "0",
-):
-    """Generate a graph from a request body and writes to a temporary file"""
-    write_placeholder(path)
+    - **svg**: If true, the graphviz drawing of the graph is added as an svg string in `svg`
+    - Other parameters are the same as in `/graph`
+    """
+    body = await get_json(request)
+    if "Items" not in body:
+        return error_resp("Missing Items key in body")
 
     text = get_text(body)
-    d = get_topics(text, method, ngram_size).most_common(limit)
-    graph = expand_corpus(d, provider, full)
-    jgraph = json_graph.node_link_data(graph)
-    with open(path, "w") as f:
-        json.dump(jgraph, f)
+    style = 0 if graph_type == GraphType.network else 1
+    async with compute_pool.slot("layout"):
+        d = (await aget_topics(text, method, ngram_size)).most_common(limit)
+        return await compute_pool.run(
+            layout_job,
+            d,
+            style,
+            svg,
+            full=full,
+            budget_ms=budget_ms,
+            **providers,
+        )
 
 
 @app.post("/command/image/graph")
@@ -346,7 +449,7 @@ async def command_graph_image(
     limit: int = 10,
     graph_type: GraphType = GraphType.network,
     full: bool = False,
-    provider: ProviderStr = list(providers_map.keys())[0],
+    providers: dict = Depends(provider_params),
     method: TopicExtractionMethod = TopicExtractionMethod.anygram,
 ):
     """Graph png image representing the network of topic hierarchy. This endpoint will spawn the computation in background and return a command id that you can use to check the progress.
@@ -365,36 +468,37 @@ async def command_graph_image(
         - **tree**: Tree graph
 
     - **full**: If true, will return the full graph without supressing unlikely (low ammount of connections) topics
-    - **provider**: The document provider atlas for corpus expansion.
+    - **provider**: The document provider atlas for corpus expansion. Can be repeated to query several providers at once.
+    - **provider_policy**: How the graphs of several providers are combined
+        - **merge**: Edges of every provider are added up. Default
+        - **first**: The edges of a topic come from the first provider (in the given order) that found its page
+
+    - **provider_weights**: Weight multiplying the edges of each provider (one per provider). Defaults to 1
     """
-    global commands
     body = await get_json(request)
     if "Items" not in body:
         return error_resp("Missing Items key in body")
 
-    command_id = str(uuid4())
-    path = f"{TMP_PATH}/{command_id}.png"
-    commands[command_id] = {
-        "path": path,
-        "type": "png",
-    }
-    multiprocessing.Process(
-        target=generate_graph_image,
-        args=(
-            body,
-            width,
-            height,
-            ngram_size,
-            limit,
-            graph_type,
-            full,
-            provider,
-            method,
-            path,
+    path = f"{TMP_PATH}/{uuid4()}.png"
+    command_id = await job_queue.asubmit(
+        "png",
+        generate_graph_image,
+        dict(
+            body=body,
+            width=width,
+            height=height,
+            ngram_size=ngram_size,
+            limit=limit,
+            graph_type=graph_type,
+            full=full,
+            method=method,
+            path=path,
+            **providers,
         ),
-        daemon=True,
-    ).start()
-
+        path,
+    )
+    if command_id is None:
+        return queue_full_resp()
     return {"command_id": command_id}
 
 
@@ -404,7 +508,7 @@ async def command_graph(
     ngram_size: int = 2,
     limit: int = 10,
     full: bool = False,
-    provider: ProviderStr = list(providers_map.keys())[0],
+    providers: dict = Depends(provider_params),
     method: TopicExtractionMethod = TopicExtractionMethod.anygram,
 ):
     """Graph json representing the network of topic hierarchy. This endpoint will spawn the computation in background and return a command id that you can use to check the progress.
@@ -417,58 +521,65 @@ async def command_graph(
     - **ngram_size**: size of ngrams to use (only for ngram method)
     - **limit**: Max of topics to display. Defaults to 10
     - **full**: If true, will return the full graph without supressing unlikely (low ammount of connections) topics
-    - **provider**: The document provider atlas for corpus expansion.
+    - **provider**: The document provider atlas for corpus expansion. Can be repeated to query several providers at once.
+    - **provider_policy**: How the graphs of several providers are combined
+        - **merge**: Edges of every provider are added up. Default
+        - **first**: The edges of a topic come from the first provider (in the given order) that found its page
+
+    - **provider_weights**: Weight multiplying the edges of each provider (one per provider). Defaults to 1
     """
-    global commands
     body = await get_json(request)
     if "Items" not in body:
         return error_resp("Missing Items key in body")
 
-    command_id = str(uuid4())
-    path = f"{TMP_PATH}/{command_id}.json"
-    commands[command_id] = {
-        "path": path,
-        "type": "json",
-    }
-    multiprocessing.Process(
-        target=generate_graph,
-        args=(body, provider, full, limit, ngram_size, method, path),
-        daemon=True,
-    ).start()
-
+    path = f"{TMP_PATH}/{uuid4()}.json"
+    command_id = await job_queue.asubmit(
+        "json",
+        generate_graph,
+        dict(
+            body=body,
+            full=full,
+            limit=limit,
+            ngram_size=ngram_size,
+            method=method,
+            path=path,
+            **providers,
+        ),
+        path,
+    )
+    if command_id is None:
+        return queue_full_resp()
     return {"command_id": command_id}
 
 
 @app.get("/command/progress")
 async def command_progress(command_id: str):
-    """Get the progress of a command. The command id is returned by the command endpoints."""
-    global commands
-
-    if command_id not in commands:
+    """Get the progress of a command (queued, running, done or failed). The command id is returned by the command endpoints."""
+    job = await job_queue.aget(command_id)
+    if job is None:
         return error_resp("Command not found")
 
-    path = commands[command_id]["path"]
-    if is_empty_file(path):
-        return {"progress": "running", "type": commands[command_id]["type"]}
-
-    return {"progress": "done", "type": commands[command_id]["type"]}
+    progress = {"progress": job["status"], "type": job["kind"]}
+    if job["status"] == FAILED:
+        progress["error"] = job["error"]
+    return progress
 
 
 @app.get("/command/result")
 async def command_result(command_id: str):
     """Get the result of a command. The command id is returned by the command endpoints. Can return a png image or a json depending on the command"""
-    if command_id not in commands:
+    job = await job_queue.aget(command_id)
+    if job is None:
         return error_resp("Command not found")
-
-    path = commands[command_id]["path"]
-    if is_empty_file(path):
+    if job["status"] != DONE:
         return error_resp("Command not finished or failed")
 
     # Read file and return
-    if commands[command_id]["type"] == "png":
+    path = job["path"]
+    if job["kind"] == "png":
         return FileResponse(path, media_type="image/png")
 
-    elif commands[command_id]["type"] == "json":
+    elif job["kind"] == "json":
         with open(path, "r") as f:
             return json.load(f)
 
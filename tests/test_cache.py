@@ -0,0 +1,287 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+from topiclib.cache import (MISSING, CacheStats, SqliteCache, StatsCache, TieredCache, WalSqliteCache,
+                            WriteBehindCache, cachenames)
+from topiclib.file_cache import FileCache
+
+
+@pytest.fixture(params=[SqliteCache, WalSqliteCache, FileCache])
+def cache(request, tmp_path):
+    return request.param(str(tmp_path / "cache.db"))
+
+
+def test_cachenames():
+    assert cachenames["SqliteCache"] is SqliteCache
+    assert cachenames["WalSqliteCache"] is WalSqliteCache
+    assert cachenames["FileCache"] is FileCache
+
+
+def test_sqlite_cache(cache):
+    cache["a"] = "1"
+    cache.set_many([("b", "2"), ("c", "3")])
+    assert cache["a"] == "1" and cache.get("c") == "3"
+    assert "b" in cache and "z" not in cache
+    assert cache.get("z") is None
+    assert sorted(cache) == ["a", "b", "c"]
+    del cache["a"]
+    assert len(cache) == 2
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_write_behind(cache):
+    buffered = WriteBehindCache(cache, max_pending=100, flush_interval=60)
+    buffered["a"] = "1"
+    # Reads see the buffered write before it reaches the backend
+    assert buffered["a"] == "1" and "a" in buffered
+    assert "a" not in cache
+
+    buffered.flush()
+    assert cache["a"] == "1"
+
+    # Deletes are buffered too and flushed in order with the writes
+    del buffered["a"]
+    buffered["c"] = "3"
+    assert "a" not in buffered and buffered.get_many(["a", "c"]) == {"c": "3"}
+    assert cache["a"] == "1"
+    buffered.flush()
+    assert "a" not in cache and cache["c"] == "3"
+
+    buffered["b"] = "2"
+    buffered.close()
+    assert cache["b"] == "2"
+
+
+def test_write_behind_clear(cache):
+    buffered = WriteBehindCache(cache, max_pending=100, flush_interval=60)
+    # Nothing runs until the first write
+    assert buffered._pid is None
+    buffered["a"] = "1"
+    write_many = cache.write_many
+
+    def slow_write_many(items, deleted):
+        time.sleep(0.2)
+        write_many(items, deleted)
+
+    cache.write_many = slow_write_many
+    flush = threading.Thread(target=buffered.flush)
+    flush.start()
+    time.sleep(0.05)
+    buffered.clear()
+    flush.join()
+    assert "a" not in buffered and "a" not in cache
+
+
+def test_ttl_and_eviction(tmp_path):
+    cache = SqliteCache(
+        str(tmp_path / "cache.db"),
+        ttls={"search_": 0.1},
+        max_size=200_000,
+        maintenance_interval=None,
+    )
+    cache["search_a"] = "1"
+    cache["provider_a"] = "2"
+    time.sleep(0.2)
+    assert "search_a" not in cache and cache.get("search_a") is None
+    assert cache["provider_a"] == "2"
+
+    for i in range(500):
+        cache[f"provider_{i}"] = "v" * 1000
+    cache.get("provider_0")
+    cache.maintenance()
+    assert cache.disk_size() <= 200_000
+    assert cache.evictions > 0
+    # Least recently used keys go first
+    assert "provider_0" in cache and "provider_1" not in cache
+
+
+def test_old_file(tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE cache (key TEXT PRIMARY KEY, value TEXT)")
+    conn.executemany("INSERT INTO cache VALUES (?, ?)", [(f"old_{i}", "v") for i in range(3)])
+    conn.commit()
+    conn.close()
+
+    cache = SqliteCache(path, maintenance_interval=None)
+    assert cache.conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+    # Rows from before the access metadata are ordered by when they were added
+    assert cache.conn.execute("SELECT COUNT(*) FROM cache WHERE created_at IS NULL").fetchone()[0] == 0
+    # Only converted on request, the full VACUUM blocks the writers
+    cache.maintenance()
+    assert cache.auto_vacuum() == 0
+    assert cache.enable_auto_vacuum()
+    assert cache.auto_vacuum() == 2
+    assert cache["old_0"] == "v"
+
+
+def test_maintenance_owner(tmp_path):
+    path = str(tmp_path / "cache.db")
+    first = WalSqliteCache(path)
+    second = WalSqliteCache(path)
+    # Nothing runs until the cache is used
+    assert first._maintenance_pid is None
+    first.get("a")
+    second.get("a")
+    assert first._own_maintenance()
+    assert not second._own_maintenance()
+    assert first._own_maintenance()
+
+
+def test_tiered(cache):
+    tiered = TieredCache(cache, max_bytes=10, negative_ttl=60)
+    assert tiered.get("a", MISSING) is MISSING
+    # The miss is remembered, a write by someone else is not seen until negative_ttl
+    cache["a"] = "1"
+    assert "a" not in tiered
+    tiered["a"] = "2"
+    assert tiered["a"] == "2" and cache["a"] == "2"
+
+    tiered["b"] = "3333"
+    tiered["c"] = "4444"
+    # Least recently used keys are dropped from memory over max_bytes
+    assert "a" not in tiered._lru and tiered.size <= 10
+    assert tiered["a"] == "2"
+    del tiered["a"]
+    assert tiered.get("a") is None and "a" not in cache
+
+
+def test_tiered_max_age(cache):
+    tiered = TieredCache(cache, negative_ttl=0, max_age=0.1)
+    tiered["a"] = "1"
+    tiered["b"] = "2"
+    # Looking a key up doesn't promote it
+    assert "a" in tiered and list(tiered._lru) == ["a", "b"]
+    # Written by another process
+    cache["a"] = "3"
+    assert tiered["a"] == "1"
+    time.sleep(0.2)
+    assert tiered["a"] == "3"
+
+
+def test_batch(cache):
+    cache.set_many([(f"k{i}", str(i)) for i in range(1200)])
+    keys = [f"k{i}" for i in range(0, 1300, 2)]
+    assert cache.get_many(keys) == {f"k{i}": str(i) for i in range(0, 1200, 2)}
+    assert cache.contains_many(["k1", "z"]) == {"k1"}
+    cache.delete_many(keys)
+    assert len(cache) == 600
+
+    for wrapper in (WriteBehindCache(cache, flush_interval=60), TieredCache(cache)):
+        wrapper.set_many([("a", "1"), ("b", "2")])
+        assert wrapper.get_many(["a", "b", "c"]) == {"a": "1", "b": "2"}
+        assert wrapper.contains_many(["a", "c"]) == {"a"}
+        wrapper.delete_many(["a", "b"])
+        assert wrapper.get_many(["a", "b"]) == {} and "a" not in cache
+
+
+def test_iteration(cache):
+    if isinstance(cache, FileCache):
+        pytest.skip("FileCache keys are not paged in key order")
+    cache.set_many([(f"provider_{i:04}", str(i)) for i in range(2500)])
+    cache.set_many([("body_a", "a"), ("search_a", "s")])
+    keys = cache.iter_keys("provider_", page=100)
+    assert next(keys) == "provider_0000"
+    # Writes are not blocked while iterating
+    cache["provider_9999"] = "last"
+    assert len(list(keys)) == 2500
+    assert list(cache.iter_items("body_")) == [("body_a", "a")]
+    assert sorted(cache) == sorted(cache.keys()) and len(cache.keys()) == 2503
+
+
+def test_async(cache):
+    async def run():
+        await cache.aset("a", "1")
+        await cache.aset_many([("b", "2")])
+        assert await cache.aget("a") == "1"
+        assert await cache.aget("z", MISSING) is MISSING
+        assert await cache.aget_many(["a", "b", "z"]) == {"a": "1", "b": "2"}
+        await cache.adelete("a")
+        assert "a" not in cache
+
+    asyncio.run(run())
+
+
+def test_stats(cache):
+    stats = StatsCache(cache)
+    stats["provider_a"] = "1234"
+    stats.get("provider_a")
+    stats.get("provider_b")
+    stats.get_many(["body_a"])
+    snapshot = stats.snapshot()
+    provider = snapshot["provider_"]
+    assert (provider["hits"], provider["misses"], provider["sets"]) == (1, 1, 1)
+    assert provider["bytes_read"] == provider["bytes_written"] == 4
+    assert provider["hit_ratio"] == 0.5
+    assert sum(provider["get_latency"].values()) == 2
+    assert snapshot["body_"]["misses"] == 1
+
+    # Stats of another process, e.g. a compute worker
+    merged = CacheStats()
+    merged.merge(stats.stats.raw())
+    merged.merge(stats.stats.raw())
+    provider = merged.snapshot()["provider_"]
+    assert (provider["hits"], provider["misses"], provider["sets"]) == (2, 2, 2)
+    assert sum(provider["get_latency"].values()) == 4
+
+
+def test_file_cache(tmp_path):
+    cache = FileCache(
+        str(tmp_path / "cache"), ttls={"search_": 0.1}, max_size=50_000, maintenance_interval=None
+    )
+    cache["search_a"] = "1"
+    cache["provider_big"] = b"x" * 100_000
+    assert cache["provider_big"] == b"x" * 100_000
+    time.sleep(0.2)
+    assert "search_a" not in cache
+
+    for i in range(50):
+        cache[f"provider_{i}"] = b"v" * 1000
+    cache.maintenance()
+    assert cache.disk_size() <= 50_000 and cache.evicted["provider_"] > 0
+    # Maintenance compacts the index to the live keys
+    assert sorted(cache) == sorted(FileCache(str(tmp_path / "cache")).keys())
+    assert "search_a" not in cache.keys()
+
+
+def test_file_cache_maintenance(tmp_path):
+    cache = FileCache(str(tmp_path / "cache"), maintenance_interval=None)
+    cache.set("a", "1", ttl=0.1)
+    # Replaced by a process whose index record was lost
+    entry, _ = cache._entry("a", "2", 60)
+    cache._replace(cache._path("a"), entry)
+    entry, _ = cache._entry("b", "3")
+    os.makedirs(os.path.dirname(cache._path("b")), exist_ok=True)
+    cache._replace(cache._path("b"), entry)
+    time.sleep(0.2)
+    cache.maintenance()
+    # Expiry follows the file, and keys missing from the index are listed again
+    assert cache["a"] == "2" and sorted(cache.keys()) == ["a", "b"]
+
+    # Truncated files read as missing
+    with open(cache._path("b"), "wb") as f:
+        f.write(b"TC")
+    assert cache.get("b", MISSING) is MISSING
+
+    # Only one process runs maintenance at a time
+    assert cache._lease()
+    cache.set("c", "4", ttl=0.01)
+    time.sleep(0.05)
+    cache.maintenance()
+    assert os.path.exists(cache._path("c"))
+
+    # The api config can ask for "lfu", the files fall back to lru
+    assert FileCache(str(tmp_path / "cache"), eviction="lfu", maintenance_interval=None)["a"] == "2"
+
+
+def test_add(cache):
+    assert cache.add("lease_a", "1", ttl=0.1)
+    assert not cache.add("lease_a", "2", ttl=0.1)
+    time.sleep(0.2)
+    # Expired keys can be added again
+    assert cache.add("lease_a", "3", ttl=10) and cache["lease_a"] == "3"
@@ -0,0 +1,59 @@
+import json
+from collections import Counter
+
+import numpy as np
+from topiclib import codec
+
+
+def test_roundtrip():
+    counter = Counter({"machine learning": 3, "topic": 1, "ñandú": 70000})
+    edges = [["topic", "machine learning", 3], ["topic", "ñandú", 2]]
+    for value in [
+        counter,
+        {},
+        (counter, edges),
+        (["Page"], [["page"]]),
+        {"a": 1.5},
+        {"big": 2**70},
+        [["a", [1.0, 2.0]]],
+    ]:
+        decoded = codec.decode(codec.encode(value))
+        assert decoded == value
+
+
+def test_numpy_ints():
+    assert codec.decode(codec.encode({"a": np.int64(3)})) == {"a": 3}
+
+
+def test_compression():
+    counter = {f"topic {i}": i for i in range(5000)}
+    encoded = codec.encode(counter)
+    assert encoded[1] & codec.COMPRESSED
+    assert len(encoded) < len(json.dumps(counter)) / 2
+    assert codec.decode(encoded) == counter
+
+
+def test_legacy_json():
+    assert codec.decode(json.dumps([{"a": 1}, [["t", "a", 1]]])) == [{"a": 1}, [["t", "a", 1]]]
+
+
+def test_rows():
+    rows = [("topic", f"ngram {i}", i) for i in range(100)]
+    assert codec.decode(codec.encode(rows)) == [list(row) for row in rows]
+    # Mixed columns fall back to json
+    mixed = [["a", 1], [2, "b"]]
+    assert codec.decode(codec.encode(mixed)) == mixed
+
+
+def test_codec_cache(tmp_path):
+    from topiclib.cache import MISSING, SqliteCache
+
+    backend = SqliteCache(str(tmp_path / "cache.db"), maintenance_interval=None)
+    backend["old"] = json.dumps({"a": 1})
+    cache = codec.CodecCache(backend)
+    cache["new"] = (["Page"], [["page"]])
+    assert isinstance(backend["new"], bytes)
+    assert cache["new"] == (["Page"], [["page"]])
+    assert cache.get_many(["old", "new", "none"]) == {"old": {"a": 1}, "new": (["Page"], [["page"]])}
+    assert cache.get("none", MISSING) is MISSING
+    assert dict(cache.iter_items()) == {"old": {"a": 1}, "new": (["Page"], [["page"]])}
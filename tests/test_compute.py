@@ -0,0 +1,58 @@
+import asyncio
+import os
+
+from topiclib.compute import ComputePool
+
+
+def test_run_in_pool():
+    pool = ComputePool(2, {"slow": 1}, initializer=None)
+
+    async def main():
+        async with pool.slot("fast"):
+            pid = await pool.run(os.getpid)
+            power = await pool.run(pow, 2, 10)
+        return pid, power
+
+    try:
+        pid, power = asyncio.run(main())
+    finally:
+        pool.shutdown()
+    assert pid != os.getpid()
+    assert power == 1024
+
+
+def test_endpoint_limits():
+    pool = ComputePool(2, {"slow": 1}, default_limit=3, initializer=None)
+
+    async def main():
+        assert pool.slot("slow") is pool.slot("slow")
+        async with pool.slot("slow"):
+            assert pool.slot("slow").locked()
+            # Other endpoints are not limited by it
+            assert not pool.slot("fast").locked()
+
+    asyncio.run(main())
+
+
+def die_once(marker: str) -> int:
+    """Kills its worker the first time it runs"""
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        os._exit(1)
+    return os.getpid()
+
+
+def test_broken_pool(tmp_path):
+    pool = ComputePool(1, initializer=None)
+
+    async def main():
+        first = await pool.run(die_once, str(tmp_path / "marker"))
+        # The new pool keeps serving
+        second = await pool.run(os.getpid)
+        return first, second
+
+    try:
+        first, second = asyncio.run(main())
+    finally:
+        pool.shutdown()
+    assert first == second != os.getpid()
@@ -1,4 +1,5 @@
 from parser import parsefile
+import networkx as nx
 from networkx.readwrite import json_graph
 from topiclib import TopicExtractor, expand_corpus
 import providers
@@ -22,3 +23,103 @@ def test_expansion():
                               'weight_total': 254,
                               'source': 'natural number',
                               'target': 'number'}]}
+
+
+def test_merge_edges():
+    from topiclib.corpus_expansion import Expansion, merge_edges
+
+    local = Expansion("local", ["a", "b"], [("a", [("a", "b", 2)])], [], [], [])
+    remote = Expansion("remote", ["a", "b"], [("a", [("a", "b", 4)]), ("b", [("b", "a", 3)])], [], [], [])
+
+    assert merge_edges([local, remote], [1, 0.5]) == [("a", "b", 2), ("a", "b", 2.0), ("b", "a", 1.5)]
+    assert merge_edges([local, remote], [1, 1], "first") == [("a", "b", 2), ("b", "a", 3)]
+
+    # Two pages with the same topic are both kept, "first" takes every page of the first provider
+    local = Expansion("local", ["a", "a", "b"], [("a", [("a", "b", 2)]), ("a", [("a", "b", 1)])], [], [], [])
+    assert merge_edges([local, remote], [1, 1]) == [("a", "b", 2), ("a", "b", 1), ("a", "b", 4), ("b", "a", 3)]
+    assert merge_edges([local, remote], [1, 1], "first") == [("a", "b", 2), ("a", "b", 1), ("b", "a", 3)]
+
+
+def test_budget_before_any_page():
+    import time
+    from topiclib.corpus_expansion import IDocumentProvider
+    from topiclib.render import render_png
+
+    class SlowPages(IDocumentProvider):
+        name = "slow"
+
+        def search(self, query):
+            return [query]
+
+        def content(self, page):
+            time.sleep(1)
+            return page
+
+        def categories(self, page):
+            return []
+
+    graph = expand_corpus([("number", 2), ("integer", 1)], SlowPages(), use_cache=False, budget_ms=200)
+    assert graph.number_of_edges() == 0
+    assert graph.graph["expansion"]["complete"] is False
+    assert sorted(graph.graph["expansion"]["pending"]) == ["integer", "number"]
+
+    pos = {node: (i, 0) for i, node in enumerate(graph.nodes())}
+    assert render_png(graph, pos, 64, 64).startswith(b"\x89PNG")
+    assert render_png(nx.DiGraph(), {}, 64, 64).startswith(b"\x89PNG")
+
+
+def test_cached_page_of_other_topics(tmp_path):
+    from topiclib import codec
+    from topiclib.cache import Cache, SqliteCache
+    from topiclib.corpus_expansion import IDocumentProvider
+
+    class Pages(IDocumentProvider):
+        name = "pages"
+
+        def search(self, query):
+            return [query]
+
+        def content(self, page):
+            return "integer number integer number"
+
+        def categories(self, page):
+            return []
+
+    previous = Cache._cache
+    cache = SqliteCache(str(tmp_path / "cache.db"), maintenance_interval=None)
+    # Stored by a request whose topics had 'natural number'
+    cache["provider_" + repr(("pages", "number"))] = codec.encode(({}, [("number", "natural number", 5)]))
+    Cache.set_cache(cache)
+    try:
+        graph = expand_corpus([("number", 2), ("integer", 1)], Pages(), full=True)
+    finally:
+        Cache._cache = previous
+    assert graph.has_edge("number", "natural number")
+
+
+def test_first_skips_resolved_pages():
+    from topiclib.corpus_expansion import IDocumentProvider
+
+    fetched = []
+
+    class Pages(IDocumentProvider):
+        def __init__(self, name, pages):
+            self.name = name
+            self.pages = pages
+
+        def search(self, query):
+            return [query] if query in self.pages else []
+
+        def content(self, page):
+            fetched.append((self.name, page))
+            return "integer number integer number"
+
+        def categories(self, page):
+            return []
+
+    local = Pages("local", ["number"])
+    remote = Pages("remote", ["number", "integer"])
+    expand_corpus([("number", 2), ("integer", 1)], [local, remote], full=True, use_cache=False,
+                  provider_policy="first")
+    # The page of number is only fetched from the first provider
+    assert sorted(fetched) == [("local", "number"), ("remote", "integer")]
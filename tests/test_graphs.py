@@ -0,0 +1,98 @@
+import random
+
+import networkx as nx
+from topiclib.graphs import aggregate_edges, build_graph, prune_edges
+
+
+def add_arrows(graph, edges):
+    """Edge by edge implementation used before the vectorized one"""
+    for start, end, weight in edges:
+        s, e = start, end
+        if graph.has_edge(end, start):
+            w = graph[end][start]["weight"]
+            graph[end][start]["weight"] -= weight
+            if graph[end][start]["weight"] <= 0:
+                weight_total = graph[end][start]["weight_total"]
+                graph.remove_edge(end, start)
+                graph.add_edge(start, end, weight=weight - w, weight_total=weight_total)
+            else:
+                s, e = end, start
+        elif graph.has_edge(start, end):
+            graph[start][end]["weight"] += weight
+        else:
+            graph.add_edge(start, end, weight=weight, weight_total=0)
+        graph[s][e]["weight_total"] += weight
+    return graph
+
+
+def prune(graph, w_min):
+    """Copy based pruning used before the vectorized one"""
+    weight_totals = nx.get_edge_attributes(graph, "weight_total")
+    full_graph = graph.copy()
+    graph.remove_edges_from((e for e, w in weight_totals.items() if w < w_min))
+    graph.remove_nodes_from(list(nx.isolates(graph)))
+    for node in full_graph.nodes():
+        if node not in graph.nodes():
+            continue
+        for edge in full_graph.edges(node):
+            if edge not in graph.edges() and edge[0] in graph.nodes() and edge[1] in graph.nodes():
+                graph.add_edge(edge[0], edge[1], **full_graph[edge[0]][edge[1]])
+    return graph
+
+
+def edge_data(graph):
+    return {(s, e): d for s, e, d in graph.edges(data=True)}
+
+
+def random_edges(n_nodes, n_edges, seed):
+    rng = random.Random(seed)
+    nodes = [f"topic {i}" for i in range(n_nodes)]
+    edges = []
+    for _ in range(n_edges):
+        s, e = rng.sample(nodes, 2)
+        edges.append((s, e, rng.randint(2, 6)))
+    return nodes, edges
+
+
+def test_aggregate_edges():
+    for seed in range(20):
+        nodes, edges = random_edges(15, 200, seed)
+        expected = nx.DiGraph()
+        expected.add_nodes_from(nodes)
+        add_arrows(expected, edges)
+        graph = build_graph(nodes, *aggregate_edges(nodes, edges))
+        assert list(graph.nodes()) == list(expected.nodes())
+        assert edge_data(graph) == edge_data(expected)
+
+
+def test_aggregate_edges_empty():
+    graph = build_graph(["a", "b"], *aggregate_edges(["a", "b"], []))
+    assert list(graph.nodes()) == ["a", "b"]
+    assert len(graph.edges()) == 0
+
+
+def test_prune_edges():
+    for seed in range(20):
+        nodes, edges = random_edges(30, 60, seed)
+        index, src, dst, weight, weight_total = aggregate_edges(nodes, edges)
+        w_min = sorted(weight_total.tolist())[len(weight_total) // 2]
+        expected = prune(build_graph(nodes, index, src, dst, weight, weight_total), w_min)
+
+        node_mask, edge_mask = prune_edges(len(index), src, dst, weight_total, w_min)
+        kept = [name for name, i in index.items() if node_mask[i]]
+        m = edge_mask
+        graph = build_graph(kept, index, src[m], dst[m], weight[m], weight_total[m])
+        assert list(graph.nodes()) == list(expected.nodes())
+        assert edge_data(graph) == edge_data(expected)
+
+
+def test_aggregate_edges_unknown_nodes():
+    # Edges of cached pages can point to topics of another search
+    nodes = ["number", "integer"]
+    edges = [("number", "natural number", 5), ("integer", "number", 2)]
+    expected = nx.DiGraph()
+    expected.add_nodes_from(nodes)
+    add_arrows(expected, edges)
+    graph = build_graph(nodes, *aggregate_edges(nodes, edges))
+    assert list(graph.nodes()) == ["number", "integer", "natural number"]
+    assert edge_data(graph) == edge_data(expected)
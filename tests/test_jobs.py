@@ -0,0 +1,86 @@
+import os
+import time
+
+from topiclib.jobs import DONE, FAILED, QUEUED, RUNNING, JobQueue, JobWorkers, run_job
+
+
+def write_result(path: str, text: str):
+    if not text:
+        raise ValueError("Nothing to write")
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def die():
+    os._exit(1)
+
+
+def test_queue(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"), max_queued=2)
+    path = str(tmp_path / "result.txt")
+    first = queue.submit("txt", write_result, {"path": path, "text": "hi"}, path)
+    second = queue.submit("txt", write_result, {"path": path, "text": ""})
+    # Saturated
+    assert queue.submit("txt", write_result, {"path": path, "text": "hi"}) is None
+    assert queue.get(first)["status"] == QUEUED
+    assert queue.counts() == {QUEUED: 2}
+
+    job = queue.claim(os.getpid())
+    assert job["id"] == first
+    assert queue.get(first)["status"] == RUNNING
+    run_job(queue, job)
+    assert queue.get(first)["status"] == DONE
+    with open(path) as f:
+        assert f.read() == "hi"
+
+    run_job(queue, queue.claim(os.getpid()))
+    assert queue.get(second)["status"] == FAILED
+    assert "Nothing to write" in queue.get(second)["error"]
+    assert queue.claim(os.getpid()) is None
+
+
+def test_cleanup(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"), retention=0.05, timeout=0.05)
+    path = str(tmp_path / "result.txt")
+    done = queue.submit("txt", write_result, {"path": path, "text": "hi"}, path)
+    run_job(queue, queue.claim(os.getpid()))
+    lost = queue.submit("txt", write_result, {"path": path, "text": "hi"})
+    queue.claim(12345)
+    time.sleep(0.1)
+
+    # The finished job is removed with its result, the lost one is failed
+    assert queue.cleanup() == 1
+    assert queue.get(done) is None
+    assert not os.path.exists(path)
+    assert queue.get(lost)["status"] == FAILED
+
+
+def test_finish_after_timeout(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"), timeout=0.05)
+    path = str(tmp_path / "result.txt")
+    late = queue.submit("txt", write_result, {"path": path, "text": "hi"})
+    job = queue.claim(os.getpid())
+    time.sleep(0.1)
+    queue.cleanup()
+
+    # The timed out job stays failed
+    run_job(queue, job)
+    assert queue.get(late)["status"] == FAILED
+    assert not queue.finish(late, os.getpid())
+
+
+def test_workers_restarted(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"))
+    crashed = queue.submit("crash", die, {})
+    workers = JobWorkers(queue, 1, poll_interval=0.05, initializer=None, supervise_interval=0.05)
+    workers.start()
+    first = workers._processes[0]
+    try:
+        deadline = time.monotonic() + 30
+        while queue.get(crashed)["status"] != FAILED and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert queue.get(crashed)["error"] == "Worker stopped"
+        assert workers._processes[0] is not first
+        assert workers._processes[0].is_alive()
+    finally:
+        workers.shutdown()
@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+
+from topiclib.nlp_sidecar import Batcher, NlpClient, NlpServer
+
+
+@pytest.fixture
+def sidecar(tmp_path):
+    batches = []
+
+    def process(texts):
+        batches.append(len(texts))
+        if "fail" in texts:
+            raise ValueError("Bad text")
+        if "slow" in texts:
+            time.sleep(0.3)
+        return [text.split() for text in texts]
+
+    path = str(tmp_path / "nlp.sock")
+    server = NlpServer(path, Batcher(process, max_batch=16, max_wait=0.05))
+    # As when shared by forked processes
+    server.socket.setblocking(False)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield path, batches
+    server.shutdown()
+    server.server_close()
+
+
+def test_preprocess(sidecar):
+    path, _ = sidecar
+    client = NlpClient(path)
+    assert client.preprocess("complex numbers") == ["complex", "numbers"]
+    assert client.preprocess("") == []
+    assert client.preprocess_many(["a b", "ñandú"]) == [["a", "b"], ["ñandú"]]
+    with pytest.raises(RuntimeError):
+        client.preprocess("fail")
+    # The connection is still usable
+    assert client.preprocess("again") == ["again"]
+
+
+def test_batching(sidecar):
+    path, batches = sidecar
+    client = NlpClient(path)
+    results = {}
+
+    def call(i):
+        results[i] = client.preprocess(f"text {i}")
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {i: ["text", str(i)] for i in range(8)}
+    assert max(batches) > 1
+
+
+def test_unavailable(tmp_path):
+    with pytest.raises(OSError):
+        NlpClient(str(tmp_path / "missing.sock")).preprocess("text")
+
+
+def test_shared_socket(sidecar):
+    path, _ = sidecar
+    # Connections taken by another process are skipped
+    server = NlpServer(path + "2")
+    server.socket.setblocking(False)
+    server._handle_request_noblock()
+    server.server_close()
+    # Large frames over a connection of the non-blocking socket
+    text = "word " * 200000
+    assert len(NlpClient(path).preprocess(text)) == 200000
+
+
+def test_timeout_not_sent_again(sidecar):
+    path, batches = sidecar
+    with pytest.raises(OSError):
+        NlpClient(path, timeout=0.1).preprocess("slow")
+    time.sleep(0.4)
+    assert batches == [1]
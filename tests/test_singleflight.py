@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+
+from topiclib.cache import SqliteCache, WriteBehindCache
+from topiclib.singleflight import SingleFlight
+
+
+def slow(calls, value="v"):
+    def func():
+        calls.append(1)
+        time.sleep(0.2)
+        return value
+    return func
+
+
+def run_threads(target, n=5):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(target())) for _ in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_in_process():
+    flight = SingleFlight()
+    calls = []
+    assert run_threads(lambda: flight.do("k", slow(calls))) == ["v"] * 5
+    assert len(calls) == 1
+
+
+def test_between_processes(tmp_path):
+    # Each SingleFlight stands for a worker, they only share the cache
+    cache = SqliteCache(str(tmp_path / "cache.db"), maintenance_interval=None)
+    calls = []
+
+    def worker():
+        return SingleFlight(poll_interval=0.01).do("k", slow(calls), WriteBehindCache(cache))
+
+    assert run_threads(worker) == ["v"] * 5
+    assert len(calls) == 1
+    assert cache["k"] == "v" and "lease_k" not in cache
+
+
+def test_nothing_stored(tmp_path):
+    cache = SqliteCache(str(tmp_path / "cache.db"), maintenance_interval=None)
+    calls = []
+    flight = SingleFlight()
+    assert flight.do("k", slow(calls, None), cache) is None
+    assert "k" not in cache and "lease_k" not in cache
+
+
+def test_async(tmp_path):
+    cache = SqliteCache(str(tmp_path / "cache.db"), maintenance_interval=None)
+    flight = SingleFlight(poll_interval=0.01)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.2)
+        return "v"
+
+    async def run():
+        return await asyncio.gather(*(flight.ado("k", compute, cache) for _ in range(5)))
+
+    assert asyncio.run(run()) == ["v"] * 5
+    assert len(calls) == 1 and cache["k"] == "v"
+
+
+def test_writes_batched(tmp_path):
+    writes = []
+
+    class Counting(SqliteCache):
+        def _writer(self):
+            writes.append(1)
+            return super()._writer()
+
+    backend = Counting(str(tmp_path / "cache.db"), maintenance_interval=None)
+    cache = WriteBehindCache(backend, flush_interval=60)
+    flight = SingleFlight()
+    keys = [f"provider_{i}" for i in range(5)]
+    writes.clear()
+    flight.lease_many(keys, cache)
+    for key in keys:
+        assert flight.do(key, lambda: "v", cache) == "v"
+    # Leases in one write, the values and the lease releases in another
+    assert "lease_provider_0" in backend
+    cache.flush()
+    assert len(writes) == 2
+    assert all(backend[key] == "v" and "lease_" + key not in backend for key in keys)
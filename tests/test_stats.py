@@ -0,0 +1,30 @@
+import json
+import time
+
+from topiclib.cache import Cache, CacheStats, SqliteCache, StatsCache
+from topiclib.fetch import latency_tracker
+from topiclib.stats import StatsTable
+
+
+def test_merged(tmp_path):
+    previous = Cache._cache
+    cache = StatsCache(SqliteCache(str(tmp_path / "cache.db"), maintenance_interval=None))
+    Cache.set_cache(cache)
+    try:
+        cache["provider_a"] = "1"
+        cache.get("provider_a")
+        latency_tracker("stats-test").add(0.5)
+        table = StatsTable(str(tmp_path / "stats.db"))
+        # Row of another process, and one gone for too long
+        other = CacheStats()
+        other.record_get("provider_a", "1", 0.001)
+        other.record_get("provider_b", "2", 0.001)
+        row = {"latency": {"stats-test": [1.5, 2.5]}, "cache": other.raw(), "evicted": {"provider_": 3}}
+        table.conn.execute("INSERT INTO stats VALUES ('other:1', ?, ?)", (time.time(), json.dumps(row)))
+        table.conn.execute("INSERT INTO stats VALUES ('gone:1', 0, '{\"latency\": {}}')")
+
+        assert table.latency_percentiles()["stats-test"]["count"] == 3
+        provider = table.cache_snapshot()["provider_"]
+        assert (provider["hits"], provider["sets"], provider["evictions"]) == (3, 1, 3)
+    finally:
+        Cache._cache = previous
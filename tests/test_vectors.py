@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from topiclib.vectors import map_vectors, share_vectors
+
+
+def fake_nlp(rows=4, version="3.0.0"):
+    data = np.arange(rows * 3, dtype=np.float32).reshape(rows, 3)
+    return SimpleNamespace(
+        vocab=SimpleNamespace(vectors=SimpleNamespace(data=data)),
+        meta={"lang": "en", "name": "core_web_md", "version": version},
+    )
+
+
+def test_share_vectors(tmp_path):
+    path = str(tmp_path / "vectors.npy")
+    nlp = fake_nlp()
+    assert not map_vectors(nlp, path)
+
+    # Exported by the first process, mapped by the others
+    assert share_vectors(nlp, path)
+    other = fake_nlp()
+    assert map_vectors(other, path)
+    data = other.vocab.vectors.data
+    assert isinstance(data, np.memmap)
+    assert not data.flags.writeable
+    assert np.array_equal(data, fake_nlp().vocab.vectors.data)
+
+    # Another model version is exported again
+    newer = fake_nlp(version="3.1.0")
+    assert not map_vectors(newer, path)
+    assert share_vectors(newer, path)
+    assert not map_vectors(fake_nlp(), path)
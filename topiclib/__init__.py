@@ -1,14 +1,23 @@
 from . import providers
-from .cache import SqliteCache, Cache, ICache, synchronized_method, cacheclass, cachenames
-from .corpus_expansion import (IDocumentProvider, expand_corpus, plot_graph,
-                               provider, providers_map)
-from .topic_extraction import (TopicExtractor, clusterize, filter_low,
+from .cache import (MISSING, SqliteCache, WalSqliteCache, WriteBehindCache, TieredCache,
+                    StatsCache, CacheStats, Cache, ICache, synchronized_method, cacheclass, cachenames,
+                    set_async_workers)
+from .file_cache import FileCache
+from .codec import CodecCache
+from .corpus_expansion import (IDocumentProvider, expand_corpus, provider,
+                               providers_map)
+from .compute import ComputePool
+from .render import graph_layout, layout_data, plot_graph
+from .topic_extraction import (TopicExtractor, clusterize, extract_topics, filter_low,
                                ngram_contains)
+from .singleflight import SingleFlight, set_single_flight
+from .fetch import FetchPolicy, latency_percentiles, set_fetch_policy
 from .wordprocess import gsd, wordcloud
 from .utils import hash_text
 
-__all__ = ("ICorpus", "TopicExtractor", "filter_low",
+__all__ = ("ICorpus", "TopicExtractor", "extract_topics", "filter_low",
            "clusterize", "ngram_contains", "provider",
            "expand_corpus", "gsd", "wordcloud", "providers_map",
-           "plot_graph", "Cache", "SqliteCache", "IDocumentProvider"
-           "ICache", "synchronized_method", "hash_text", "cacheclass", "cachenames")
+           "plot_graph", "graph_layout", "layout_data", "ComputePool", "Cache", "SqliteCache", "WalSqliteCache", "FileCache", "WriteBehindCache", "TieredCache", "StatsCache", "CodecCache", "CacheStats", "MISSING", "IDocumentProvider"
+           "ICache", "synchronized_method", "hash_text", "cacheclass", "cachenames", "set_async_workers",
+           "SingleFlight", "set_single_flight", "FetchPolicy", "latency_percentiles", "set_fetch_policy")
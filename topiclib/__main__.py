@@ -6,10 +6,15 @@ from pathlib import Path
 import click
 from networkx.readwrite import json_graph
 
+from .cache import cachenames
 from .corpus_expansion import expand_corpus, plot_graph
+from .nlp_sidecar import serve as serve_nlp
+from .preprocess import load_nlp, set_vectors_path
+from .vectors import export_vectors
 from .parser import parsefile
 from .topic_extraction import TopicExtractor
 from .wordprocess import gsd
+from .warm import cache_settings, find_inputs, warm as warm_jobs
 from .wordprocess import wordcloud as wc
 
 logger = logging.getLogger("topiclib")
@@ -30,6 +35,17 @@ def get_topics(text: str, method: str, ngram_size: int = 2):
     return Counter(counter)
 
 
+def check_weights(provider: [str], provider_weights: [float]) -> [float]:
+    """--provider_weights as expand_corpus takes them, None if not given"""
+    if not provider_weights:
+        return None
+    if len(provider_weights) != len(provider):
+        raise click.BadParameter(
+            "must be given once per provider", param_hint="--provider_weights"
+        )
+    return list(provider_weights)
+
+
 def checkinput_file(func):
     """
     Decorator to check if input file exists
@@ -147,7 +163,23 @@ def topics(input, method: str = "anygram", ngram_size: int = 2, limit: int = 20)
 @click.option("-l", "--limit", default=10, help="limit the number of topics to display")
 @click.option("-o", "--output", default=None, help="Output path")
 @click.option(
-    "-p", "--provider", default=None, help="provider to use for topic expansion"
+    "-p",
+    "--provider",
+    default=("wikipedia",),
+    multiple=True,
+    help="provider to use for topic expansion, can be repeated",
+)
+@click.option(
+    "--provider_policy",
+    default="merge",
+    type=click.Choice(["merge", "first"]),
+    help="how to combine the graphs of several providers",
+)
+@click.option(
+    "--provider_weights",
+    type=float,
+    multiple=True,
+    help="weight multiplying the edges of each provider, repeated once per provider. Defaults to 1",
 )
 @click.option(
     "-g",
@@ -165,13 +197,21 @@ def graphimg(
     ngram_size: int = 2,
     limit: int = 10,
     output: str = None,
-    provider: str = None,
+    provider: [str] = None,
+    provider_policy: str = "merge",
+    provider_weights: [float] = None,
     graph_type: str = None,
 ):
     text = parsefile(input)
     d = get_topics(text, method, ngram_size).most_common(limit)
     print(f"Got topics: {limit=} {d}")
-    graph = expand_corpus(d, provider, use_cache=False)
+    graph = expand_corpus(
+        d,
+        provider,
+        use_cache=False,
+        provider_weights=check_weights(provider, provider_weights),
+        provider_policy=provider_policy,
+    )
 
     if graph_type == "network":
         image_bytes: bytes = plot_graph(graph, width, height)
@@ -202,7 +242,23 @@ def graphimg(
 )
 @click.option("-l", "--limit", default=10, help="limit the number of topics to display")
 @click.option(
-    "-p", "--provider", default=None, help="provider to use for topic expansion"
+    "-p",
+    "--provider",
+    default=("wikipedia",),
+    multiple=True,
+    help="provider to use for topic expansion, can be repeated",
+)
+@click.option(
+    "--provider_policy",
+    default="merge",
+    type=click.Choice(["merge", "first"]),
+    help="how to combine the graphs of several providers",
+)
+@click.option(
+    "--provider_weights",
+    type=float,
+    multiple=True,
+    help="weight multiplying the edges of each provider, repeated once per provider. Defaults to 1",
 )
 @click.option(
     "-g",
@@ -217,15 +273,144 @@ def graph(
     method: str = "anygram",
     ngram_size: int = 2,
     limit: int = 10,
-    provider: str = None,
+    provider: [str] = None,
+    provider_policy: str = "merge",
+    provider_weights: [float] = None,
     graph_type: str = None,
 ):
     text = parsefile(input)
     d = get_topics(text, method, ngram_size).most_common(limit)
-    graph = expand_corpus(d, provider, use_cache=False)
+    graph = expand_corpus(
+        d,
+        provider,
+        use_cache=False,
+        provider_weights=check_weights(provider, provider_weights),
+        provider_policy=provider_policy,
+    )
 
     print(json_graph.node_link_data(graph))
 
 
+@cli.command(help="Precomputes topics, provider pages and graph layouts into the api cache.")
+@click.option(
+    "-i",
+    "--input",
+    multiple=True,
+    help="transcript json file, directory or glob pattern, can be repeated",
+)
+@click.option("-t", "--topics", multiple=True, help="comma separated topics to expand, can be repeated")
+@click.option(
+    "-m",
+    "--method",
+    default="anygram",
+    type=click.Choice(["gsdmm", "ngram", "anygram"]),
+    help="method to use for topic generation (same names as the api)",
+)
+@click.option("-n", "--ngram_size", default=2, help="size of ngrams to use (only for ngram method)")
+@click.option("-l", "--limit", default=10, help="number of topics to expand")
+@click.option(
+    "-p",
+    "--provider",
+    default=("wikipedia",),
+    multiple=True,
+    help="provider to use for topic expansion, can be repeated",
+)
+@click.option(
+    "--provider_policy",
+    default="merge",
+    type=click.Choice(["merge", "first"]),
+    help="how to combine the graphs of several providers",
+)
+@click.option("-c", "--cache_path", default=None, help="cache to fill. Defaults to CACHE_PATH of config.py")
+@click.option("-s", "--state", default=None, help="file of finished jobs to resume from. Defaults to <cache_path>.warm")
+@click.option("-w", "--workers", default=None, type=int, help="number of processes. Defaults to the cpu count")
+def warm(
+    input: [str],
+    topics: [str],
+    method: str = "anygram",
+    ngram_size: int = 2,
+    limit: int = 10,
+    provider: [str] = None,
+    provider_policy: str = "merge",
+    cache_path: str = None,
+    state: str = None,
+    workers: int = None,
+):
+    jobs = find_inputs(input) + [f"topics:{t}" for t in topics]
+    if not jobs:
+        raise click.ClickException("Nothing to warm, give --input or --topics")
+
+    cache = cache_settings()
+    if cache_path:
+        cache["path"] = cache_path
+    state = state or cache["path"] + ".warm"
+    print(f"Warming {cache['path']} with {len(jobs)} jobs, progress in {state}")
+    done, failed = warm_jobs(
+        jobs,
+        state,
+        workers,
+        cache,
+        method=method,
+        ngram_size=ngram_size,
+        limit=limit,
+        providers=provider,
+        provider_policy=provider_policy,
+    )
+    print(f"{done} jobs done, {failed} failed")
+
+
+@cli.command(help="Switches an sqlite cache created by older versions to incremental vacuuming.")
+@click.option("-c", "--cache_path", default=None, help="sqlite cache file. Defaults to CACHE_PATH of config.py")
+def vacuum(cache_path: str = None):
+    cache = cache_settings()
+    if cache_path:
+        cache["path"] = cache_path
+    backend = cachenames[cache["backend"]](cache["path"], maintenance_interval=None)
+    if not hasattr(backend, "enable_auto_vacuum"):
+        raise click.ClickException(f"{cache['backend']} has nothing to vacuum")
+    print(f"Vacuuming {cache['path']}, the api should be stopped meanwhile")
+    if backend.enable_auto_vacuum():
+        print("Switched to incremental auto vacuum")
+    else:
+        print("Already using incremental auto vacuum")
+    backend.close()
+
+
+@cli.command(help="Runs the nlp sidecar the api workers send their text preprocessing to.")
+@click.option("-s", "--socket", "socket_path", default=None, help="unix socket to listen on. Defaults to NLP_SOCKET of config.py")
+@click.option("-p", "--processes", default=1, help="processes sharing the loaded model")
+@click.option("-b", "--max_batch", default=64, help="most texts run through the pipeline at once")
+@click.option("--max_wait", default=0.005, help="seconds to wait for a batch to fill")
+@click.option("-v", "--vectors", default=None, help="word vectors file to memory map. Defaults to VECTORS_PATH of config.py")
+def nlp(
+    socket_path: str = None,
+    processes: int = 1,
+    max_batch: int = 64,
+    max_wait: float = 0.005,
+    vectors: str = None,
+):
+    try:
+        import config
+    except ImportError:
+        config = None
+    socket_path = socket_path or getattr(config, "NLP_SOCKET", None)
+    if not socket_path:
+        raise click.ClickException("Give the --socket to listen on")
+    set_vectors_path(vectors or getattr(config, "VECTORS_PATH", None) or None)
+    serve_nlp(socket_path, processes, max_batch, max_wait)
+
+
+@cli.command(help="Exports the word vectors of the spacy model to a file the api memory maps.")
+@click.option("-o", "--output", default=None, help="vectors file. Defaults to VECTORS_PATH of config.py")
+def vectors(output: str = None):
+    try:
+        import config
+    except ImportError:
+        config = None
+    output = output or getattr(config, "VECTORS_PATH", None) or "vectors.npy"
+    export_vectors(load_nlp(), output)
+    print(f"Saved the word vectors to {output}")
+
+
 if __name__ == "__main__":
     cli()
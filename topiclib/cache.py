@@ -1,13 +1,64 @@
+import asyncio
+import atexit
+import concurrent.futures
+import os
+import sqlite3
+import threading
+import time
+import uuid
 from abc import ABC, abstractclassmethod
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from functools import partial
 from multiprocessing import Lock
-import sqlite3
 
 cachenames = {}
 
+
+class _Missing:
+    def __repr__(self):
+        return "MISSING"
+
+
+# Default for get() to tell a missing key apart from any stored value in a single lookup
+MISSING = _Missing()
+
+# Threads running the cache calls of async code (aget, aset...), so disk waits don't block the loop
+async_workers = 4
+_async_executor = None
+_async_pid = None
+_async_lock = threading.Lock()
+
+
+def set_async_workers(workers: int) -> None:
+    """Number of threads for async cache calls. Takes effect for new processes or pools"""
+    global async_workers, _async_executor
+    with _async_lock:
+        async_workers = workers
+        _async_executor = None
+
+
+def async_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Thread pool of the async cache calls of this process (a new one after a fork)"""
+    global _async_executor, _async_pid
+    with _async_lock:
+        if _async_executor is None or _async_pid != os.getpid():
+            _async_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=async_workers, thread_name_prefix="cache-async")
+            _async_pid = os.getpid()
+        return _async_executor
+
+
+async def _run(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(async_executor(), partial(func, *args))
+
+
 # Abstract caching class
 class ICache(ABC):
     @abstractclassmethod
-    def get(self, key: str) -> str:
+    def get(self, key: str, default=None) -> str:
+        """Returns the value of key or default if it is not in cache"""
         pass
 
     @abstractclassmethod
@@ -58,9 +109,87 @@ class ICache(ABC):
     def __delitem__(self, key: str) -> None:
         pass
 
+    # Batch operations. Backends should override them to use one query or transaction
+
+    def get_many(self, keys: [str]) -> dict:
+        """Returns {key: value} of the keys found in cache"""
+        values = {}
+        for key in keys:
+            value = self.get(key, MISSING)
+            if value is not MISSING:
+                values[key] = value
+        return values
+
+    def contains_many(self, keys: [str]) -> set:
+        """Returns the set of keys found in cache"""
+        return {key for key in keys if key in self}
+
+    def set_many(self, items: [(str, str)]) -> None:
+        """Sets several keys"""
+        for key, value in items:
+            self.set(key, value)
+
+    def delete_many(self, keys: [str]) -> None:
+        for key in keys:
+            self.delete(key)
+
+    def write_many(self, items: [(str, str)], deleted: [str]) -> None:
+        """set_many(items) then delete_many(deleted)"""
+        if items:
+            self.set_many(items)
+        if deleted:
+            self.delete_many(deleted)
+
+    def add(self, key: str, value: str, ttl: float = None) -> bool:
+        """Sets key only if it is not in cache and returns whether it did. Backends shared between
+        processes override it with an atomic version that honours ttl, this one is neither"""
+        if key in self:
+            return False
+        self.set(key, value)
+        return True
+
+    def add_many(self, items: [(str, str)], ttl: float = None) -> set:
+        """add() of several keys, returns the set of keys added"""
+        return {key for key, value in items if self.add(key, value, ttl)}
+
+    # Streaming iteration. Backends should override them to read in batches
+
+    def iter_keys(self, prefix: str = "") -> iter:
+        """Iterates over the keys starting with prefix"""
+        return (key for key in self.keys() if key.startswith(prefix))
+
+    def iter_items(self, prefix: str = "") -> iter:
+        """Iterates over the (key, value) of the keys starting with prefix"""
+        return ((key, value) for key, value in self.items() if key.startswith(prefix))
+
+    def flush(self) -> None:
+        """Writes any buffered data to the backend"""
+        pass
+
+    def close(self) -> None:
+        """Flushes and releases resources. Called on shutdown"""
+        self.flush()
+
     def set_lock(self, lock: Lock) -> None:
         self._lock = lock
 
+    # Async versions for event loops. They run the calls above in async_executor()
+
+    async def aget(self, key: str, default=None) -> str:
+        return await _run(self.get, key, default)
+
+    async def aset(self, key: str, value: str) -> None:
+        await _run(self.set, key, value)
+
+    async def aget_many(self, keys: [str]) -> dict:
+        return await _run(self.get_many, list(keys))
+
+    async def aset_many(self, items: [(str, str)]) -> None:
+        await _run(self.set_many, list(items))
+
+    async def adelete(self, key: str) -> None:
+        await _run(self.delete, key)
+
 
 def synchronized_method(func):
     """Checks for self._lock and wraps the method with the mutex."""
@@ -72,6 +201,18 @@ def synchronized_method(func):
     return _synchronized
 
 
+class _CacheInit:
+    """Registers the class in cachenames as soon as it is defined (see cacheclass)"""
+
+    def __init__(self, init):
+        self.init = init
+
+    def __set_name__(self, owner, name):
+        assert issubclass(owner, ICache)
+        cachenames[owner.__name__] = owner
+        setattr(owner, name, self.init)
+
+
 def cacheclass(init):
     """Decorator for adding more cache classes. This should wrap the init method"""
     def _wraped_init(self, *args, **kwargs):
@@ -80,88 +221,1042 @@ def cacheclass(init):
         cachenames[cls.__name__] = cls
         init(self, *args, **kwargs)
 
-    return _wraped_init
+    return _CacheInit(_wraped_init)
+
 
 class SqliteCache(ICache):
-    """sqlite file cache"""
+    """sqlite file cache
+
+    - ttls: {key_prefix: seconds} keys expire after the ttl of their longest matching prefix
+    - max_size: maximum size in bytes of the database, least recently (eviction="lru") or least
+      frequently (eviction="lfu") used keys are evicted when it grows over it
+    - maintenance_interval: seconds between background runs that store access metadata, remove
+      expired keys, evict and incrementally vacuum the file (None to disable them)
+    - maintain: whether this process may run the maintenance. If not its thread only stores the
+      access metadata of the process (e.g. in workers, leaving the rest to the api processes)
+
+    The maintenance thread of a process starts with its first read or write, not when the cache
+    is created (e.g. in a gunicorn master before forking). Every process stores its own access
+    metadata, the rest runs in a single process, the one holding the maintenance lease.
+    """
+
+    # Added after the first version of the table, missing columns are created on open
+    COLUMNS = {
+        "expires_at": "REAL",
+        "accessed_at": "REAL",
+        "created_at": "REAL",
+        "hits": "INTEGER NOT NULL DEFAULT 0",
+        "size": "INTEGER NOT NULL DEFAULT 0",
+    }
+    LIVE = "(expires_at IS NULL OR expires_at > ?)"
+    USED = "COALESCE(accessed_at, created_at)"
+    # Keys per IN (...) query, old sqlite versions allow at most 999 parameters
+    BATCH = 500
+    # Rows read per query by the iterators
+    PAGE = 1000
 
     @cacheclass
-    def __init__(self, db_path: str):
+    def __init__(
+        self,
+        db_path: str,
+        ttls: dict = None,
+        max_size: int = None,
+        eviction: str = "lru",
+        maintenance_interval: float = 60.0,
+        maintain: bool = True,
+    ):
+        assert eviction in ("lru", "lfu")
         self.db_path = db_path
-        self.conn = sqlite3.connect(db_path)
-        self.conn.execute(
-            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)")
+        self.ttls = ttls or {}
+        self.max_size = max_size
+        self.eviction = eviction
+        self.maintenance_interval = maintenance_interval
+        self.maintain = maintain
+        self.evictions = 0
+        # Evicted keys by prefix (see key_prefix)
+        self.evicted = Counter()
         self._lock = Lock()
+        self._accessed = {}
+        self._accessed_lock = threading.Lock()
+        self._maintenance_pid = None
+        self._maintenance_token = None
+        self._auto_vacuum_checked = False
+        # Shared between threads (e.g. expansion callbacks), access is serialized by self._lock
+        self.conn = self._connect()
+        self._opening = True
+        self._create_table()
+        self._opening = False
 
-    @synchronized_method
-    def get(self, key: str) -> str:
-        cursor = self.conn.execute(
-            "SELECT value FROM cache WHERE key=?", (key,))
-        row = cursor.fetchone()
-        if row is None:
+    def _create_table(self) -> None:
+        with self._writer() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(cache)")}
+            for column, definition in self.COLUMNS.items():
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE cache ADD COLUMN {column} {definition}")
+            if "size" not in columns:
+                conn.execute("UPDATE cache SET size = length(key) + length(value)")
+            if "created_at" not in columns:
+                conn.execute("UPDATE cache SET created_at = COALESCE(accessed_at, ?)", (time.time(),))
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires_at)")
+            # Orders of evict, rows never read since the access metadata was added fall back to
+            # when they were written
+            conn.execute("DROP INDEX IF EXISTS cache_accessed")
+            conn.execute("DROP INDEX IF EXISTS cache_hits")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS cache_used ON cache ({self.USED})")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS cache_used_hits ON cache (hits, {self.USED})")
+            # Single row, the process running the maintenance (see _own_maintenance)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS maintenance"
+                " (id INTEGER PRIMARY KEY CHECK (id = 0), owner TEXT, expires_at REAL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        # Only applies to new files, old ones are switched by enable_auto_vacuum
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        return conn
+
+    @contextmanager
+    def _reader(self) -> sqlite3.Connection:
+        """Connection to run queries with"""
+        self._start_maintenance()
+        with self._lock:
+            yield self.conn
+
+    @contextmanager
+    def _writer(self) -> sqlite3.Connection:
+        """Connection to run a write transaction with. Commits on exit"""
+        self._start_maintenance()
+        with self._lock:
+            try:
+                yield self.conn
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+
+    def _script(self, sql: str) -> None:
+        """Runs statements that can't be inside a transaction (e.g. VACUUM) until they finish"""
+        with self._lock:
+            self.conn.executescript(sql)
+
+    def vacuum(self) -> None:
+        """Full VACUUM, rewrites the whole file"""
+        self._script("VACUUM")
+
+    def auto_vacuum(self) -> int:
+        """auto_vacuum mode of the file, 0 for files created before incremental vacuuming"""
+        with self._reader() as conn:
+            return conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+
+    def enable_auto_vacuum(self) -> bool:
+        """Switches a file created without incremental auto vacuum to it. Needs a full VACUUM
+        once, which holds the write lock of the file until it is done (minutes on big files),
+        so run it with the api stopped (python -m topiclib vacuum). Returns True if the file was
+        switched"""
+        if self.auto_vacuum() != 0:
+            return False
+        print(f"Enabling incremental auto vacuum of {self.db_path}")
+        self._script("PRAGMA auto_vacuum=INCREMENTAL; VACUUM;")
+        return True
+
+    def ttl(self, key: str) -> float:
+        """ttl in seconds of the longest prefix of key in self.ttls or None"""
+        prefixes = [p for p in self.ttls if key.startswith(p)]
+        if not prefixes:
             return None
-        cursor.close()
+        return self.ttls[max(prefixes, key=len)]
+
+    def _row(self, key: str, value: str, now: float, ttl: float = None) -> tuple:
+        ttl = self.ttl(key) if ttl is None else ttl
+        expires_at = None if ttl is None else now + ttl
+        return (key, value, expires_at, now, now, len(key) + len(value))
+
+    def _touch(self, key: str) -> None:
+        """Access metadata is kept in memory and written by the maintenance thread"""
+        with self._accessed_lock:
+            _, hits = self._accessed.get(key, (0, 0))
+            self._accessed[key] = (time.time(), hits + 1)
+
+    def get(self, key: str, default=None) -> str:
+        with self._reader() as conn:
+            row = conn.execute(
+                f"SELECT value FROM cache WHERE key=? AND {self.LIVE}", (key, time.time())).fetchone()
+        if row is None:
+            return default
+        self._touch(key)
         return row[0]
 
-    @synchronized_method
+    def set(self, key: str, value: str, ttl: float = None) -> None:
+        """ttl overrides the ttl of the key prefix"""
+        with self._writer() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at, created_at, size) VALUES (?, ?, ?, ?, ?, ?)",
+                self._row(key, value, time.time(), ttl))
+
+    def set_many(self, items: [(str, str)]) -> None:
+        now = time.time()
+        with self._writer() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at, created_at, size) VALUES (?, ?, ?, ?, ?, ?)",
+                [self._row(key, value, now) for key, value in items])
+
+    def _select_many(self, columns: str, keys: [str]) -> [tuple]:
+        """Rows of the live keys, BATCH keys per query"""
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        rows = []
+        with self._reader() as conn:
+            for i in range(0, len(keys), self.BATCH):
+                batch = keys[i:i + self.BATCH]
+                marks = ",".join("?" * len(batch))
+                rows += conn.execute(
+                    f"SELECT {columns} FROM cache WHERE key IN ({marks}) AND {self.LIVE}",
+                    (*batch, now)).fetchall()
+        return rows
+
+    def get_many(self, keys: [str]) -> dict:
+        values = dict(self._select_many("key, value", keys))
+        for key in values:
+            self._touch(key)
+        return values
+
+    def contains_many(self, keys: [str]) -> set:
+        return {row[0] for row in self._select_many("key", keys)}
+
+    def add(self, key: str, value: str, ttl: float = None) -> bool:
+        """Atomic, expired keys count as missing. ttl overrides the ttl of the key prefix"""
+        return key in self.add_many([(key, value)], ttl)
+
+    def add_many(self, items: [(str, str)], ttl: float = None) -> set:
+        """add() of several keys in one transaction"""
+        now = time.time()
+        added = set()
+        with self._writer() as conn:
+            for key, value in items:
+                conn.execute(f"DELETE FROM cache WHERE key=? AND NOT {self.LIVE}", (key, now))
+                if conn.execute(
+                    "INSERT OR IGNORE INTO cache (key, value, expires_at, accessed_at, created_at, size) VALUES (?, ?, ?, ?, ?, ?)",
+                        self._row(key, value, now, ttl)).rowcount == 1:
+                    added.add(key)
+        return added
+
+    def delete(self, key: str) -> None:
+        with self._writer() as conn:
+            conn.execute("DELETE FROM cache WHERE key=?", (key,))
+
+    def delete_many(self, keys: [str]) -> None:
+        with self._writer() as conn:
+            conn.executemany("DELETE FROM cache WHERE key=?", [(key,) for key in keys])
+
+    def write_many(self, items: [(str, str)], deleted: [str]) -> None:
+        """Both in one transaction"""
+        now = time.time()
+        with self._writer() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at, created_at, size) VALUES (?, ?, ?, ?, ?, ?)",
+                [self._row(key, value, now) for key, value in items])
+            conn.executemany("DELETE FROM cache WHERE key=?", [(key,) for key in deleted])
+
+    def clear(self) -> None:
+        with self._writer() as conn:
+            conn.execute("DELETE FROM cache")
+        with self._accessed_lock:
+            self._accessed = {}
+        # Pages are released by the maintenance thread (incremental vacuum)
+
+    def _pages(self, columns: str, prefix: str, page: int = None) -> iter:
+        """Yields the live rows (key first) with keys starting with prefix in key order.
+        Reads page rows per query, continuing after the last key read (keyset pagination), so
+        the lock is only held while each page is read and writes in between are not blocked"""
+        page = page or self.PAGE
+        last, op = prefix, ">="
+        while True:
+            with self._reader() as conn:
+                rows = conn.execute(
+                    f"SELECT {columns} FROM cache WHERE key {op} ? AND {self.LIVE} ORDER BY key LIMIT ?",
+                    (last, time.time(), page)).fetchall()
+            for row in rows:
+                if not row[0].startswith(prefix):
+                    return
+                yield row
+            if len(rows) < page:
+                return
+            last, op = rows[-1][0], ">"
+
+    def iter_keys(self, prefix: str = "", page: int = None) -> iter:
+        return (row[0] for row in self._pages("key", prefix, page))
+
+    def iter_items(self, prefix: str = "", page: int = None) -> iter:
+        return self._pages("key, value", prefix, page)
+
+    def keys(self) -> [str]:
+        return list(self.iter_keys())
+
+    def values(self) -> [str]:
+        return [value for _, value in self.iter_items()]
+
+    def items(self) -> [(str, str)]:
+        return list(self.iter_items())
+
+    def __contains__(self, key: str) -> bool:
+        with self._reader() as conn:
+            row = conn.execute(
+                f"SELECT key FROM cache WHERE key=? AND {self.LIVE}", (key, time.time())).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        with self._reader() as conn:
+            return conn.execute(
+                f"SELECT COUNT(*) FROM cache WHERE {self.LIVE}", (time.time(),)).fetchone()[0]
+
+    def __iter__(self) -> iter:
+        return self.iter_keys()
+
+    def __getitem__(self, key: str) -> str:
+        return self.get(key)
+
+    def __setitem__(self, key: str, value: str) -> None:
+        self.set(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        self.delete(key)
+
+    # Maintenance
+
+    def _start_maintenance(self) -> None:
+        """Starts the maintenance thread of this process if not running"""
+        if (
+            self.maintenance_interval is None
+            or self._opening
+            or self._maintenance_pid == os.getpid()
+        ):
+            return
+        self._maintenance_pid = os.getpid()
+        self._maintenance_token = uuid.uuid4().hex
+        threading.Thread(target=self._maintenance_loop, daemon=True, name="cache-maintenance").start()
+
+    def _own_maintenance(self) -> bool:
+        """Takes or renews the maintenance lease of the file for this process. It lapses after
+        3 intervals without a renewal, so another process takes over from a dead owner"""
+        now = time.time()
+        token = self._maintenance_token
+        with self._writer() as conn:
+            cursor = conn.execute(
+                "INSERT INTO maintenance VALUES (0, ?, ?) ON CONFLICT (id) DO UPDATE"
+                " SET owner = excluded.owner, expires_at = excluded.expires_at"
+                " WHERE owner = ? OR expires_at <= ?",
+                (token, now + 3 * self.maintenance_interval, token, now))
+            return cursor.rowcount > 0
+
+    def _maintenance_loop(self) -> None:
+        while True:
+            time.sleep(self.maintenance_interval)
+            try:
+                if self.maintain and self._own_maintenance():
+                    self.maintenance()
+                else:
+                    self.store_access()
+            except Exception as e:
+                print(f"Cache maintenance failed: {e}")
+
+    def maintenance(self) -> None:
+        """Stores access metadata, removes expired keys, evicts if over max_size and releases free
+        pages. Each step is a short transaction so other writers are not blocked for long.
+        Files without auto vacuum keep their free pages, the first run of a process says so"""
+        if not self._auto_vacuum_checked:
+            self._auto_vacuum_checked = True
+            if self.auto_vacuum() == 0:
+                print(f"{self.db_path} has no incremental auto vacuum, freed pages stay in the "
+                      "file. Convert it once with the api stopped: python -m topiclib vacuum")
+        self.store_access()
+        with self._writer() as conn:
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        self.evict()
+        self.incremental_vacuum()
+
+    def store_access(self) -> None:
+        with self._accessed_lock:
+            accessed, self._accessed = self._accessed, {}
+        if not accessed:
+            return
+        with self._writer() as conn:
+            conn.executemany(
+                "UPDATE cache SET accessed_at=?, hits=hits+? WHERE key=?",
+                [(at, hits, key) for key, (at, hits) in accessed.items()])
+
+    def disk_size(self) -> int:
+        """Bytes of the database in use (without free pages)"""
+        with self._reader() as conn:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            pages = conn.execute("PRAGMA page_count").fetchone()[0]
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free) * page_size
+
+    def evict(self, batch: int = 100) -> int:
+        """Evicts keys, batch by batch, until the database is 10% below max_size.
+        Returns the number of keys evicted"""
+        if self.max_size is None:
+            return 0
+
+        order = self.USED if self.eviction == "lru" else f"hits, {self.USED}"
+        evicted = 0
+        while self.disk_size() > 0.9 * self.max_size:
+            with self._writer() as conn:
+                keys = conn.execute(
+                    f"SELECT key FROM cache ORDER BY {order} LIMIT ?", (batch,)).fetchall()
+                conn.executemany("DELETE FROM cache WHERE key=?", keys)
+            if not keys:
+                break
+            evicted += len(keys)
+            self.evicted.update(key_prefix(key) for key, in keys)
+        self.evictions += evicted
+        return evicted
+
+    def incremental_vacuum(self, pages: int = 1000) -> None:
+        """Releases up to pages free pages back to the file system"""
+        self._script(f"PRAGMA incremental_vacuum({int(pages)});")
+
+
+class WalSqliteCache(SqliteCache):
+    """sqlite file cache tuned for concurrent access from several threads and processes.
+    Uses WAL journal mode with synchronous=NORMAL and one connection per thread. Reads don't take
+    any lock, writes are serialized by a thread lock in each process and by sqlite between
+    processes, waiting up to busy_timeout seconds for the database write lock.
+    """
+
+    @cacheclass
+    def __init__(self, db_path: str, busy_timeout: float = 30.0, **kwargs):
+        """kwargs are the same as for SqliteCache"""
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        super().__init__(db_path, **kwargs)
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit mode, write transactions are opened explicitly by _writer
+        conn = sqlite3.connect(
+            self.db_path, timeout=self.busy_timeout, isolation_level=None)
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout * 1000)}")
+        # Must be set before the database switches to WAL (new files only)
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Connection of the current thread (a new one after a fork)"""
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            local.conn = self._connect()
+            local.pid = os.getpid()
+        return local.conn
+
+    @conn.setter
+    def conn(self, value) -> None:
+        # Connections are created per thread on demand
+        pass
+
+    @contextmanager
+    def _reader(self) -> sqlite3.Connection:
+        self._start_maintenance()
+        yield self.conn
+
+    @contextmanager
+    def _writer(self) -> sqlite3.Connection:
+        self._start_maintenance()
+        with self._write_lock:
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _script(self, sql: str) -> None:
+        with self._write_lock:
+            self.conn.executescript(sql)
+
+
+class WriteBehindCache(ICache):
+    """Buffers the writes and deletes to a backend cache and flushes them with write_many (one
+    transaction) when max_pending keys are queued or every flush_interval seconds, in the order
+    they were made. Reads in this process see the buffered values. close() flushes what is left and is also called at exit.
+    The flushing thread and the exit hook are started by the first write of each process, so
+    nothing runs in a master that only forks the workers (gunicorn --preload).
+    """
+
+    def __init__(self, backend: ICache, max_pending: int = 256, flush_interval: float = 1.0):
+        self.backend = backend
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._pid = None
+
+    def _start_flusher(self) -> None:
+        """Starts the flushing thread and registers the exit flush, once per process"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._flusher, daemon=True, name="cache-flush").start()
+        atexit.register(self.close)
+
+    def _flusher(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Could not flush cache writes: {e}")
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+            items = [(key, value) for key, value in self._flushing.items() if value is not MISSING]
+            deleted = [key for key, value in self._flushing.items() if value is MISSING]
+            try:
+                self.backend.write_many(items, deleted)
+            except BaseException:
+                # Put them back unless they were overwritten meanwhile
+                with self._lock:
+                    self._pending = {**self._flushing, **self._pending}
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
+        self.backend.close()
+
+    def _buffered(self, key: str):
+        """Returns (True, value) if key is waiting to be written, value is MISSING if it is
+        waiting to be deleted"""
+        with self._lock:
+            if key in self._pending:
+                return True, self._pending[key]
+            if key in self._flushing:
+                return True, self._flushing[key]
+        return False, None
+
+    def get(self, key: str, default=None) -> str:
+        found, value = self._buffered(key)
+        if found:
+            return default if value is MISSING else value
+        return self.backend.get(key, default)
+
+    def _buffer(self, key: str, value) -> None:
+        self._start_flusher()
+        with self._lock:
+            self._pending[key] = value
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wakeup.set()
+
     def set(self, key: str, value: str) -> None:
-        self.conn.execute(
-            "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", (key, value))
-        self.conn.commit()
+        if self._closed:
+            self.backend.set(key, value)
+            return
+        self._buffer(key, value)
+
+    def set_many(self, items: [(str, str)]) -> None:
+        for key, value in items:
+            self.set(key, value)
+
+    def get_many(self, keys: [str]) -> dict:
+        keys = list(keys)
+        with self._lock:
+            buffered = {**self._flushing, **self._pending}
+        values = {key: buffered[key] for key in keys if key in buffered}
+        values.update(self.backend.get_many([key for key in keys if key not in values]))
+        return {key: value for key, value in values.items() if value is not MISSING}
+
+    def contains_many(self, keys: [str]) -> set:
+        keys = list(keys)
+        with self._lock:
+            buffered = {key: self._buffered_value(key) for key in keys
+                        if key in self._pending or key in self._flushing}
+        found = {key for key, value in buffered.items() if value is not MISSING}
+        return found | self.backend.contains_many([key for key in keys if key not in buffered])
+
+    def _buffered_value(self, key: str):
+        # Needs self._lock
+        return self._pending[key] if key in self._pending else self._flushing[key]
 
-    @synchronized_method
     def delete(self, key: str) -> None:
-        self.conn.execute("DELETE FROM cache WHERE key=?", (key,))
-        self.conn.commit()
+        if self._closed:
+            self.backend.delete(key)
+            return
+        self._buffer(key, MISSING)
+
+    def delete_many(self, keys: [str]) -> None:
+        for key in keys:
+            self.delete(key)
+
+    def add(self, key: str, value: str, ttl: float = None) -> bool:
+        # Goes straight to the backend so it stays atomic
+        self.flush()
+        return self.backend.add(key, value, ttl)
 
-    @synchronized_method
     def clear(self) -> None:
-        self.conn.execute("DELETE FROM cache")
-        self.conn.commit()
-        self.conn.execute("VACUUM")
-        self.conn.commit()
+        # Waits for a running flush, so it can't write cleared keys back afterwards
+        with self._flush_lock:
+            with self._lock:
+                self._pending = {}
+            self.backend.clear()
 
-    @synchronized_method
     def keys(self) -> [str]:
-        cursor = self.conn.execute("SELECT key FROM cache")
-        rows = [row[0] for row in cursor]
-        cursor.close()
-        return rows
+        self.flush()
+        return self.backend.keys()
 
-    @synchronized_method
     def values(self) -> [str]:
-        cursor = self.conn.execute("SELECT value FROM cache")
-        rows = [row[0] for row in cursor]
-        cursor.close()
-        return rows
+        self.flush()
+        return self.backend.values()
 
-    @synchronized_method
     def items(self) -> [(str, str)]:
-        cursor = self.conn.execute("SELECT key, value FROM cache")
-        rows = [(row[0], row[1]) for row in cursor]
-        cursor.close()
-        return rows
+        self.flush()
+        return self.backend.items()
+
+    def iter_keys(self, prefix: str = "") -> iter:
+        self.flush()
+        return self.backend.iter_keys(prefix)
+
+    def iter_items(self, prefix: str = "") -> iter:
+        self.flush()
+        return self.backend.iter_items(prefix)
 
-    @synchronized_method
     def __contains__(self, key: str) -> bool:
-        cursor = self.conn.execute("SELECT key FROM cache WHERE key=?", (key,))
-        contains = cursor.fetchone() is not None
-        cursor.close()
-        return contains
+        found, value = self._buffered(key)
+        if found:
+            return value is not MISSING
+        return key in self.backend
 
-    @synchronized_method
     def __len__(self) -> int:
-        cursor = self.conn.execute("SELECT COUNT(*) FROM cache")
-        node = cursor.fetchone()[0]
-        cursor.close()
-        return node
+        self.flush()
+        return len(self.backend)
 
-    @synchronized_method
     def __iter__(self) -> iter:
-        cursor = self.conn.execute("SELECT key FROM cache")
-        rows = (row[0] for row in cursor)
-        cursor.close()
-        return rows
+        return self.iter_keys()
+
+    def __getitem__(self, key: str) -> str:
+        return self.get(key)
+
+    def __setitem__(self, key: str, value: str) -> None:
+        self.set(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        self.delete(key)
+
+
+class TieredCache(ICache):
+    """In memory LRU of up to max_bytes (key and value sizes) in front of a backend cache.
+    Misses are remembered for negative_ttl seconds (up to max_negative keys) so repeated probes of
+    missing keys don't reach the backend either. Writes go through to the backend.
+    Values are kept in memory for max_age seconds at most (None for no limit), so writes and
+    deletes of other processes are seen after that.
+    """
+
+    def __init__(
+        self,
+        backend: ICache,
+        max_bytes: int = 64 * 1024**2,
+        negative_ttl: float = 5.0,
+        max_negative: int = 10000,
+        max_age: float = 60.0,
+    ):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.negative_ttl = negative_ttl
+        self.max_negative = max_negative
+        self.max_age = max_age
+        self.size = 0
+        self._lru = OrderedDict()
+        self._negative = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key: str, value) -> None:
+        """Stores a value in memory, evicting the least recently used ones. Needs self._lock"""
+        self._forget(key)
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            return
+        expires_at = float("inf") if self.max_age is None else time.monotonic() + self.max_age
+        self._lru[key] = value, expires_at
+        self.size += size
+        while self.size > self.max_bytes:
+            old_key, (old_value, _) = self._lru.popitem(last=False)
+            self.size -= len(old_key) + len(old_value)
+
+    def _forget(self, key: str) -> None:
+        """Needs self._lock"""
+        self._negative.pop(key, None)
+        entry = self._lru.pop(key, None)
+        if entry is not None:
+            self.size -= len(key) + len(entry[0])
+
+    def _peek(self, key: str, now: float):
+        """Value in memory or MISSING, dropping it if older than max_age. Needs self._lock"""
+        entry = self._lru.get(key)
+        if entry is None:
+            return MISSING
+        value, expires_at = entry
+        if expires_at <= now:
+            self._forget(key)
+            return MISSING
+        return value
+
+    def get(self, key: str, default=None) -> str:
+        with self._lock:
+            value = self._peek(key, time.monotonic())
+            if value is not MISSING:
+                self._lru.move_to_end(key)
+                return value
+            expires_at = self._negative.get(key)
+            if expires_at is not None:
+                if expires_at > time.monotonic():
+                    return default
+                del self._negative[key]
+
+        value = self.backend.get(key, MISSING)
+        with self._lock:
+            if value is MISSING:
+                self._negative[key] = time.monotonic() + self.negative_ttl
+                if len(self._negative) > self.max_negative:
+                    self._negative.popitem(last=False)
+                return default
+            self._remember(key, value)
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        self.backend.set(key, value)
+        with self._lock:
+            self._remember(key, value)
+
+    def set_many(self, items: [(str, str)]) -> None:
+        items = list(items)
+        self.backend.set_many(items)
+        with self._lock:
+            for key, value in items:
+                self._remember(key, value)
+
+    def get_many(self, keys: [str]) -> dict:
+        values = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                value = self._peek(key, now)
+                if value is not MISSING:
+                    self._lru.move_to_end(key)
+                    values[key] = value
+                elif self._negative.get(key, 0) <= now:
+                    missing.append(key)
+
+        found = self.backend.get_many(missing) if missing else {}
+        with self._lock:
+            for key in missing:
+                if key in found:
+                    self._remember(key, found[key])
+                else:
+                    self._negative[key] = now + self.negative_ttl
+            while len(self._negative) > self.max_negative:
+                self._negative.popitem(last=False)
+        values.update(found)
+        return values
+
+    def contains_many(self, keys: [str]) -> set:
+        # Looks without promoting or loading the keys
+        found = set()
+        probe = []
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                if self._peek(key, now) is not MISSING:
+                    found.add(key)
+                elif self._negative.get(key, 0) <= now:
+                    probe.append(key)
+        return found | (self.backend.contains_many(probe) if probe else set())
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._forget(key)
+        self.backend.delete(key)
+
+    def delete_many(self, keys: [str]) -> None:
+        keys = list(keys)
+        with self._lock:
+            for key in keys:
+                self._forget(key)
+        self.backend.delete_many(keys)
+
+    def add(self, key: str, value: str, ttl: float = None) -> bool:
+        with self._lock:
+            self._forget(key)
+        return self.backend.add(key, value, ttl)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._lru = OrderedDict()
+            self._negative = OrderedDict()
+            self.size = 0
+        self.backend.clear()
+
+    def flush(self) -> None:
+        self.backend.flush()
+
+    def close(self) -> None:
+        self.backend.close()
+
+    def keys(self) -> [str]:
+        return self.backend.keys()
+
+    def values(self) -> [str]:
+        return self.backend.values()
+
+    def items(self) -> [(str, str)]:
+        return self.backend.items()
+
+    def iter_keys(self, prefix: str = "") -> iter:
+        return self.backend.iter_keys(prefix)
+
+    def iter_items(self, prefix: str = "") -> iter:
+        return self.backend.iter_items(prefix)
+
+    def __contains__(self, key: str) -> bool:
+        return bool(self.contains_many([key]))
+
+    def __len__(self) -> int:
+        return len(self.backend)
+
+    def __iter__(self) -> iter:
+        return iter(self.backend)
+
+    def __getitem__(self, key: str) -> str:
+        return self.get(key)
+
+    def __setitem__(self, key: str, value: str) -> None:
+        self.set(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        self.delete(key)
+
+
+def innermost(cache: ICache) -> ICache:
+    """The backend at the bottom of wrappers like TieredCache, shared by every process"""
+    while hasattr(cache, "backend"):
+        cache = cache.backend
+    return cache
+
+
+def key_prefix(key: str) -> str:
+    """Kind of key used to group stats, e.g. provider_ for provider_('wikipedia', 'Page')"""
+    head, sep, _ = key.partition("_")
+    return head + sep if sep else ""
+
+
+# Upper bounds in milliseconds of the latency histogram buckets (the last one takes the rest)
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, float("inf"))
+
+
+class CacheStats:
+    """Counters and latency histograms of cache calls by key prefix"""
+
+    COUNTERS = ("hits", "misses", "sets", "deletes", "bytes_read", "bytes_written")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._prefixes = {}
+
+    def _stats(self, prefix: str) -> dict:
+        """Needs self._lock"""
+        stats = self._prefixes.get(prefix)
+        if stats is None:
+            stats = {name: 0 for name in self.COUNTERS}
+            stats["get_latency"] = [0] * len(LATENCY_BUCKETS)
+            stats["set_latency"] = [0] * len(LATENCY_BUCKETS)
+            self._prefixes[prefix] = stats
+        return stats
+
+    @staticmethod
+    def _bucket(seconds: float) -> int:
+        ms = seconds * 1000
+        return next(i for i, bound in enumerate(LATENCY_BUCKETS) if ms <= bound)
+
+    def record_get(self, key: str, value, seconds: float) -> None:
+        """value is MISSING for a miss"""
+        with self._lock:
+            stats = self._stats(key_prefix(key))
+            if value is MISSING:
+                stats["misses"] += 1
+            else:
+                stats["hits"] += 1
+                stats["bytes_read"] += len(value)
+            stats["get_latency"][self._bucket(seconds)] += 1
+
+    def record_set(self, key: str, value, seconds: float) -> None:
+        with self._lock:
+            stats = self._stats(key_prefix(key))
+            stats["sets"] += 1
+            stats["bytes_written"] += len(value)
+            stats["set_latency"][self._bucket(seconds)] += 1
+
+    def record_delete(self, key: str) -> None:
+        with self._lock:
+            self._stats(key_prefix(key))["deletes"] += 1
+
+    def raw(self) -> dict:
+        """{prefix: counters and histogram lists}, as merge takes them"""
+        with self._lock:
+            return {prefix: {name: list(value) if isinstance(value, list) else value
+                             for name, value in stats.items()}
+                    for prefix, stats in self._prefixes.items()}
+
+    def merge(self, raw: dict) -> None:
+        """Adds the raw() stats of another process to these"""
+        with self._lock:
+            for prefix, other in raw.items():
+                stats = self._stats(prefix)
+                for name, value in other.items():
+                    if isinstance(value, list):
+                        stats[name] = [a + b for a, b in zip(stats[name], value)]
+                    else:
+                        stats[name] += value
+
+    def snapshot(self, evicted: dict = None) -> dict:
+        """{prefix: stats} with hit ratio and histograms as {bucket upper bound in ms: count}.
+        evicted is {prefix: keys evicted} from the backend"""
+        evicted = evicted or {}
+        bounds = [str(bound) for bound in LATENCY_BUCKETS]
+        result = {}
+        with self._lock:
+            for prefix in set(self._prefixes) | set(evicted):
+                stats = dict(self._stats(prefix))
+                lookups = stats["hits"] + stats["misses"]
+                stats["hit_ratio"] = stats["hits"] / lookups if lookups else None
+                stats["evictions"] = evicted.get(prefix, 0)
+                for name in ("get_latency", "set_latency"):
+                    stats[name] = dict(zip(bounds, stats[name]))
+                result[prefix] = stats
+        return result
+
+
+class StatsCache(ICache):
+    """Records the hits, misses, bytes and latencies of the calls to a backend cache by key
+    prefix. Evictions are read from the innermost backend (see SqliteCache.evicted).
+    Stats are kept per process, topiclib.stats merges those of every process.
+    """
+
+    def __init__(self, backend: ICache):
+        self.backend = backend
+        self.stats = CacheStats()
+
+    def snapshot(self) -> dict:
+        return self.stats.snapshot(getattr(innermost(self), "evicted", None))
+
+    def reset(self) -> None:
+        self.stats.reset()
+
+    def get(self, key: str, default=None) -> str:
+        start = time.perf_counter()
+        value = self.backend.get(key, MISSING)
+        self.stats.record_get(key, value, time.perf_counter() - start)
+        return default if value is MISSING else value
+
+    def get_many(self, keys: [str]) -> dict:
+        keys = list(keys)
+        start = time.perf_counter()
+        values = self.backend.get_many(keys)
+        seconds = (time.perf_counter() - start) / max(len(keys), 1)
+        for key in keys:
+            self.stats.record_get(key, values.get(key, MISSING), seconds)
+        return values
+
+    def set(self, key: str, value: str) -> None:
+        start = time.perf_counter()
+        self.backend.set(key, value)
+        self.stats.record_set(key, value, time.perf_counter() - start)
+
+    def set_many(self, items: [(str, str)]) -> None:
+        items = list(items)
+        start = time.perf_counter()
+        self.backend.set_many(items)
+        seconds = (time.perf_counter() - start) / max(len(items), 1)
+        for key, value in items:
+            self.stats.record_set(key, value, seconds)
+
+    def delete(self, key: str) -> None:
+        self.backend.delete(key)
+        self.stats.record_delete(key)
+
+    def delete_many(self, keys: [str]) -> None:
+        keys = list(keys)
+        self.backend.delete_many(keys)
+        for key in keys:
+            self.stats.record_delete(key)
+
+    def contains_many(self, keys: [str]) -> set:
+        return self.backend.contains_many(keys)
+
+    def add(self, key: str, value: str, ttl: float = None) -> bool:
+        return self.backend.add(key, value, ttl)
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def flush(self) -> None:
+        self.backend.flush()
+
+    def close(self) -> None:
+        self.backend.close()
+
+    def keys(self) -> [str]:
+        return self.backend.keys()
+
+    def values(self) -> [str]:
+        return self.backend.values()
+
+    def items(self) -> [(str, str)]:
+        return self.backend.items()
+
+    def iter_keys(self, prefix: str = "") -> iter:
+        return self.backend.iter_keys(prefix)
+
+    def iter_items(self, prefix: str = "") -> iter:
+        return self.backend.iter_items(prefix)
+
+    def __contains__(self, key: str) -> bool:
+        # Not counted as a hit or miss, nothing is read
+        return key in self.backend
+
+    def __len__(self) -> int:
+        return len(self.backend)
+
+    def __iter__(self) -> iter:
+        return iter(self.backend)
 
     def __getitem__(self, key: str) -> str:
         return self.get(key)
@@ -194,6 +1289,10 @@ class Cache(Singleton):
             raise Exception("Cache not set")
         return cls._cache
 
+    @classmethod
+    def is_set(cls) -> bool:
+        return cls._cache is not None
+
     @classmethod
     def set_cache(cls, cache: ICache):
         if not issubclass(type(cache), ICache):
@@ -0,0 +1,259 @@
+# Cache value codec
+#
+# Values are stored as bytes: a header with the codec version and flags, then a tagged payload.
+# Counters of topics (str -> int) are packed as one block of \0 separated keys plus an int array,
+# lists of rows like edges [(start, end, weight)] are packed column by column the same way,
+# tuples are packed element by element and anything else is stored as json. Big payloads are
+# zlib compressed. Values written before the codec (json text) are still decoded. CodecCache is
+# an ICache layer that encodes and decodes the values of a cache for its callers.
+
+import json
+import struct
+import sys
+import zlib
+from array import array
+from numbers import Integral
+
+from .cache import MISSING, ICache
+
+VERSION = 1
+COMPRESSED = 0b1
+
+T_JSON = 0
+T_COUNTER = 1
+T_TUPLE = 2
+T_ROWS = 3
+
+_header = struct.Struct("<BB")
+_length = struct.Struct("<I")
+
+compress_min = 1024
+compress_level = 1
+
+
+def set_compression(min_size: int = 1024, level: int = 1) -> None:
+    """Payloads of at least min_size bytes are compressed with zlib at the given level.
+    min_size = 0 disables compression"""
+    global compress_min, compress_level
+    compress_min = min_size
+    compress_level = level
+
+
+def _int_typecode(values: [int]) -> str:
+    """Smallest signed array typecode that holds all values or None"""
+    low, high = min(values, default=0), max(values, default=0)
+    for typecode in "bhiq":
+        bits = array(typecode).itemsize * 8
+        if -(2 ** (bits - 1)) <= low and high < 2 ** (bits - 1):
+            return typecode
+    return None
+
+
+def _pack_column(values: list) -> bytes:
+    """Column of str (\0 separated) or int (array) values, or None if it is neither"""
+    types = set(map(type, values))
+    if types == {str}:
+        text = "\0".join(values)
+        if text.count("\0") != len(values) - 1:
+            return None
+        data = text.encode()
+        return b"s" + _length.pack(len(data)) + data
+    if not all(issubclass(t, Integral) and t is not bool for t in types):
+        return None
+    typecode = _int_typecode(values)
+    if typecode is None:
+        return None
+    ints = array(typecode, map(int, values))
+    if sys.byteorder == "big":
+        ints.byteswap()
+    data = ints.tobytes()
+    return typecode.encode() + _length.pack(len(data)) + data
+
+
+def _unpack_column(data: memoryview, offset: int, n: int) -> (list, int):
+    """Returns the column at offset and the offset after it"""
+    typecode = chr(data[offset])
+    (size,) = _length.unpack_from(data, offset + 1)
+    start = offset + 1 + _length.size
+    end = start + size
+    if typecode == "s":
+        values = bytes(data[start:end]).decode().split("\0") if n else []
+    else:
+        ints = array(typecode)
+        ints.frombytes(data[start:end])
+        if sys.byteorder == "big":
+            ints.byteswap()
+        values = ints.tolist()
+    return values, end
+
+
+def _pack_columns(tag: int, columns: [list], n: int) -> bytes:
+    packed = [_pack_column(column) for column in columns]
+    if any(p is None for p in packed):
+        return None
+    header = bytes((tag, len(columns))) + _length.pack(n)
+    return b"".join([header] + packed)
+
+
+def _pack_counter(value: dict) -> bytes:
+    """Counter payload or None if value is not a str -> int mapping"""
+    columns = [list(value.keys()), list(value.values())]
+    if set(map(type, columns[0])) - {str}:
+        return None
+    return _pack_columns(T_COUNTER, columns, len(value))
+
+
+def _pack_rows(value: list) -> bytes:
+    """Payload of a list of rows of the same length with str or int columns, or None"""
+    if not value or set(map(type, value)) - {list, tuple}:
+        return None
+    width = len(value[0])
+    if not 0 < width < 256 or set(map(len, value)) != {width}:
+        return None
+    return _pack_columns(T_ROWS, [list(column) for column in zip(*value)], len(value))
+
+
+def _pack(value) -> bytes:
+    if isinstance(value, dict):
+        packed = _pack_counter(value)
+        if packed is not None:
+            return packed
+    if isinstance(value, list):
+        packed = _pack_rows(value)
+        if packed is not None:
+            return packed
+    if isinstance(value, tuple):
+        parts = [_pack(v) for v in value]
+        return b"".join(
+            [bytes((T_TUPLE,)), _length.pack(len(parts))]
+            + [_length.pack(len(p)) + p for p in parts]
+        )
+    return bytes((T_JSON,)) + json.dumps(value, default=int).encode()
+
+
+def _unpack(data: memoryview):
+    tag = data[0]
+    if tag == T_JSON:
+        return json.loads(bytes(data[1:]))
+    if tag in (T_COUNTER, T_ROWS):
+        width = data[1]
+        (n,) = _length.unpack_from(data, 2)
+        offset = 2 + _length.size
+        columns = []
+        for _ in range(width):
+            column, offset = _unpack_column(data, offset, n)
+            columns.append(column)
+        if tag == T_COUNTER:
+            return dict(zip(*columns))
+        return list(map(list, zip(*columns)))
+    if tag == T_TUPLE:
+        (n,) = _length.unpack_from(data, 1)
+        offset = 1 + _length.size
+        values = []
+        for _ in range(n):
+            (size,) = _length.unpack_from(data, offset)
+            offset += _length.size
+            values.append(_unpack(data[offset:offset + size]))
+            offset += size
+        return tuple(values)
+    raise ValueError(f"Unknown cache value tag {tag}")
+
+
+def encode(value) -> bytes:
+    """Encodes a cache value. Dicts come back as dicts (not Counters) and tuples inside lists as
+    lists, like with json"""
+    payload = _pack(value)
+    flags = 0
+    if compress_min and len(payload) >= compress_min:
+        compressed = zlib.compress(payload, compress_level)
+        if len(compressed) < len(payload):
+            payload, flags = compressed, COMPRESSED
+    return _header.pack(VERSION, flags) + payload
+
+
+def decode(data):
+    """Decodes a value written by encode, or by json.dumps before the codec existed"""
+    if isinstance(data, str):
+        return json.loads(data)
+    version, flags = _header.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f"Unknown cache value version {version}")
+    payload = memoryview(data)[_header.size:]
+    if flags & COMPRESSED:
+        payload = memoryview(zlib.decompress(payload))
+    return _unpack(payload)
+
+
+class CodecCache(ICache):
+    """View of a backend cache storing values encoded with this codec. Reads decode (old json
+    values too), writes encode, keys are left as they are"""
+
+    def __init__(self, backend: ICache):
+        self.backend = backend
+
+    def get(self, key: str, default=None):
+        value = self.backend.get(key, MISSING)
+        return default if value is MISSING else decode(value)
+
+    def set(self, key: str, value) -> None:
+        self.backend.set(key, encode(value))
+
+    def get_many(self, keys: [str]) -> dict:
+        return {key: decode(value) for key, value in self.backend.get_many(keys).items()}
+
+    def set_many(self, items) -> None:
+        self.backend.set_many([(key, encode(value)) for key, value in items])
+
+    def contains_many(self, keys: [str]) -> set:
+        return self.backend.contains_many(keys)
+
+    def add(self, key: str, value, ttl: float = None) -> bool:
+        return self.backend.add(key, encode(value), ttl)
+
+    def delete(self, key: str) -> None:
+        self.backend.delete(key)
+
+    def delete_many(self, keys: [str]) -> None:
+        self.backend.delete_many(keys)
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def flush(self) -> None:
+        self.backend.flush()
+
+    def close(self) -> None:
+        self.backend.close()
+
+    def keys(self) -> [str]:
+        return self.backend.keys()
+
+    def values(self) -> list:
+        return [decode(value) for value in self.backend.values()]
+
+    def items(self) -> list:
+        return list(self.iter_items())
+
+    def iter_keys(self, prefix: str = "") -> iter:
+        return self.backend.iter_keys(prefix)
+
+    def iter_items(self, prefix: str = "") -> iter:
+        return ((key, decode(value)) for key, value in self.backend.iter_items(prefix))
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.backend
+
+    def __len__(self) -> int:
+        return len(self.backend)
+
+    def __iter__(self) -> iter:
+        return iter(self.backend)
+
+    def __getitem__(self, key: str):
+        return self.get(key)
+
+    def __setitem__(self, key: str, value) -> None:
+        self.set(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        self.delete(key)
@@ -0,0 +1,114 @@
+# Compute pool
+#
+# The cpu bound stages of the api (topic extraction, corpus expansion, layouts, images) run in a
+# long lived pool of processes so they don't block the event loop. Each endpoint has a limit of
+# jobs running or queued at once, so a burst on one endpoint can't take every worker and the
+# others (and the cheap endpoints) stay responsive. A worker that dies (e.g. killed for its memory)
+# breaks the pool, which is then replaced and the jobs it was running are run once more.
+
+import asyncio
+import concurrent.futures
+import concurrent.futures.process
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+
+logger = logging.getLogger("topiclib")
+
+
+def _warm_up():
+    """Worker initializer so models are loaded before the first job"""
+    from .preload import warm_up
+
+    warm_up()
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+class ComputePool:
+    """Process pool for the cpu bound jobs of the api.
+
+    - max_workers: processes in the pool
+    - limits: {endpoint: jobs} maximum jobs of an endpoint running or waiting at once, other
+      callers of that endpoint wait (without blocking the event loop). default_limit otherwise
+    - initializer: runs once in each worker, defaults to the warm up of topiclib.preload
+
+    Workers are spawned, not forked, so they don't inherit the threads and connections of the
+    api process. The functions given to run must be picklable (defined at module level) and the
+    modules defining them are imported again in the workers. The pool is started on first use in
+    the process that uses it, so it can be created before forking (e.g. gunicorn --preload).
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 2,
+        limits: dict = None,
+        default_limit: int = 2,
+        initializer=_warm_up,
+    ):
+        self.max_workers = max_workers
+        self.limits = limits or {}
+        self.default_limit = default_limit
+        self.initializer = initializer
+        self._slots = {}
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=self.initializer,
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def start(self) -> [concurrent.futures.Future]:
+        """Starts the workers now instead of on the first job. They warm up in background, the
+        returned futures are done when they are ready"""
+        executor = self._get_executor()
+        return [executor.submit(_ping) for _ in range(self.max_workers)]
+
+    def slot(self, endpoint: str) -> asyncio.Semaphore:
+        """Semaphore limiting the jobs of endpoint. Hold it around every run of a request"""
+        if endpoint not in self._slots:
+            self._slots[endpoint] = asyncio.Semaphore(
+                self.limits.get(endpoint, self.default_limit)
+            )
+        return self._slots[endpoint]
+
+    def _discard(self, executor: concurrent.futures.ProcessPoolExecutor) -> None:
+        """Drops a broken executor, the next job starts a new one"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def run(self, func, *args, **kwargs):
+        """Runs func(*args, **kwargs) in a worker and returns its result. If the pool breaks
+        meanwhile the job is run again in a new one, BrokenProcessPool is raised if that breaks
+        too"""
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, **kwargs)
+        for attempt in range(2):
+            executor = self._get_executor()
+            try:
+                return await loop.run_in_executor(executor, call)
+            except concurrent.futures.process.BrokenProcessPool:
+                self._discard(executor)
+                if attempt:
+                    raise
+                logger.warning(f"A compute worker died, running {func.__name__} in a new pool")
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(cancel_futures=True)
+            self._executor = None
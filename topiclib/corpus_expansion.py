@@ -1,5 +1,4 @@
 import concurrent.futures
-import json
 import logging
 import multiprocessing
 import sys
@@ -9,15 +8,16 @@ import traceback
 from abc import ABC, abstractclassmethod
 from collections import Counter
 from dataclasses import dataclass
-from io import BytesIO
 from itertools import islice
 
-import matplotlib.pyplot as plt
 import networkx as nx
 from networkx.readwrite import json_graph
-from requests.exceptions import ConnectionError
 
-from .cache import Cache
+from . import codec, fetch, singleflight
+from .cache import MISSING, Cache, ICache
+from .fetch import FetchPolicy
+from .graphs import aggregate_edges, build_graph, prune_edges
+from .render import graph_layout, plot_graph  # noqa: F401
 from .preprocess import flatten, preprocess2
 from .topic_extraction import TopicExtractor, filter_low
 from .utils import hash_text
@@ -68,27 +68,23 @@ def provider(name):
     return wrapper
 
 
-def process_page(provider, page_name, topic_names) -> (Counter, list):
+def process_page(provider, page_name, topic_names, policy: FetchPolicy = None) -> (Counter, list):
     """This function will run in a thread. page_name must be a valid page for the provider.
     It retuns the counter of topics for the page and the edges from the topic corresponding to page_name
     connecting to other other topics that are in topic_names: edges = [(this_topic, other_topic, n_references)]
+    The fetch is bounded by the timeouts, retries and hedging of policy (defaults to fetch.default_policy).
     """
     topic = flatten(preprocess2(page_name))
     if topic not in topic_names:
         return None, None
 
     # Fetch from provider
-    attempts = 0
-    while True:
-        if attempts > 3:
-            print(f"Could not fetch content for {page_name}")
-            return None, None
-        try:
-            content = provider.content(page_name)
-            break
-        except ConnectionError:
-            time.sleep(1)
-            attempts += 1
+    policy = policy or fetch.default_policy
+    try:
+        content = fetch.fetch_content(provider, page_name, policy)
+    except policy.retry_on:
+        print(f"Could not fetch content for {page_name}")
+        return None, None
 
     model = TopicExtractor(content)
     counter = model.count()
@@ -101,122 +97,194 @@ def process_page(provider, page_name, topic_names) -> (Counter, list):
     return counter, edges
 
 
-def process_categories(provider, page_name) -> Counter:
+def search_page(provider, topic: str) -> str:
+    """Returns the first page found by the provider for topic or None"""
+    return next(iter(provider.search(topic)), None)
+
+
+def remaining(deadline: float) -> float:
+    """Seconds left until deadline (a time.monotonic() value). None means no deadline"""
+    if deadline is None:
+        return None
+    return max(0, deadline - time.monotonic())
+
+
+def process_categories(provider, page_name, policy: FetchPolicy = None) -> Counter:
     """Will process a list of categories similarly to process_page"""
-    categories = provider.categories(page_name)
+    categories = fetch.fetch_categories(provider, page_name, policy)
     categories = [preprocess2(cat) for cat in categories]
     return sum((Counter(cat.split()) for cat in categories), Counter())
 
 
-def expand_corpus(
-    topics: [str], provider: str, full: bool = False, use_cache=True
-) -> nx.DiGraph:
-    """Expands a corpus by adding pages from a provider and returns a graph"""
+def page_key(provider, page_name: str) -> str:
+    return "provider_" + repr((provider.name, page_name))
 
-    topic_hash = hash_text(",".join([t for t, _ in topics]))
-    cache = Cache.instance() if use_cache else {}
 
-    if isinstance(provider, str):
-        assert provider in providers_map
-        provider: IDocumentProvider = providers_map[provider].provider
+def _load_page(provider, page_name, cache_key, topic_names, cache, fetch_policy) -> (Counter, list):
+    """Runs process_page and stores the page in cache, even if it finishes after the
+    deadline, so the next call finds it. Identical pages requested at the same time by other
+    threads or workers are processed once (see singleflight)"""
+    computed = {}
+
+    def compute():
+        counter, edges = process_page(provider, page_name, topic_names, fetch_policy)
+        if counter is None:
+            return None
+        computed["page"] = counter, edges
+        return codec.encode((counter, edges))
+
+    if not isinstance(cache, ICache):
+        compute()
+        return computed.get("page", (None, None))
+    value = singleflight.flight.do(cache_key, compute, cache)
+    if "page" in computed:
+        return computed["page"]
+    return (None, None) if value is None else codec.decode(value)
+
 
+def _finish_search(provider, cache, cache_key, futures, fetch_policy) -> None:
+    """Runs in background after a budget cut a search short. Waits for the remaining searches,
+    stores the complete search and loads the pages that are not in cache yet, so a later call
+    finds everything"""
+    concurrent.futures.wait(futures)
+    page_names = []
+    for future in futures:
+        try:
+            page_name = future.result()
+        except Exception as e:
+            print(f"Search of {provider.name} failed: {e}")
+            return
+        if page_name is not None:
+            page_names.append(page_name)
+    topic_names = [flatten(preprocess2(name)) for name in page_names]
+    cache[cache_key] = codec.encode((page_names, topic_names))
+
+    keys = {name: page_key(provider, name) for name in page_names}
+    cached_pages = cache.get_many(list(keys.values()))
+    singleflight.flight.lease_many([k for k in keys.values() if k not in cached_pages], cache)
+    for name in page_names:
+        if keys[name] in cached_pages:
+            continue
+        try:
+            _load_page(provider, name, keys[name], topic_names, cache, fetch_policy)
+        except Exception as e:
+            print("%r generated an exception: %s" % (name, e))
+    logger.debug(f"Finished the search of {provider.name} in background")
+
+
+@dataclass
+class Expansion:
+    """Result of querying a single provider for a list of topics"""
+
+    provider: str
+    topic_names: [str]
+    # [(topic, edges)] of every page that was resolved, in search order. Several pages can
+    # share a topic
+    page_edges: list
+    skipped: list
+    pending: list
+    pending_topics: list
+
+
+def collect_edges(
+    topics: [str],
+    provider: IDocumentProvider,
+    cache,
+    fetch_policy: FetchPolicy = None,
+    deadline: float = None,
+    resolved: set = None,
+) -> Expansion:
+    """Searches the pages of topics in provider and returns the edges found in each page. Pages
+    whose topic is in resolved (answered by another provider) are not loaded"""
+    topic_hash = hash_text(",".join([t for t, _ in topics]))
     n_cores = multiprocessing.cpu_count()
 
     logger.debug(topics)
-    logger.info("loading pages...")
+    logger.info(f"loading pages from {provider.name}...")
+
+    pending_topics = []
 
     cache_key = "search_" + repr((provider.name, topic_hash))
-    if cache_key not in cache:
+    cached = cache.get(cache_key, MISSING)
+    if cached is MISSING:
         page_names = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=n_cores) as executor:
-            future_to_page = {
-                executor.submit(provider.search, topic): topic for topic, _ in topics
-            }
-            for future in concurrent.futures.as_completed(future_to_page):
-                page_names.append(next(future.result()))
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_cores)
+        future_to_topic = {
+            executor.submit(search_page, provider, topic): topic for topic, _ in topics
+        }
+        executor.shutdown(wait=False)
+        try:
+            for future in concurrent.futures.as_completed(
+                future_to_topic, timeout=remaining(deadline)
+            ):
+                page_name = future.result()
+                if page_name is not None:
+                    page_names.append(page_name)
+        except concurrent.futures.TimeoutError:
+            pending_topics = [t for f, t in future_to_topic.items() if not f.done()]
+            logger.info(f"Search budget exceeded, {pending_topics=}")
 
         topic_names = [flatten(preprocess2(name)) for name in page_names]
-        cache[cache_key] = json.dumps((page_names, topic_names))
+        # Only complete searches are stored, a partial one is completed in background
+        if not pending_topics:
+            cache[cache_key] = codec.encode((page_names, topic_names))
+        elif isinstance(cache, ICache):
+            threading.Thread(
+                target=_finish_search,
+                args=(provider, cache, cache_key, list(future_to_topic), fetch_policy),
+                daemon=True,
+            ).start()
     else:
-        page_names, topic_names = json.loads(cache[cache_key])
+        page_names, topic_names = codec.decode(cached)
     logger.debug(f"{topic_names=}")
 
-    graph = nx.DiGraph()
-    graph.add_nodes_from(topic_names)
-    logger.debug("Initialized graph")
-
-    def add_arrow(start, end, weight=1):
-        """Add edge if weight 'weight' if not exists, else increase the 'weight' by 1"""
-        s = start
-        e = end
-
-        # If contrary edge exists subtract from it
-        if graph.has_edge(end, start):
-            w = graph[end][start]["weight"]
-            graph[end][start]["weight"] -= weight
-
-            # Direction flip
-            if graph[end][start]["weight"] <= 0:
-                weight_total = graph[end][start]["weight_total"]
-                graph.remove_edge(end, start)
-                graph.add_edge(start, end, weight=weight - w, weight_total=weight_total)
-            else:
-                s = end
-                e = start
-
-        # If edge exists add to it
-        elif graph.has_edge(start, end):
-            graph[start][end]["weight"] += weight
-        else:
-            graph.add_edge(start, end, weight=weight, weight_total=0)
-
-        # Add to overall weight property for that edge
-        graph[s][e]["weight_total"] += weight
-
-        return graph[s][e]["weight_total"]
-
-    def filter_topics_from_cache(page_name):
-        # Read from cache
-        cache_key = "provider_" + repr((provider.name, page_name))
-        if cache_key in cache:
-            logger.debug(f"{page_name} found in cache")
-            _, edges = json.loads(cache[cache_key])
-            return edges
-        else:
-            logger.debug(f"{cache_key} not found in cache, computing...")
-            return False
-
-    def add_edges(edges):
-        if edges is None:
-            return
-        for edge in edges:
-            topic, ngram, weight = edge
-            weight_total = add_arrow(topic, ngram, weight)
-            logger.debug(f"Added arrow: '{topic}' -> '{ngram}'   weight: {weight}")
-            logger.debug(f"    weight_total: {weight_total}")
-
-    # remove topics that are cached from page_names and add them to the graph already
+    # remove topics that are cached from page_names and add them to the graph already.
+    # All pages are read in one query (cache is a plain dict when caching is off)
     non_cached_names = []
-    cached_edges = {}
-    for name in page_names:
-        cached = filter_topics_from_cache(name)
-        if cached is False:
+    loaded = {}
+    page_keys = {
+        name: page_key(provider, name)
+        for name, topic in zip(page_names, topic_names)
+        if not resolved or topic not in resolved
+    }
+    if isinstance(cache, ICache):
+        cached_pages = cache.get_many(list(page_keys.values()))
+    else:
+        cached_pages = {}
+    for name in page_keys:
+        cached = cached_pages.get(page_keys[name], MISSING)
+        if cached is MISSING:
+            logger.debug(f"{page_keys[name]} not found in cache, computing...")
             non_cached_names.append(name)
             continue
 
         # is in cache
-        cached_edges[name] = cached
+        logger.debug(f"{name} found in cache")
+        _, loaded[name] = codec.decode(cached)
+
+    def load_page(page_name):
+        return _load_page(
+            provider, page_name, page_keys[page_name], topic_names, cache, fetch_policy
+        )
 
     # Loop over each topic and populated edges between topics
     logger.debug(f"{non_cached_names=}")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=n_cores) as executor:
-        logger.info("Submitting tasks")
-        future_to_page = {
-            executor.submit(process_page, provider, name, topic_names): name
-            for name in non_cached_names
-        }
-        logger.debug("Processing pages")
-        for future in concurrent.futures.as_completed(future_to_page):
+    skipped = []
+    pending = []
+    if isinstance(cache, ICache):
+        # One write for the leases of every page instead of one per page
+        singleflight.flight.lease_many([page_keys[name] for name in non_cached_names], cache)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_cores)
+    logger.info("Submitting tasks")
+    future_to_page = {executor.submit(load_page, name): name for name in non_cached_names}
+    # Don't wait for the pages that miss the deadline, they keep running in background
+    executor.shutdown(wait=False)
+
+    logger.debug("Processing pages")
+    try:
+        for future in concurrent.futures.as_completed(
+            future_to_page, timeout=remaining(deadline)
+        ):
             page_name = future_to_page[future]
             logger.debug(f"Finished for {page_name}")
             try:
@@ -225,89 +293,140 @@ def expand_corpus(
                     logger.debug(
                         f"{page_name} is being skipped because it is not in topic_names or provider request failed"
                     )
+                    skipped.append(page_name)
                     continue
 
-                add_edges(edges)
-
-                # Store in cache
-                cache_key = "provider_" + repr((provider.name, page_name))
-                cache[cache_key] = json.dumps((counter, edges))
-                logger.debug(f"{page_name} stored in cache")
+                loaded[page_name] = edges
 
             except Exception as e:
+                skipped.append(page_name)
                 print("%r generated an exception: %s" % (page_name, e))
                 print(
                     "".join(traceback.format_exception(type(e), e, e.__traceback__)),
                     file=sys.stderr,
                     flush=True,
                 )
-
-    # Add cached edges
-    for name, edges in cached_edges.items():
-        add_edges(edges)
-
-    if not full:
-        # Remove edges with weight smaller than W_MIN
-        logger.debug("Removing edges with weight smaller than W_MIN")
-        weight_totals = nx.get_edge_attributes(graph, "weight_total")
-        logger.debug(f"{weight_totals.values()=}")
-        w_min = filter_low(list(weight_totals.values()))[1][0]
-        full_graph = graph.copy()
-        graph.remove_edges_from((e for e, w in weight_totals.items() if w < w_min))
-
-        # Remove nodes with no edges
-        graph.remove_nodes_from(list(nx.isolates(graph)))
-
-        # Restore edges with weight smaller than W_MIN for remaining nodes
-        for node in full_graph.nodes():
-            if node not in graph.nodes():
+    except concurrent.futures.TimeoutError:
+        pending = [name for f, name in future_to_page.items() if not f.done()]
+        logger.info(f"Expansion budget exceeded, {pending=}")
+
+    page_edges = [
+        (topic, loaded[name]) for name, topic in zip(page_names, topic_names) if name in loaded
+    ]
+    return Expansion(
+        provider=provider.name,
+        topic_names=topic_names,
+        page_edges=page_edges,
+        skipped=skipped,
+        pending=pending,
+        pending_topics=pending_topics,
+    )
+
+
+def merge_edges(expansions: [Expansion], weights: [float], policy: str = "merge") -> list:
+    """Combines the edges of each provider. With policy "merge" the edges of every provider are
+    added with their weight multiplied by the provider weight. With policy "first" the edges
+    of a page topic come only from the first provider (in order) that resolved it, from every
+    page of that provider with the topic.
+    """
+    assert policy in ("merge", "first")
+    edges = []
+    resolved = set()
+    for expansion, provider_weight in zip(expansions, weights):
+        topics = set()
+        for topic, page_edges in expansion.page_edges:
+            if policy == "first" and topic in resolved:
                 continue
-            for edge in full_graph.edges(node):
-                if (
-                    edge not in graph.edges()
-                    and edge[0] in graph.nodes()
-                    and edge[1] in graph.nodes()
-                ):
-                    graph.add_edge(
-                        edge[0],
-                        edge[1],
-                        weight=full_graph[edge[0]][edge[1]]["weight"],
-                        weight_total=full_graph[edge[0]][edge[1]]["weight_total"],
-                    )
+            topics.add(topic)
+            edges += [(s, e, w * provider_weight) for s, e, w in page_edges]
+        resolved |= topics
+    return edges
 
-    return graph
 
+def expand_corpus(
+    topics: [str],
+    provider,
+    full: bool = False,
+    use_cache=True,
+    fetch_policy: FetchPolicy = None,
+    budget_ms: int = None,
+    provider_weights: [float] = None,
+    provider_policy: str = "merge",
+) -> nx.DiGraph:
+    """Expands a corpus by adding pages from a provider and returns a graph
 
-def plot_graph(graph: nx.DiGraph, width: int, height: int, style=0) -> bytes:
-    """Returns a plot of the graph"""
+    provider can be a name, an IDocumentProvider or a list of them. Multiple providers are queried
+    concurrently and their edges combined as described in merge_edges, each scaled by
+    provider_weights (defaults to 1 for every provider). With provider_policy "first" the
+    providers are queried one after the other instead, so the pages already answered by a
+    provider are not fetched from the next ones.
 
-    # Set layout
-    if style == 0:
-        pos = nx.nx_agraph.graphviz_layout(graph, prog="dot")
-    elif style == 1:
-        # Ortogonal
-        pos = nx.nx_agraph.pygraphviz_layout(
-            graph, prog="patchwork", args="-Goverlap=scale "
-        )
+    If budget_ms is given the graph is built only from the pages that finished in time. Pages
+    still running are left in background and stored in cache when done, so a later call is
+    complete. In that case graph.graph["expansion"] lists the skipped and pending pages.
+    """
+    cache = Cache.instance() if use_cache else {}
+
+    if isinstance(provider, (str, IDocumentProvider)):
+        provider = [provider]
+    providers = []
+    for p in provider:
+        if isinstance(p, str):
+            assert p in providers_map
+            p: IDocumentProvider = providers_map[p].provider
+        providers.append(p)
+
+    if provider_weights is None:
+        provider_weights = [1] * len(providers)
+    assert len(provider_weights) == len(providers)
+
+    deadline = None if budget_ms is None else time.monotonic() + budget_ms / 1000
+
+    if len(providers) == 1:
+        expansions = [
+            collect_edges(topics, providers[0], cache, fetch_policy, deadline)
+        ]
+    elif provider_policy == "first":
+        # In order, a provider only loads the pages no previous one answered for
+        expansions = []
+        resolved = set()
+        for p in providers:
+            expansion = collect_edges(topics, p, cache, fetch_policy, deadline, resolved)
+            resolved |= {topic for topic, _ in expansion.page_edges}
+            expansions.append(expansion)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(providers)) as executor:
+            futures = [
+                executor.submit(collect_edges, topics, p, cache, fetch_policy, deadline)
+                for p in providers
+            ]
+            expansions = [future.result() for future in futures]
+
+    nodes = [name for expansion in expansions for name in expansion.topic_names]
+    edges = merge_edges(expansions, provider_weights, provider_policy)
+    index, src, dst, weight, weight_total = aggregate_edges(nodes, edges)
+    logger.debug(f"Aggregated {len(edges)} edges into {len(src)} arrows")
+
+    # A partial graph might not have any edges to prune
+    if not full and len(src):
+        # Remove edges with weight smaller than W_MIN, then the nodes left without edges and
+        # restore the edges with weight smaller than W_MIN between the remaining nodes
+        logger.debug("Removing edges with weight smaller than W_MIN")
+        logger.debug(f"{weight_total=}")
+        w_min = filter_low(weight_total.tolist())[1][0]
+        node_mask, edge_mask = prune_edges(len(index), src, dst, weight_total, w_min)
+        nodes = [name for name, i in index.items() if node_mask[i]]
+        src, dst = src[edge_mask], dst[edge_mask]
+        weight, weight_total = weight[edge_mask], weight_total[edge_mask]
+
+    graph = build_graph(nodes, index, src, dst, weight, weight_total)
+
+    if budget_ms is not None:
+        graph.graph["expansion"] = {
+            "complete": not any(e.pending or e.pending_topics for e in expansions),
+            "skipped": sum((e.skipped for e in expansions), []),
+            "pending": sum((e.pending for e in expansions), []),
+            "pending_topics": sum((e.pending_topics for e in expansions), []),
+        }
 
-    # Compute plotting data
-    weight_totals = nx.get_edge_attributes(graph, "weight_total")
-    labels = nx.get_edge_attributes(graph, "weight")
-    thickness = list(weight_totals.values())
-    thickness = [(w + 1) / max(thickness) for w in thickness]
-
-    # Resize image
-    dpi = 128
-    plt.gcf().set_size_inches(width / dpi, height / dpi)
-    plt.axis("off")
-
-    # PLOT
-    nx.draw_networkx(graph, pos, width=thickness)
-    nx.draw_networkx_edge_labels(graph, pos, edge_labels=labels)
-    nx.draw_networkx_edge_labels(graph, pos, edge_labels=weight_totals)
-
-    # Convert to bytes[]
-    b = BytesIO()
-    plt.savefig(b, format="png", dpi=dpi)
-    b.seek(0)
-    return b.read()
+    return graph
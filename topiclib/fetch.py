@@ -0,0 +1,189 @@
+import concurrent.futures
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+
+from requests.exceptions import ConnectionError
+
+# Threads used to run the actual provider calls so that they can be abandoned on timeout
+FETCH_WORKERS = 32
+LATENCY_WINDOW = 1000
+
+
+@dataclass
+class FetchPolicy:
+    """Timeouts, retries and hedging used when fetching content from a provider"""
+
+    timeout: float = 10.0  # seconds for a single attempt
+    retries: int = 3
+    backoff: float = 0.5  # base delay for the exponential backoff
+    max_backoff: float = 8.0
+    hedge: bool = False  # fire a duplicate request when the first one is slow
+    hedge_percentile: float = 95
+    hedge_min_samples: int = 20  # samples needed before the percentile is trusted
+    retry_on: tuple = (ConnectionError, TimeoutError)
+
+
+class LatencyTracker:
+    """Keeps a sliding window of latencies (in seconds) for a provider"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, latency: float) -> None:
+        with self._lock:
+            self.samples.append(latency)
+
+    def values(self) -> [float]:
+        with self._lock:
+            return list(self.samples)
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def percentile(self, p: float) -> float:
+        """Nearest rank percentile. Returns None if there are no samples"""
+        with self._lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        rank = int(round(p / 100 * (len(samples) - 1)))
+        return samples[rank]
+
+    def percentiles(self) -> dict:
+        return {
+            "count": len(self),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+default_policy = FetchPolicy()
+latency_trackers = {}
+_trackers_lock = threading.Lock()
+_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=FETCH_WORKERS, thread_name_prefix="fetch"
+)
+
+
+def set_fetch_policy(policy: FetchPolicy) -> None:
+    """Sets the policy used when expand_corpus is not given one"""
+    global default_policy
+    default_policy = policy
+
+
+def latency_tracker(name: str) -> LatencyTracker:
+    with _trackers_lock:
+        if name not in latency_trackers:
+            latency_trackers[name] = LatencyTracker()
+        return latency_trackers[name]
+
+
+def latency_percentiles(name: str = None) -> dict:
+    """Fetch latency percentiles in seconds for one provider or for all of them"""
+    if name is not None:
+        return latency_tracker(name).percentiles()
+    return {n: t.percentiles() for n, t in list(latency_trackers.items())}
+
+
+class _Call:
+    """A provider call submitted to the executor. started_at is set when a thread runs it"""
+
+    def __init__(self, func, args):
+        self.started_at = None
+        self.future = _executor.submit(self._run, func, args)
+
+    def _run(self, func, args):
+        self.started_at = time.monotonic()
+        result = func(*args)
+        return result, time.monotonic() - self.started_at
+
+
+def _abandon(call: _Call, tracker: LatencyTracker) -> None:
+    """Drops a call nobody waits for anymore. It is removed from the queue if it didn't start,
+    otherwise its latency is still recorded if it completes"""
+    if call.future.cancel():
+        return
+
+    def record(future):
+        if not future.cancelled() and future.exception() is None:
+            tracker.add(future.result()[1])
+
+    call.future.add_done_callback(record)
+
+
+def _fetch_once(func, args, policy: FetchPolicy, tracker: LatencyTracker):
+    """Runs one attempt, hedging it if enabled. Raises TimeoutError if nothing answered in time.
+    The timeout counts from when the call starts running, time waiting for a free thread is
+    bounded by the timeout too"""
+    submitted_at = time.monotonic()
+    calls = [_Call(func, args)]
+
+    def deadline() -> float:
+        started = [c.started_at for c in calls if c.started_at is not None]
+        return (min(started) if started else submitted_at) + policy.timeout
+
+    if policy.hedge and len(tracker) >= policy.hedge_min_samples:
+        hedge_after = min(tracker.percentile(policy.hedge_percentile), policy.timeout)
+        done, _ = concurrent.futures.wait([calls[0].future], timeout=hedge_after)
+        if not done:
+            calls.append(_Call(func, args))
+
+    pending = {c.future for c in calls}
+    error = None
+    while pending:
+        remaining = deadline() - time.monotonic()
+        if remaining <= 0:
+            break
+        done, pending = concurrent.futures.wait(
+            pending, timeout=remaining, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in done:
+            try:
+                result, latency = future.result()
+            except Exception as e:
+                # The hedged request may still answer
+                error = e
+                continue
+            tracker.add(latency)
+            for call in calls:
+                if call.future is not future:
+                    _abandon(call, tracker)
+            return result
+
+    if error is not None and not pending:
+        raise error
+    for call in calls:
+        if call.future in pending:
+            _abandon(call, tracker)
+    if all(c.started_at is None for c in calls):
+        raise TimeoutError(f"No free fetch thread after {policy.timeout}s")
+    raise TimeoutError(f"No answer after {policy.timeout}s")
+
+
+def fetch(provider, func, *args, policy: FetchPolicy = None):
+    """Calls func(*args) for the provider with a timeout per attempt, exponential backoff with
+    full jitter between attempts and optional hedging. Latencies are tracked by provider name.
+    """
+    policy = policy or default_policy
+    tracker = latency_tracker(provider.name)
+    for attempt in range(policy.retries + 1):
+        try:
+            return _fetch_once(func, args, policy, tracker)
+        except policy.retry_on:
+            if attempt >= policy.retries:
+                raise
+            delay = min(policy.max_backoff, policy.backoff * 2**attempt)
+            time.sleep(random.uniform(0, delay))
+
+
+def fetch_content(provider, page_name: str, policy: FetchPolicy = None) -> str:
+    return fetch(provider, provider.content, page_name, policy=policy)
+
+
+def fetch_categories(provider, page_name: str, policy: FetchPolicy = None) -> [str]:
+    return fetch(provider, provider.categories, page_name, policy=policy)
@@ -0,0 +1,444 @@
+# Sharded file system cache
+#
+# Each entry is a file named by the sha256 of its key under data/<2 hex>/<2 hex>/, so lookups
+# don't need any index or lock and files can live on a shared file system. Files are written to
+# tmp/ and renamed into place (atomic), big ones are read with mmap. Keys are also appended to a
+# compact per shard index (index/<2 hex>) used to list them. Maintenance scans data/ itself (the
+# file headers are the truth for expiry and eviction) and rebuilds the index from it, one process
+# at a time.
+
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+import uuid
+from collections import Counter
+
+from .cache import MISSING, ICache, cacheclass, key_prefix
+
+# magic, flags (value is bytes), expires_at (0 never), key length
+_header = struct.Struct("<4sBdI")
+_MAGIC = b"TCF1"
+_BYTES = 0b1
+
+# record length, op, expires_at (0 never) followed by the key
+_record = struct.Struct("<IBd")
+_SET = 1
+_DELETE = 0
+
+# Files at least this big are read with mmap
+MMAP_MIN = 64 * 1024
+# Seconds between the mtime updates of a file read often
+TOUCH_INTERVAL = 60.0
+# Seconds after which the maintenance lease of a dead process is taken over
+LEASE_TTL = 3600.0
+
+
+class FileCache(ICache):
+    """Cache stored as one file per key in a sharded directory tree (see the module comment).
+
+    - ttls: {key_prefix: seconds} keys expire after the ttl of their longest matching prefix
+    - max_size: maximum bytes of the entries, the least recently used ones are evicted when it
+      grows over it. Reads update the file mtime (at most every TOUCH_INTERVAL seconds), which
+      is used as the access time
+    - eviction: only "lru", others fall back to it with a warning
+    - maintenance_interval: seconds between background runs that remove expired keys, evict and
+      compact the index (None to disable them)
+    - fsync: flush each file to disk before renaming it into place
+    - maintain: whether this process runs the maintenance (e.g. not in workers)
+    """
+
+    @cacheclass
+    def __init__(
+        self,
+        root: str,
+        ttls: dict = None,
+        max_size: int = None,
+        eviction: str = "lru",
+        maintenance_interval: float = 60.0,
+        fsync: bool = False,
+        maintain: bool = True,
+    ):
+        if eviction != "lru":
+            # Hit counts are not kept in the files
+            print(f"FileCache only evicts the least recently used keys, "
+                  f"ignoring eviction={eviction!r}")
+        self.root = root
+        self.ttls = ttls or {}
+        self.max_size = max_size
+        # Access times are in the files, a process that doesn't maintain needs no thread
+        self.maintenance_interval = maintenance_interval if maintain else None
+        self.fsync = fsync
+        self.evictions = 0
+        # Evicted keys by prefix (see key_prefix)
+        self.evicted = Counter()
+        self._maintenance_pid = None
+        for directory in ("data", "index", "tmp"):
+            os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    # Paths
+
+    @staticmethod
+    def digest(key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        h = self.digest(key)
+        return os.path.join(self.root, "data", h[:2], h[2:4], h)
+
+    def _index_path(self, shard: str) -> str:
+        return os.path.join(self.root, "index", shard)
+
+    def ttl(self, key: str) -> float:
+        """ttl in seconds of the longest prefix of key in self.ttls or None"""
+        prefixes = [p for p in self.ttls if key.startswith(p)]
+        if not prefixes:
+            return None
+        return self.ttls[max(prefixes, key=len)]
+
+    # Index
+
+    def _append_index(self, key: str, op: int, expires_at: float) -> None:
+        """Appends a record with a single O_APPEND write, so concurrent writers don't mix them"""
+        data = key.encode()
+        record = _record.pack(len(data), op, expires_at) + data
+        fd = os.open(
+            self._index_path(self.digest(key)[:2]), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, record)
+        finally:
+            os.close(fd)
+
+    def _read_index(self, shard: str) -> dict:
+        """{key: expires_at} of the keys set (and not deleted afterwards) in a shard"""
+        try:
+            with open(self._index_path(shard), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return {}
+        keys = {}
+        offset = 0
+        while offset + _record.size <= len(data):
+            length, op, expires_at = _record.unpack_from(data, offset)
+            offset += _record.size
+            key = data[offset:offset + length].decode()
+            offset += length
+            if op == _SET:
+                keys[key] = expires_at
+            else:
+                keys.pop(key, None)
+        return keys
+
+    def _shards(self) -> [str]:
+        return sorted(os.listdir(os.path.join(self.root, "index")))
+
+    def _index_sizes(self) -> dict:
+        sizes = {}
+        for shard in self._shards():
+            try:
+                sizes[shard] = os.path.getsize(self._index_path(shard))
+            except FileNotFoundError:
+                pass
+        return sizes
+
+    def compact_index(self, entries: [tuple], sizes: dict) -> None:
+        """Rewrites the shard indexes with the keys of entries (see _scan) followed by the records
+        appended since sizes {shard: bytes} were taken, before the scan. A record appended while
+        its shard is being replaced can still be lost, its key is listed again after the next
+        maintenance finds its file"""
+        live = {}
+        for entry in entries:
+            key, expires_at = entry[2], entry[3]
+            data = key.encode()
+            live.setdefault(self.digest(key)[:2], []).append(
+                _record.pack(len(data), _SET, expires_at) + data)
+        for shard in set(live) | set(self._shards()):
+            path = self._index_path(shard)
+            try:
+                with open(path, "rb") as f:
+                    f.seek(sizes.get(shard, 0))
+                    appended = f.read()
+            except FileNotFoundError:
+                appended = b""
+            self._replace(path, b"".join(live.get(shard, [])) + appended)
+
+    # Files
+
+    def _replace(self, path: str, data: bytes) -> None:
+        """Writes data to a temporary file and renames it to path"""
+        tmp = os.path.join(self.root, "tmp", uuid.uuid4().hex)
+        with open(tmp, "wb") as f:
+            f.write(data)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _parse(key: str, data):
+        """Value in the contents of an entry file (bytes or mmap) or MISSING. Only the value is
+        copied out of data"""
+        if len(data) < _header.size:
+            return MISSING
+        magic, flags, expires_at, key_length = _header.unpack_from(data)
+        start = _header.size + key_length
+        # Different keys with the same hash are not expected, checked anyway
+        if magic != _MAGIC or len(data) < start or data[_header.size:start] != key.encode():
+            return MISSING
+        if expires_at and expires_at <= time.time():
+            return MISSING
+        value = data[start:]
+        return value if flags & _BYTES else value.decode()
+
+    def _read(self, key: str, touch: bool = True):
+        """Returns the value of key or MISSING"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size >= MMAP_MIN:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                        value = self._parse(key, m)
+                else:
+                    value = self._parse(key, f.read())
+        except FileNotFoundError:
+            return MISSING
+
+        if touch and value is not MISSING and stat.st_mtime < time.time() - TOUCH_INTERVAL:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+        return value
+
+    def _start_maintenance(self) -> None:
+        """Starts the maintenance thread of this process if not running"""
+        if self.maintenance_interval is None or self._maintenance_pid == os.getpid():
+            return
+        self._maintenance_pid = os.getpid()
+        threading.Thread(target=self._maintenance_loop, daemon=True, name="cache-maintenance").start()
+
+    def _maintenance_loop(self) -> None:
+        while True:
+            time.sleep(self.maintenance_interval)
+            try:
+                self.maintenance()
+            except Exception as e:
+                print(f"Cache maintenance failed: {e}")
+
+    # ICache
+
+    def get(self, key: str, default=None) -> str:
+        self._start_maintenance()
+        value = self._read(key)
+        return default if value is MISSING else value
+
+    def _entry(self, key: str, value: str, ttl: float = None) -> (bytes, float):
+        """Returns the file contents of an entry and its expires_at"""
+        ttl = self.ttl(key) if ttl is None else ttl
+        expires_at = 0.0 if ttl is None else time.time() + ttl
+        flags = 0
+        if isinstance(value, str):
+            value = value.encode()
+        else:
+            flags = _BYTES
+        data = key.encode()
+        return _header.pack(_MAGIC, flags, expires_at, len(data)) + data + value, expires_at
+
+    def set(self, key: str, value: str, ttl: float = None) -> None:
+        """ttl overrides the ttl of the key prefix"""
+        self._start_maintenance()
+        entry, expires_at = self._entry(key, value, ttl)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._replace(path, entry)
+        self._append_index(key, _SET, expires_at)
+
+    def add(self, key: str, value: str, ttl: float = None) -> bool:
+        """Hard links a temporary file to the key path, which fails if it exists. An expired
+        entry is removed first (two processes could both do it at the same time)"""
+        entry, expires_at = self._entry(key, value, ttl)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = os.path.join(self.root, "tmp", uuid.uuid4().hex)
+        with open(tmp, "wb") as f:
+            f.write(entry)
+        try:
+            for _ in range(2):
+                try:
+                    os.link(tmp, path)
+                except FileExistsError:
+                    if self._read(key, touch=False) is not MISSING:
+                        return False
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                self._append_index(key, _SET, expires_at)
+                return True
+            return False
+        finally:
+            os.remove(tmp)
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            return
+        self._append_index(key, _DELETE, 0.0)
+
+    def clear(self) -> None:
+        for directory in ("data", "index"):
+            shutil.rmtree(os.path.join(self.root, directory), ignore_errors=True)
+            os.makedirs(os.path.join(self.root, directory), exist_ok=True)
+
+    def iter_keys(self, prefix: str = "") -> iter:
+        now = time.time()
+        for shard in self._shards():
+            for key, expires_at in self._read_index(shard).items():
+                if key.startswith(prefix) and (not expires_at or expires_at > now):
+                    if os.path.exists(self._path(key)):
+                        yield key
+
+    def iter_items(self, prefix: str = "") -> iter:
+        for key in self.iter_keys(prefix):
+            value = self._read(key, touch=False)
+            if value is not MISSING:
+                yield key, value
+
+    def keys(self) -> [str]:
+        return list(self.iter_keys())
+
+    def values(self) -> [str]:
+        return [value for _, value in self.iter_items()]
+
+    def items(self) -> [(str, str)]:
+        return list(self.iter_items())
+
+    def __contains__(self, key: str) -> bool:
+        return self._read(key, touch=False) is not MISSING
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.iter_keys())
+
+    def __iter__(self) -> iter:
+        return self.iter_keys()
+
+    def __getitem__(self, key: str) -> str:
+        return self.get(key)
+
+    def __setitem__(self, key: str, value: str) -> None:
+        self.set(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        self.delete(key)
+
+    # Maintenance
+
+    def _scan(self) -> iter:
+        """Yields (mtime, size, key, expires_at, path, inode) of the files under data/, key is
+        None for files that are not valid entries"""
+        for directory, _, names in os.walk(os.path.join(self.root, "data")):
+            for name in names:
+                path = os.path.join(directory, name)
+                key, expires_at = None, 0.0
+                try:
+                    with open(path, "rb") as f:
+                        stat = os.fstat(f.fileno())
+                        head = f.read(_header.size)
+                        if len(head) == _header.size:
+                            magic, _, expires_at, key_length = _header.unpack(head)
+                            data = f.read(key_length)
+                            if magic == _MAGIC and len(data) == key_length:
+                                key = data.decode(errors="replace")
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, key, expires_at, path, stat.st_ino
+
+    @staticmethod
+    def _remove(path: str, inode: int) -> bool:
+        """Removes path unless it was replaced since it was scanned"""
+        try:
+            if os.stat(path).st_ino != inode:
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _lease(self) -> bool:
+        """Takes the maintenance lease (a file created exclusively), or takes it over if its
+        holder didn't release it in LEASE_TTL seconds. Returns whether it was taken"""
+        path = os.path.join(self.root, "maintenance.lease")
+        for _ in range(2):
+            try:
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+                return True
+            except FileExistsError:
+                try:
+                    if os.stat(path).st_mtime > time.time() - LEASE_TTL:
+                        return False
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return False
+
+    def maintenance(self) -> None:
+        """Removes expired keys and stale temporary files, evicts if over max_size and compacts
+        the index. Skipped if another process is running it"""
+        if not self._lease():
+            return
+        try:
+            now = time.time()
+            sizes = self._index_sizes()
+            entries = []
+            for entry in self._scan():
+                key, expires_at, path, inode = entry[2:]
+                # Checked against the file header, the index may be behind a newer set
+                if key is None or (expires_at and expires_at <= now):
+                    self._remove(path, inode)
+                    continue
+                entries.append(entry)
+
+            # Temporary files of writers that died before renaming them
+            tmp = os.path.join(self.root, "tmp")
+            for name in os.listdir(tmp):
+                path = os.path.join(tmp, name)
+                try:
+                    if os.stat(path).st_mtime < now - 3600:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+            if self.max_size is not None:
+                entries = self.evict(entries)
+            self.compact_index(entries, sizes)
+        finally:
+            try:
+                os.remove(os.path.join(self.root, "maintenance.lease"))
+            except FileNotFoundError:
+                pass
+
+    def disk_size(self) -> int:
+        """Bytes of the entry files"""
+        return sum(entry[1] for entry in self._scan())
+
+    def evict(self, entries: [tuple]) -> [tuple]:
+        """Deletes the least recently used of entries (see _scan) until they are 10% below
+        max_size. Returns the entries left"""
+        size = sum(entry[1] for entry in entries)
+        entries = sorted(entries)
+        evicted = 0
+        for _, file_size, key, _, path, inode in entries:
+            if size <= 0.9 * self.max_size:
+                break
+            if self._remove(path, inode):
+                evicted += 1
+                self.evicted[key_prefix(key)] += 1
+            size -= file_size
+        self.evictions += evicted
+        return [entry for entry in entries if os.path.exists(entry[4])]
@@ -0,0 +1,81 @@
+# Vectorized graph construction for the corpus expansion
+#
+# Edges are accumulated in a topic x topic matrix indexed by topic id and the networkx graph is
+# built once at the end.
+
+import networkx as nx
+import numpy as np
+
+
+def topic_index(nodes: [str]) -> dict:
+    """Maps each unique topic to its id, keeping the order of first appearance"""
+    index = {}
+    for node in nodes:
+        index.setdefault(node, len(index))
+    return index
+
+
+def aggregate_edges(nodes: [str], edges: [(str, str, int)]):
+    """Aggregates edges = [(start, end, weight)] between nodes.
+
+    Same result as adding the edges one by one: an edge between two topics points in the
+    direction of the net weight ('weight') and 'weight_total' is the sum of the weights in both
+    directions. When the net weight is zero the edge keeps the direction of the last edge added.
+    Endpoints missing from nodes get an id after them, as adding the edges to a graph would
+    (e.g. pages cached by a search of other topics).
+    Returns (index, src, dst, weight, weight_total) where src and dst are arrays of topic ids.
+    """
+    edges = [(s, e, w) for s, e, w in edges if s != e]
+    index = topic_index(nodes + [name for s, e, _ in edges for name in (s, e)])
+    n = len(index)
+
+    src = np.fromiter((index[s] for s, _, _ in edges), dtype=np.intp, count=len(edges))
+    dst = np.fromiter((index[e] for _, e, _ in edges), dtype=np.intp, count=len(edges))
+    weights = np.asarray([w for _, _, w in edges])
+
+    # sums[i, j] is the weight added from i to j, last[i, j] the position of the last one
+    sums = np.zeros((n, n), dtype=weights.dtype)
+    np.add.at(sums, (src, dst), weights)
+    last = np.full((n, n), -1, dtype=np.intp)
+    np.maximum.at(last, (src, dst), np.arange(len(edges)))
+
+    net = sums - sums.T
+    total = sums + sums.T
+    touched = (last >= 0) | (last.T >= 0)
+
+    i, j = np.nonzero(np.triu(touched, k=1))
+    forward = (net[i, j] > 0) | ((net[i, j] == 0) & (last[i, j] > last[j, i]))
+    src = np.where(forward, i, j)
+    dst = np.where(forward, j, i)
+    weight = np.abs(net[i, j])
+    weight_total = total[i, j]
+
+    order = np.lexsort((dst, src))
+    return index, src[order], dst[order], weight[order], weight_total[order]
+
+
+def build_graph(nodes: [str], index: dict, src, dst, weight, weight_total) -> nx.DiGraph:
+    """Builds the DiGraph from the arrays returned by aggregate_edges"""
+    names = list(index)
+    graph = nx.DiGraph()
+    graph.add_nodes_from(nodes)
+    graph.add_edges_from(
+        (names[s], names[e], {"weight": w, "weight_total": t})
+        for s, e, w, t in zip(
+            src.tolist(), dst.tolist(), weight.tolist(), weight_total.tolist()
+        )
+    )
+    return graph
+
+
+def prune_edges(n_nodes: int, src, dst, weight_total, w_min):
+    """Removes the edges with weight_total < w_min, then the nodes left without edges, and
+    keeps every edge (even weak ones) between the remaining nodes.
+    Returns (node_mask, edge_mask) over topic ids and over the edge arrays.
+    """
+    strong = weight_total >= w_min
+    node_mask = np.zeros(n_nodes, dtype=bool)
+    node_mask[src[strong]] = True
+    node_mask[dst[strong]] = True
+    edge_mask = node_mask[src] & node_mask[dst]
+    return node_mask, edge_mask
@@ -0,0 +1,341 @@
+# Background jobs
+#
+# Jobs of the /command endpoints are rows of a sqlite table shared by every api worker, so any of
+# them can report the status of a job or return its result, whichever queued it. A fixed number
+# of long lived worker processes claim the queued jobs in order, run them and record how they
+# ended. Results are files that are removed together with their row after a retention period.
+
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from .cache import _run
+from .compute import _warm_up
+
+logger = logging.getLogger("topiclib")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueue:
+    """Sqlite queue and table of jobs (see the module comment).
+
+    - max_queued: jobs waiting at most, submit refuses more
+    - retention: seconds finished jobs and their result files are kept
+    - timeout: seconds a job can run. Longer ones are failed (their worker is assumed dead)
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        max_queued: int = 32,
+        retention: float = 3600.0,
+        timeout: float = 900.0,
+        busy_timeout: float = 30.0,
+    ):
+        self.db_path = db_path
+        self.max_queued = max_queued
+        self.retention = retention
+        self.timeout = timeout
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self.conn.executescript(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                func TEXT NOT NULL,
+                kwargs TEXT NOT NULL,
+                path TEXT,
+                status TEXT NOT NULL,
+                error TEXT,
+                worker INTEGER,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);"""
+        )
+
+    def __getstate__(self) -> dict:
+        # Sent to the job workers, which open their own connections
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit mode, write transactions are opened explicitly by _write
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout * 1000)}")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Connection of the current thread (a new one after a fork)"""
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            local.conn = self._connect()
+            local.pid = os.getpid()
+        return local.conn
+
+    def _write(self, func):
+        """Runs func(conn) in a write transaction and returns its result"""
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(conn)
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def submit(self, kind: str, func, kwargs: dict, path: str = None) -> str:
+        """Queues func(**kwargs). func must be a module level function and kwargs json
+        serializable. kind and path (of the result file) are only recorded.
+        Returns the job id or None if max_queued jobs are waiting already"""
+        job_id = str(uuid.uuid4())
+        name = f"{func.__module__}:{func.__qualname__}"
+
+        def insert(conn):
+            (queued,) = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)
+            ).fetchone()
+            if queued >= self.max_queued:
+                return None
+            conn.execute(
+                "INSERT INTO jobs (id, kind, func, kwargs, path, status, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, name, json.dumps(kwargs), path, QUEUED, time.time()),
+            )
+            return job_id
+
+        return self._write(insert)
+
+    def get(self, job_id: str) -> dict:
+        """The job row as a dict (without its function and arguments) or None"""
+        row = self.conn.execute(
+            "SELECT id, kind, path, status, error, created_at, started_at, finished_at"
+            " FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        return None if row is None else dict(row)
+
+    def counts(self) -> dict:
+        """{status: jobs}"""
+        rows = self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return {status: n for status, n in rows}
+
+    def claim(self, worker: int) -> dict:
+        """Marks the oldest queued job as running by worker and returns it (with func and
+        kwargs), or None if there is nothing queued"""
+
+        def update(conn):
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+            started_at = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = ?, started_at = ? WHERE id = ?",
+                (RUNNING, worker, started_at, row["id"]),
+            )
+            return dict(row, status=RUNNING, worker=worker, started_at=started_at)
+
+        return self._write(update)
+
+    def finish(self, job_id: str, worker: int, error: str = None) -> bool:
+        """Marks a job running in worker as done, or failed with error. Returns False (and leaves
+        the job as is) if it is not running in worker anymore, e.g. it timed out meanwhile"""
+        cursor = self._write(
+            lambda conn: conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?"
+                " WHERE id = ? AND status = ? AND worker = ?",
+                (DONE if error is None else FAILED, error, time.time(), job_id, RUNNING, worker),
+            )
+        )
+        return cursor.rowcount > 0
+
+    def abandon(self, workers: [int]) -> None:
+        """Fails the jobs running in workers (pids), e.g. after stopping them"""
+        self._write(
+            lambda conn: conn.executemany(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?"
+                " WHERE status = ? AND worker = ?",
+                [(FAILED, "Worker stopped", time.time(), RUNNING, pid) for pid in workers],
+            )
+        )
+
+    def cleanup(self) -> int:
+        """Fails the jobs running for longer than timeout and removes the jobs (and result
+        files) finished more than retention seconds ago. Returns the number removed"""
+        now = time.time()
+
+        def expire(conn):
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?"
+                " WHERE status = ? AND started_at < ?",
+                (FAILED, "Timed out", now, RUNNING, now - self.timeout),
+            )
+            old = conn.execute(
+                "SELECT id, path FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                (DONE, FAILED, now - self.retention),
+            ).fetchall()
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(row["id"],) for row in old])
+            return old
+
+        old = self._write(expire)
+        for row in old:
+            if row["path"]:
+                try:
+                    os.remove(row["path"])
+                except FileNotFoundError:
+                    pass
+        return len(old)
+
+    # Async, run in the threads of the async cache calls
+
+    async def asubmit(self, kind: str, func, kwargs: dict, path: str = None) -> str:
+        return await _run(self.submit, kind, func, kwargs, path)
+
+    async def aget(self, job_id: str) -> dict:
+        return await _run(self.get, job_id)
+
+    def close(self) -> None:
+        if getattr(self._local, "pid", None) == os.getpid():
+            self._local.conn.close()
+        self._local = threading.local()
+
+
+def resolve(name: str):
+    """Function from its "module:qualname" """
+    module, _, qualname = name.partition(":")
+    func = importlib.import_module(module)
+    for attr in qualname.split("."):
+        func = getattr(func, attr)
+    return func
+
+
+def run_job(queue: JobQueue, job: dict) -> None:
+    """Runs a claimed job and records how it ended"""
+    try:
+        resolve(job["func"])(**json.loads(job["kwargs"]))
+    except Exception as e:
+        print(f"Job {job['id']} failed: {e}")
+        finished = queue.finish(job["id"], job["worker"], f"{type(e).__name__}: {e}")
+    else:
+        finished = queue.finish(job["id"], job["worker"])
+    if not finished:
+        print(f"Job {job['id']} ended after it was failed, its result is dropped")
+
+
+def _work(queue: JobQueue, parent: int, poll_interval: float, cleanup_interval: float,
+          initializer) -> None:
+    """Job worker loop. Exits when the process that started it is gone"""
+    if initializer is not None:
+        initializer()
+    last_cleanup = 0.0
+    while os.getppid() == parent:
+        if time.monotonic() - last_cleanup >= cleanup_interval:
+            last_cleanup = time.monotonic()
+            try:
+                queue.cleanup()
+            except sqlite3.Error as e:
+                print(f"Job cleanup failed: {e}")
+        job = queue.claim(os.getpid())
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        logger.debug(f"Running job {job['id']} ({job['kind']})")
+        run_job(queue, job)
+
+
+class JobWorkers:
+    """Fixed pool of processes running the jobs of a queue. Like ComputePool they are spawned and
+    warmed up by initializer, and only started by start() in the process that calls it. A thread
+    of that process replaces the workers that die (checking every supervise_interval seconds)
+    and fails the job they were running right away"""
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        workers: int = 2,
+        poll_interval: float = 0.5,
+        cleanup_interval: float = 60.0,
+        initializer=_warm_up,
+        supervise_interval: float = 1.0,
+    ):
+        self.queue = queue
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.cleanup_interval = cleanup_interval
+        self.initializer = initializer
+        self.supervise_interval = supervise_interval
+        self._processes = []
+        self._pid = None
+        self._stop = threading.Event()
+        self._supervisor = None
+
+    def _spawn(self, i: int):
+        process = multiprocessing.get_context("spawn").Process(
+            target=_work,
+            args=(self.queue, os.getpid(), self.poll_interval, self.cleanup_interval,
+                  self.initializer),
+            daemon=True,
+            name=f"job-worker-{i}",
+        )
+        process.start()
+        return process
+
+    def _supervise(self) -> None:
+        while not self._stop.wait(self.supervise_interval):
+            for i, process in enumerate(self._processes):
+                if process.is_alive() or self._stop.is_set():
+                    continue
+                print(f"Job worker {process.pid} exited with {process.exitcode}, restarting it")
+                try:
+                    self.queue.abandon([process.pid])
+                except sqlite3.Error as e:
+                    print(f"Failing the jobs of worker {process.pid} failed: {e}")
+                self._processes[i] = self._spawn(i)
+
+    def start(self) -> None:
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._stop = threading.Event()
+        self._processes = [self._spawn(i) for i in range(self.workers)]
+        self._supervisor = threading.Thread(
+            target=self._supervise, daemon=True, name="job-supervisor"
+        )
+        self._supervisor.start()
+
+    def shutdown(self) -> None:
+        """Stops the workers and fails the jobs they were running"""
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        self._supervisor.join()
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            process.join()
+        self.queue.abandon([process.pid for process in self._processes])
+        self._processes = []
+        self._pid = None
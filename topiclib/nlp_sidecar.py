@@ -0,0 +1,264 @@
+# NLP sidecar
+#
+# One process (or a few forked from it, sharing the model pages) owns the spacy pipeline and runs
+# preprocess2 for the api workers over a Unix socket, so model memory doesn't grow with the
+# number of workers. A frame is a header (op or status, payload length) followed by the payload,
+# a list of length prefixed utf-8 strings: the texts in a request, the \0 joined tokens of each
+# text in a response. Texts of concurrent requests go through nlp.pipe together.
+
+import concurrent.futures
+import gc
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+logger = logging.getLogger("topiclib")
+
+_frame = struct.Struct("<BI")
+_length = struct.Struct("<I")
+
+OP_PREPROCESS = 1
+OK = 0
+ERROR = 1
+
+
+def _pack_strings(strings: [str]) -> bytes:
+    parts = [_length.pack(len(strings))]
+    for s in strings:
+        data = s.encode()
+        parts += [_length.pack(len(data)), data]
+    return b"".join(parts)
+
+
+def _unpack_strings(data: bytes) -> [str]:
+    (n,) = _length.unpack_from(data)
+    offset = _length.size
+    strings = []
+    for _ in range(n):
+        (size,) = _length.unpack_from(data, offset)
+        offset += _length.size
+        strings.append(data[offset:offset + size].decode())
+        offset += size
+    return strings
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Nlp sidecar connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def _send_frame(sock: socket.socket, code: int, payload: bytes) -> None:
+    sock.sendall(_frame.pack(code, len(payload)) + payload)
+
+
+def _recv_frame(sock: socket.socket) -> (int, bytes):
+    code, size = _frame.unpack(_recv_exactly(sock, _frame.size))
+    return code, _recv_exactly(sock, size)
+
+
+# Server
+
+
+class Batcher:
+    """Runs the texts of concurrent requests through process(texts) -> [[tokens]] in batches of
+    at most max_batch texts, waiting up to max_wait seconds for a batch to fill"""
+
+    def __init__(self, process, max_batch: int = 64, max_wait: float = 0.005):
+        self.process = process
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        threading.Thread(target=self._loop, daemon=True, name="nlp-batcher").start()
+
+    def submit(self, texts: [str]) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self._queue.put((texts, future))
+        return future
+
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            batch = self._next_batch()
+            texts = [text for texts, _ in batch for text in texts]
+            try:
+                results = self.process(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for texts, future in batch:
+                future.set_result(results[offset:offset + len(texts)])
+                offset += len(texts)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        while True:
+            try:
+                op, payload = _recv_frame(self.request)
+            except ConnectionError:
+                return
+            if op != OP_PREPROCESS:
+                _send_frame(self.request, ERROR, f"Unknown op {op}".encode())
+                continue
+            try:
+                results = self.server.batcher.submit(_unpack_strings(payload)).result()
+            except Exception as e:
+                _send_frame(self.request, ERROR, str(e).encode())
+                continue
+            _send_frame(self.request, OK, _pack_strings(["\0".join(t) for t in results]))
+
+
+class NlpServer(socketserver.ThreadingUnixStreamServer):
+    """Serves the requests of a socket with a Batcher (one thread per connection)"""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, batcher: Batcher = None):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, _Handler)
+        self.batcher = batcher
+
+    def get_request(self) -> (socket.socket, str):
+        try:
+            request, address = self.socket.accept()
+        except BlockingIOError:
+            # The socket is non-blocking when shared by forked processes and another one
+            # accepted the connection first. socketserver skips the OSError and waits again
+            raise
+        except OSError as e:
+            print(f"Nlp sidecar accept failed: {e}")
+            raise
+        # Connections are read and written blocking whatever the listening socket is
+        request.setblocking(True)
+        return request, address
+
+
+def _preprocess_many(nlp, texts: [str]) -> [[str]]:
+    from .preprocess import doc_tokens
+
+    return [doc_tokens(doc) for doc in nlp.pipe(texts)]
+
+
+def serve(
+    socket_path: str, processes: int = 1, max_batch: int = 64, max_wait: float = 0.005
+) -> None:
+    """Runs the sidecar on socket_path until interrupted. The pipeline is loaded once, with
+    processes > 1 the others are forked from this one and accept on the same socket"""
+    from .preprocess import load_nlp
+
+    nlp = load_nlp()
+    server = NlpServer(socket_path)
+    # Forked before any thread is started, they share the model pages copy-on-write
+    gc.collect()
+    gc.freeze()
+    children = []
+    if processes > 1:
+        # A process woken up for a connection another one accepted goes back to waiting
+        server.socket.setblocking(False)
+        for _ in range(processes - 1):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    server.batcher = Batcher(lambda texts: _preprocess_many(nlp, texts),
+                                             max_batch, max_wait)
+                    server.serve_forever()
+                finally:
+                    os._exit(0)
+            children.append(pid)
+
+    server.batcher = Batcher(lambda texts: _preprocess_many(nlp, texts), max_batch, max_wait)
+    logger.info(f"Nlp sidecar listening on {socket_path} with {processes} processes")
+    try:
+        server.serve_forever()
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        server.server_close()
+        os.remove(socket_path)
+
+
+# Client
+
+
+class NlpClient:
+    """preprocess2 through the sidecar listening on socket_path. Each thread keeps its own
+    connection, which is opened again once if it broke. Raises OSError if the sidecar can't be
+    reached or doesn't answer within timeout seconds (not sent again, the sidecar may still be
+    busy with it) and RuntimeError if it failed"""
+
+    def __init__(self, socket_path: str, timeout: float = 30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _socket(self) -> socket.socket:
+        """Connection of the current thread (a new one after a fork)"""
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid() or local.sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            local.sock = sock
+            local.pid = os.getpid()
+        return local.sock
+
+    def _close(self) -> None:
+        sock, self._local.sock = self._local.sock, None
+        if sock is not None and self._local.pid == os.getpid():
+            sock.close()
+
+    def preprocess_many(self, texts: [str]) -> [[str]]:
+        for attempt in range(2):
+            sock = self._socket()
+            try:
+                _send_frame(sock, OP_PREPROCESS, _pack_strings(texts))
+                status, payload = _recv_frame(sock)
+            except OSError as e:
+                self._close()
+                if attempt or isinstance(e, socket.timeout):
+                    raise
+                continue
+            if status != OK:
+                raise RuntimeError(f"Nlp sidecar failed: {payload.decode()}")
+            return [tokens.split("\0") if tokens else [] for tokens in _unpack_strings(payload)]
+
+    def preprocess(self, text: str) -> [str]:
+        return self.preprocess_many([text])[0]
@@ -0,0 +1,80 @@
+# Process warm up
+#
+# Loads the heavy libraries and models and runs the extraction and rendering once on a tiny input,
+# so the first job of a process isn't slow. It runs in the initializer of the compute and job
+# workers, which are spawned and so inherit nothing loaded by the api. gc.freeze() then keeps the
+# collector from going through the model objects again on every full collection. Providers are
+# primed by the api processes, which fetch the pages.
+
+import gc
+import logging
+import time
+
+from .corpus_expansion import providers_map
+from .fetch import FetchPolicy, fetch
+
+logger = logging.getLogger("topiclib")
+
+WARM_UP_TEXT = (
+    "Complex numbers extend the real numbers. Every complex number can be written as a sum of "
+    "a real number and an imaginary number, and complex numbers are added like vectors."
+)
+
+
+def _step(name: str, func, *args, **kwargs) -> None:
+    # A failed step only leaves that stage cold
+    start = time.monotonic()
+    try:
+        func(*args, **kwargs)
+    except Exception as e:
+        print(f"Warm up of {name} failed: {e}")
+        return
+    logger.debug(f"Warmed up {name} in {time.monotonic() - start:.2f}s")
+
+
+def _extract() -> None:
+    from .topic_extraction import extract_topics
+
+    for method in ("anygram", "ngram"):
+        extract_topics(WARM_UP_TEXT, method, 2)
+
+
+def _render() -> None:
+    from .render import _warm_up
+
+    _warm_up()
+
+
+def _wordcloud() -> None:
+    from .wordprocess import wordcloud
+
+    wordcloud({"complex": 2, "number": 1}, 64, 64)
+
+
+def warm_up(freeze: bool = True) -> float:
+    """Loads the nlp models (unless the sidecar is used) and runs the extraction, rendering and
+    wordcloud once, then freezes the objects allocated so far out of the garbage collector if
+    freeze. Returns the seconds taken"""
+    from . import preprocess
+
+    start = time.monotonic()
+    # With the nlp sidecar the model is not loaded here
+    if preprocess.nlp_client is None:
+        _step("nlp model", preprocess.load_nlp)
+    _step("topic extraction", _extract)
+    _step("graph rendering", _render)
+    _step("wordcloud", _wordcloud)
+    if freeze:
+        gc.collect()
+        gc.freeze()
+    return time.monotonic() - start
+
+
+def prime_providers(names: [str] = None, timeout: float = 10.0) -> None:
+    """Runs one search per provider (all by default) so connections are open and their latency
+    is tracked before the first request. Nothing is cached"""
+    policy = FetchPolicy(timeout=timeout, retries=0)
+    for name in names or list(providers_map):
+        provider = providers_map[name].provider
+        _step(f"provider {name}", fetch, provider, lambda q: list(provider.search(q)), "number",
+              policy=policy)
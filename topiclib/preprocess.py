@@ -1,6 +1,7 @@
 # Text processing and cleaning tools
 
 from collections import Counter
+from functools import lru_cache
 
 import en_core_web_md
 import nltk
@@ -55,28 +56,78 @@ def preprocess(text: str) -> [str]:
     return tokens
 
 
-def preprocess2(text: str) -> [str]:
-    """Same as preprocess but also removes adjectives, pronomes, conjunctions, etc."""
+# .npy file the word vectors of the model are memory mapped from (see vectors.py), None to keep
+# them in the memory of each process
+vectors_path = None
+
+
+def set_vectors_path(path: str) -> None:
+    """Memory maps the word vectors of pipelines loaded from now on from path, exporting them
+    there first if needed. None disables it"""
+    global vectors_path
+    vectors_path = path
+
+
+@lru_cache(maxsize=None)
+def load_nlp():
+    """The en_core_web_md pipeline, loaded once per process"""
     nlp = en_core_web_md.load()
-    removal = [
-        "ADV",
-        "PRON",
-        "CCONJ",
-        "PUNCT",
-        "PART",
-        "DET",
-        "ADP",
-        "SPACE",
-        "NUM",
-        "SYM",
-    ]
+    if vectors_path:
+        from .vectors import share_vectors
+
+        share_vectors(nlp, vectors_path)
+    return nlp
+
+
+REMOVED_POS = {
+    "ADV",
+    "PRON",
+    "CCONJ",
+    "PUNCT",
+    "PART",
+    "DET",
+    "ADP",
+    "SPACE",
+    "NUM",
+    "SYM",
+}
+
+# Client of the nlp sidecar (see nlp_sidecar.py), None to run the pipeline in this process
+nlp_client = None
+# Whether preprocess2 loads the pipeline in this process when the sidecar can't be reached
+nlp_fallback = False
+
+
+def set_nlp_client(client, fallback: bool = False) -> None:
+    """Makes preprocess2 use the nlp sidecar through client (an NlpClient) or, if None, the
+    pipeline of this process. If the sidecar fails preprocess2 raises, unless fallback: then it
+    loads the pipeline here, which costs the model memory in every process that falls back"""
+    global nlp_client, nlp_fallback
+    nlp_client = client
+    nlp_fallback = fallback
+
+
+def doc_tokens(doc) -> [str]:
+    """Lemmas of the tokens of a spacy doc that preprocess2 keeps"""
     tokens = []
-    for token in nlp(text):
-        if token.pos_ not in removal and not token.is_stop and token.is_alpha and len(token) >= MIN_WORD_LENGTH:
+    for token in doc:
+        if token.pos_ not in REMOVED_POS and not token.is_stop and token.is_alpha and len(token) >= MIN_WORD_LENGTH:
             tokens.append(token.lemma_.lower())
     return tokens
 
 
+def preprocess2(text: str) -> [str]:
+    """Same as preprocess but also removes adjectives, pronomes, conjunctions, etc."""
+    if nlp_client is not None:
+        try:
+            return nlp_client.preprocess(text)
+        except OSError as e:
+            if not nlp_fallback:
+                raise
+            print(f"Nlp sidecar unavailable, using the local pipeline: {e}")
+    return doc_tokens(load_nlp()(text))
+
+
 def get_ngrams(text, n):
     n_grams = ngrams(word_tokenize(text), n)
     return [' '.join(grams) for grams in n_grams]
@@ -0,0 +1,149 @@
+# Graph rendering
+#
+# Figures are created explicitly with the Agg canvas (no pyplot global state), so renders don't
+# stack on each other and can run concurrently. The api renders in its compute workers
+# (topiclib/compute.py).
+
+import json
+import logging
+from io import BytesIO
+
+import networkx as nx
+from networkx.readwrite import json_graph
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from .cache import MISSING, Cache
+from .codec import CodecCache
+from .utils import hash_text
+
+logger = logging.getLogger("topiclib")
+DPI = 128
+
+
+def layout_key(graph: nx.DiGraph, style: int) -> str:
+    """Cache key of the layout of a graph. Only depends on its nodes, edges and the layout style"""
+    nodes = sorted(graph.nodes())
+    edges = sorted(graph.edges())
+    return "layout_" + hash_text(json.dumps((style, nodes, edges)))
+
+
+def compute_layout(graph: nx.DiGraph, style=0) -> dict:
+    """Runs graphviz and returns the positions of the nodes {node: (x, y)}"""
+    if not graph.number_of_nodes():
+        return {}
+    if style == 0:
+        pos = nx.nx_agraph.graphviz_layout(graph, prog="dot")
+    elif style == 1:
+        # Ortogonal
+        pos = nx.nx_agraph.pygraphviz_layout(
+            graph, prog="patchwork", args="-Goverlap=scale "
+        )
+    return pos
+
+
+def cached_layout(graph: nx.DiGraph, style=0, use_cache=True) -> dict:
+    """Returns the cached layout of the graph or None"""
+    if not (use_cache and Cache.is_set()):
+        return None
+    cache = CodecCache(Cache.instance())
+    cache_key = layout_key(graph, style)
+    cached = cache.get(cache_key, MISSING)
+    if cached is not MISSING:
+        logger.debug(f"Layout cache hit for {cache_key}")
+        return {node: tuple(xy) for node, xy in cached}
+    return None
+
+
+def store_layout(graph: nx.DiGraph, style: int, pos: dict, use_cache=True) -> None:
+    if use_cache and Cache.is_set():
+        cache = CodecCache(Cache.instance())
+        cache[layout_key(graph, style)] = list(pos.items())
+
+
+def graph_layout(graph: nx.DiGraph, style=0, use_cache=True) -> dict:
+    """Returns the graphviz positions of the nodes {node: (x, y)}. Layouts are stored in the
+    global cache (if set) so graphs with the same structure skip graphviz"""
+    pos = cached_layout(graph, style, use_cache)
+    if pos is None:
+        pos = compute_layout(graph, style)
+        store_layout(graph, style, pos, use_cache)
+    return pos
+
+
+def edge_thickness(graph: nx.DiGraph) -> dict:
+    """Line width of each edge {(start, end): width} normalized by the biggest weight_total"""
+    weight_totals = nx.get_edge_attributes(graph, "weight_total")
+    if not weight_totals:
+        return {}
+    w_max = max(weight_totals.values())
+    return {edge: (w + 1) / w_max for edge, w in weight_totals.items()}
+
+
+def graph_svg(graph: nx.DiGraph, pos: dict) -> str:
+    """SVG drawn by graphviz straight from the given positions (no new layout is computed)"""
+    agraph = nx.nx_agraph.to_agraph(graph)
+    for node, (x, y) in pos.items():
+        agraph.get_node(node).attr["pos"] = f"{x},{y}"
+    return agraph.draw(format="svg", prog="neato", args="-n2").decode()
+
+
+def layout_data(graph: nx.DiGraph, style=0, use_cache=True, svg=False) -> dict:
+    """Node link data of the graph with the layout already computed so clients can draw it.
+    Nodes get 'x' and 'y', links get the 'thickness' used by plot_graph and if svg is True the
+    graphviz drawing is added as 'svg'"""
+    pos = graph_layout(graph, style, use_cache)
+    thickness = edge_thickness(graph)
+    data = json_graph.node_link_data(graph)
+    for node in data["nodes"]:
+        node["x"], node["y"] = pos[node["id"]]
+    for link in data["links"]:
+        link["thickness"] = thickness[(link["source"], link["target"])]
+    if svg:
+        data["svg"] = graph_svg(graph, pos)
+    return data
+
+
+def render_png(graph: nx.DiGraph, pos: dict, width: int, height: int) -> bytes:
+    """Draws the graph with the given positions on its own figure and returns png bytes"""
+    # Compute plotting data
+    weight_totals = nx.get_edge_attributes(graph, "weight_total")
+    labels = nx.get_edge_attributes(graph, "weight")
+    thickness = list(edge_thickness(graph).values())
+
+    fig = Figure(figsize=(width / DPI, height / DPI), dpi=DPI)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.set_axis_off()
+
+    # PLOT. A partial expansion (budget_ms) can leave a graph without edges, or empty
+    if graph.number_of_edges():
+        nx.draw_networkx(graph, pos, width=thickness, ax=ax)
+        nx.draw_networkx_edge_labels(graph, pos, edge_labels=labels, ax=ax)
+        nx.draw_networkx_edge_labels(graph, pos, edge_labels=weight_totals, ax=ax)
+    elif graph.number_of_nodes():
+        nx.draw_networkx_nodes(graph, pos, ax=ax)
+        nx.draw_networkx_labels(graph, pos, ax=ax)
+
+    # Convert to bytes[]
+    b = BytesIO()
+    fig.savefig(b, format="png", dpi=DPI)
+    return b.getvalue()
+
+
+def _warm_up():
+    """Loads the imports and font caches of a worker once (see preload)"""
+    import pygraphviz  # noqa: F401
+
+    graph = nx.DiGraph()
+    graph.add_edge("a", "b", weight=1, weight_total=1)
+    render_png(graph, {"a": (0, 0), "b": (1, 1)}, 64, 64)
+
+
+def plot_graph(
+    graph: nx.DiGraph, width: int, height: int, style=0, use_cache=True
+) -> bytes:
+    """Returns a plot of the graph"""
+    # Set layout
+    pos = graph_layout(graph, style, use_cache)
+    return render_png(graph, pos, width, height)
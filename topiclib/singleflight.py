@@ -0,0 +1,195 @@
+# Request coalescing
+#
+# Identical computations (same cache key) that are requested while one is already running wait
+# for it instead of running again. Inside a process callers share a future. Between processes the
+# one computing holds a lease key ("lease_" + key) added atomically to the shared cache, the
+# others poll the cache until the value shows up or the lease is gone. Values and lease releases
+# go through the whole cache stack, so with a write-behind layer they are flushed together in one
+# transaction, the value first. Callers computing many keys at once (the pages of an expansion)
+# take their leases in one write with lease_many.
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+import uuid
+
+from .cache import MISSING, ICache, async_executor, innermost
+
+logger = logging.getLogger("topiclib")
+
+
+class SingleFlight:
+    """Runs func once per key at a time (see the module comment).
+
+    func returns the value to store in cache under key, or None to store nothing. The value (as
+    stored) is returned to every caller. Leases expire after lease_ttl seconds so a crashed
+    process doesn't block the others. Without a cache only callers in this process are coalesced.
+    """
+
+    def __init__(self, lease_ttl: float = 120.0, poll_interval: float = 0.1):
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self._calls = {}
+        self._async_calls = {}
+        # {key: token} of the leases taken by lease_many and not used yet
+        self._leased = {}
+        self._lock = threading.Lock()
+
+    def lease_many(self, keys: [str], cache: ICache = None) -> None:
+        """Takes the leases of keys in a single write, ahead of the do() of each of them.
+        Leases held by other processes are left to do() to wait for"""
+        if cache is None or not keys:
+            return
+        tokens = {"lease_" + key: (key, uuid.uuid4().hex) for key in keys}
+        added = innermost(cache).add_many(
+            [(lease, token) for lease, (_, token) in tokens.items()], self.lease_ttl
+        )
+        with self._lock:
+            for lease in added:
+                key, token = tokens[lease]
+                self._leased[key] = token
+
+    def _take_lease(self, shared: ICache, key: str) -> str:
+        """Token of the lease of key taken by lease_many or now, None if another process has it"""
+        with self._lock:
+            token = self._leased.pop(key, None)
+        if token is not None:
+            return token
+        token = uuid.uuid4().hex
+        return token if shared.add("lease_" + key, token, self.lease_ttl) else None
+
+    # Threads
+
+    def do(self, key: str, func, cache: ICache = None):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+        if not leader:
+            logger.debug(f"Waiting for the running computation of {key}")
+            return future.result()
+
+        try:
+            value = self._run(key, func, cache)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def _run(self, key: str, func, cache: ICache):
+        if cache is None:
+            return func()
+        shared = innermost(cache)
+        lease = "lease_" + key
+        token = self._take_lease(shared, key)
+        if token is None:
+            logger.debug(f"{key} is being computed by another process, waiting")
+            value = self._wait(shared, key, lease)
+            if value is not MISSING:
+                return value
+            # The other process stored nothing (or died), compute it here
+            token = self._take_lease(shared, key)
+            if token is None:
+                return self._store(cache, key, func())
+        try:
+            # It may have been stored between the caller's miss and the lease
+            value = shared.get(key, MISSING)
+            if value is not MISSING:
+                return value
+            return self._store(cache, key, func())
+        finally:
+            self._release(cache, shared, lease, token)
+
+    def _wait(self, shared: ICache, key: str, lease: str):
+        """Polls until key is stored or lease is released. Returns the value or MISSING"""
+        while True:
+            value = shared.get(key, MISSING)
+            if value is not MISSING or shared.get(lease, MISSING) is MISSING:
+                return shared.get(key, MISSING) if value is MISSING else value
+            time.sleep(self.poll_interval)
+
+    @staticmethod
+    def _store(cache: ICache, key: str, value):
+        # Written behind like any other value, the lease is released after it
+        if value is not None:
+            cache.set(key, value)
+        return value
+
+    @staticmethod
+    def _release(cache: ICache, shared: ICache, lease: str, token: str) -> None:
+        # Unless it expired and another process took it
+        if shared.get(lease, MISSING) == token:
+            cache.delete(lease)
+
+    # Event loop
+
+    async def ado(self, key: str, coro_func, cache: ICache = None):
+        """do() for coroutines. coro_func() returns the awaitable computing the value. Waiting
+        doesn't block the event loop"""
+        future = self._async_calls.get(key)
+        if future is not None:
+            logger.debug(f"Waiting for the running computation of {key}")
+            return await asyncio.shield(future)
+
+        future = self._async_calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await self._arun(key, coro_func, cache)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            # Retrieved so it is not reported as never retrieved when nobody waits
+            future.exception()
+            raise
+        finally:
+            del self._async_calls[key]
+
+    async def _arun(self, key: str, coro_func, cache: ICache):
+        if cache is None:
+            return await coro_func()
+        shared = innermost(cache)
+        lease = "lease_" + key
+        loop = asyncio.get_running_loop()
+
+        async def call(func, *args):
+            return await loop.run_in_executor(async_executor(), func, *args)
+
+        token = await call(self._take_lease, shared, key)
+        if token is None:
+            logger.debug(f"{key} is being computed by another process, waiting")
+            while True:
+                value = await shared.aget(key, MISSING)
+                if value is not MISSING:
+                    return value
+                if await shared.aget(lease, MISSING) is MISSING:
+                    break
+                await asyncio.sleep(self.poll_interval)
+            value = await shared.aget(key, MISSING)
+            if value is not MISSING:
+                return value
+            token = await call(self._take_lease, shared, key)
+            if token is None:
+                return await call(self._store, cache, key, await coro_func())
+        try:
+            value = await shared.aget(key, MISSING)
+            if value is not MISSING:
+                return value
+            return await call(self._store, cache, key, await coro_func())
+        finally:
+            await call(self._release, cache, shared, lease, token)
+
+
+flight = SingleFlight()
+
+
+def set_single_flight(single_flight: SingleFlight) -> None:
+    """Replaces the SingleFlight used by the expansion and the api"""
+    global flight
+    flight = single_flight
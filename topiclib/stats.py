@@ -0,0 +1,147 @@
+# Stats of every process
+#
+# Fetch latencies and cache stats are recorded in memory by each process, but most of the fetches
+# and cache traffic happen in the compute and job workers, not in the api process answering
+# /stats. Every process publishes its numbers to its row of a sqlite table shared by all of them
+# (every interval seconds and when asked for the stats) and the rows of the processes that
+# published in the last max_age seconds are merged. Numbers of a process that is gone are dropped
+# with its row.
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+from . import fetch
+from .cache import Cache, CacheStats, StatsCache, _run, innermost
+
+
+class StatsTable:
+    """Shared table of the stats of each process (see the module comment).
+
+    - interval: seconds between the publications of a process
+    - max_age: seconds after which the row of a process that stopped publishing is ignored
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        interval: float = 5.0,
+        max_age: float = 60.0,
+        busy_timeout: float = 30.0,
+    ):
+        self.db_path = db_path
+        self.interval = interval
+        self.max_age = max_age
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._pid = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None)
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout * 1000)}")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats"
+            " (process TEXT PRIMARY KEY, updated_at REAL NOT NULL, data TEXT NOT NULL)"
+        )
+        return conn
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Connection of the current thread, opened on first use (a new one after a fork)"""
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            local.conn = self._connect()
+            local.pid = os.getpid()
+        return local.conn
+
+    def start(self) -> None:
+        """Starts publishing the stats of this process in background, once per process"""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._publisher, daemon=True, name="stats-publish").start()
+
+    def _publisher(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.publish()
+            except sqlite3.Error as e:
+                print(f"Could not publish stats: {e}")
+
+    @staticmethod
+    def _local_stats() -> dict:
+        data = {
+            "latency": {
+                name: tracker.values() for name, tracker in list(fetch.latency_trackers.items())
+            }
+        }
+        cache = Cache._cache
+        if isinstance(cache, StatsCache):
+            data["cache"] = cache.stats.raw()
+            data["evicted"] = dict(getattr(innermost(cache), "evicted", {}))
+        return data
+
+    def publish(self) -> None:
+        """Writes the stats of this process to its row, and removes the rows of processes gone"""
+        now = time.time()
+        data = json.dumps(self._local_stats())
+        self.conn.execute(
+            "INSERT OR REPLACE INTO stats VALUES (?, ?, ?)",
+            (f"{socket.gethostname()}:{os.getpid()}", now, data),
+        )
+        self.conn.execute("DELETE FROM stats WHERE updated_at < ?", (now - self.max_age,))
+
+    def _rows(self) -> [dict]:
+        self.publish()
+        rows = self.conn.execute(
+            "SELECT data FROM stats WHERE updated_at >= ?", (time.time() - self.max_age,)
+        )
+        return [json.loads(data) for data, in rows]
+
+    def latency_percentiles(self) -> dict:
+        """fetch.latency_percentiles() of the samples of every process"""
+        samples = {}
+        for row in self._rows():
+            for name, values in row["latency"].items():
+                samples.setdefault(name, []).extend(values)
+        result = {}
+        for name, values in samples.items():
+            tracker = fetch.LatencyTracker(max(len(values), 1))
+            for value in values:
+                tracker.add(value)
+            result[name] = tracker.percentiles()
+        return result
+
+    def cache_snapshot(self) -> dict:
+        """StatsCache.snapshot() of the stats of every process, {} if none records them"""
+        stats = CacheStats()
+        evicted = Counter()
+        for row in self._rows():
+            if "cache" in row:
+                stats.merge(row["cache"])
+                evicted.update(row["evicted"])
+        return stats.snapshot(evicted)
+
+    # Async, run in the threads of the async cache calls
+
+    async def alatency_percentiles(self) -> dict:
+        return await _run(self.latency_percentiles)
+
+    async def acache_snapshot(self) -> dict:
+        return await _run(self.cache_snapshot)
+
+
+stats_table: StatsTable = None
+
+
+def set_stats_table(table: StatsTable) -> None:
+    """Sets the table the stats of this process are published to (None for none)"""
+    global stats_table
+    stats_table = table
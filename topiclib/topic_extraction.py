@@ -11,6 +11,7 @@ import numpy as np
 from sklearn.feature_extraction.text import CountVectorizer
 
 from .preprocess import get_ngrams, preprocess2
+from .wordprocess import gsd
 
 
 def clusterize(points: [int], n_clusters: int = 2) -> [int]:
@@ -128,3 +129,16 @@ class TopicExtractor:
                       for word, i in vec.vocabulary_.items()]
         words_freq = sorted(words_freq, key=lambda x: x[1], reverse=True)
         return Counter({k: v for k, v in words_freq})
+
+
+def extract_topics(text: str, method: str, ngram_size: int = 1) -> Counter:
+    """Topics of text with method "gsdmm", "ngram" or "anygram" (ngram_size is only used by ngram)"""
+    if method == "gsdmm":
+        counter = gsd(text)
+    elif method == "ngram":
+        counter = TopicExtractor(text, ngram_range=(ngram_size,)).count_vectorizer(
+            ngram_size=ngram_size
+        )
+    elif method == "anygram":
+        counter = TopicExtractor(text).count()
+    return counter
@@ -3,3 +3,9 @@ import hashlib
 def hash_text(text: str) -> str:
     """Returns a hash of the given text."""
     return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def topics_key(text: str, method: str, ngram_size: int) -> str:
+    """Cache key of the topics of text (see extract_topics). method can be a str enum"""
+    method = getattr(method, "value", method)
+    return f"body_{method}_{ngram_size}" + repr(hash_text(text))
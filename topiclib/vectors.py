@@ -0,0 +1,67 @@
+# Shared word vectors
+#
+# The vectors table is most of the memory of the spacy model and every process that loads the
+# model gets a private copy of it. export_vectors writes it once to a .npy file (with a .json
+# describing which model it comes from) and map_vectors makes a loaded pipeline use a read-only
+# memory map of that file instead, so all the processes share one copy in the page cache.
+# The pipeline is still loaded whole first: until map_vectors replaces (and frees) its table a
+# starting process holds a private copy, so its peak RSS is that of the full model. Workers
+# starting together peak together, the nlp sidecar avoids it by loading the model once.
+
+import json
+import os
+import uuid
+
+import numpy as np
+
+
+def _meta_path(path: str) -> str:
+    return path + ".json"
+
+
+def _describe(nlp) -> dict:
+    data = nlp.vocab.vectors.data
+    return {
+        "model": f"{nlp.meta.get('lang')}_{nlp.meta.get('name')}",
+        "version": nlp.meta.get("version"),
+        "shape": list(data.shape),
+        "dtype": str(data.dtype),
+    }
+
+
+def export_vectors(nlp, path: str) -> None:
+    """Writes the vectors table of nlp to path (.npy) and its description next to it.
+    Files are renamed into place, so processes exporting at the same time don't clash"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp = os.path.join(directory, f".{uuid.uuid4().hex}.npy")
+    np.save(tmp, np.ascontiguousarray(nlp.vocab.vectors.data))
+    os.replace(tmp, path)
+    tmp = os.path.join(directory, f".{uuid.uuid4().hex}.json")
+    with open(tmp, "w") as f:
+        json.dump(_describe(nlp), f)
+    os.replace(tmp, _meta_path(path))
+
+
+def map_vectors(nlp, path: str) -> bool:
+    """Replaces the vectors table of nlp by a read-only memory map of path. Returns False (and
+    leaves nlp as is) if path is missing or was exported from another model"""
+    try:
+        with open(_meta_path(path)) as f:
+            meta = json.load(f)
+        mapped = np.load(path, mmap_mode="r")
+    except FileNotFoundError:
+        return False
+    if meta != _describe(nlp) or list(mapped.shape) != meta["shape"]:
+        print(f"Vectors of {path} don't match the loaded model, not using them")
+        return False
+    nlp.vocab.vectors.data = mapped
+    return True
+
+
+def share_vectors(nlp, path: str) -> bool:
+    """map_vectors, exporting the vectors to path first if needed"""
+    if map_vectors(nlp, path):
+        return True
+    export_vectors(nlp, path)
+    return map_vectors(nlp, path)
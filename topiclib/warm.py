@@ -0,0 +1,128 @@
+# Cache warm up
+#
+# Precomputes in a process pool what the api caches for a transcript: its topics, the provider
+# searches and pages of the corpus expansion and the graph layouts. Finished jobs are appended to
+# a state file, so an interrupted run resumes where it stopped.
+
+import concurrent.futures
+import glob
+import logging
+from collections import Counter
+from pathlib import Path
+
+from .cache import MISSING, Cache, cachenames
+from .codec import CodecCache
+from .corpus_expansion import expand_corpus
+from .parser import parsefile
+from .render import graph_layout
+from .topic_extraction import extract_topics
+from .utils import topics_key
+
+logger = logging.getLogger("topiclib")
+
+
+def cache_settings() -> dict:
+    """Cache backend, path and ttls of the api (config.py) when run from its directory"""
+    try:
+        import config
+    except ImportError:
+        return {"backend": "WalSqliteCache", "path": "cache.db", "ttls": {}}
+    return {
+        "backend": config.CACHE_BACKEND,
+        "path": config.CACHE_PATH,
+        "ttls": config.CACHE_TTLS,
+    }
+
+
+def find_inputs(inputs: [str]) -> [str]:
+    """Transcript files from paths to files, directories (their .json files) or glob patterns"""
+    paths = []
+    for pattern in inputs:
+        path = Path(pattern)
+        if path.is_dir():
+            paths += sorted(str(p) for p in path.rglob("*.json"))
+        elif path.is_file():
+            paths.append(str(path))
+        else:
+            paths += sorted(glob.glob(pattern, recursive=True))
+    return list(dict.fromkeys(paths))
+
+
+def _init_worker(backend: str, path: str, ttls: dict) -> None:
+    Cache.set_cache(cachenames[backend](path, ttls=ttls, maintenance_interval=None))
+
+
+def warm_job(
+    job: str,
+    method: str = "anygram",
+    ngram_size: int = 2,
+    limit: int = 10,
+    providers: [str] = ("wikipedia",),
+    provider_policy: str = "merge",
+    styles: [int] = (0, 1),
+) -> str:
+    """Runs in the pool. job is a transcript path or "topics:" followed by comma separated
+    topics. Returns job when done"""
+    cache = Cache.instance()
+    if job.startswith("topics:"):
+        topics = [(topic, 1) for topic in job[len("topics:"):].split(",")]
+    else:
+        text = parsefile(job)
+        cache_key = topics_key(text, method, ngram_size)
+        values = CodecCache(cache)
+        counter = values.get(cache_key, MISSING)
+        if counter is MISSING:
+            counter = extract_topics(text, method, ngram_size)
+            values.set(cache_key, counter)
+        topics = Counter(counter).most_common(limit)
+
+    graph = expand_corpus(topics, list(providers), provider_policy=provider_policy)
+    for style in styles:
+        graph_layout(graph, style)
+    cache.flush()
+    return job
+
+
+def read_state(state_path: str) -> set:
+    try:
+        with open(state_path) as f:
+            return {line.rstrip("\n") for line in f}
+    except FileNotFoundError:
+        return set()
+
+
+def warm(
+    jobs: [str],
+    state_path: str,
+    workers: int = None,
+    cache: dict = None,
+    **options,
+) -> (int, int):
+    """Runs the jobs not in the state file yet (see warm_job for jobs and options) in a pool of
+    workers, appending each finished one to the state file. cache is the backend, path and ttls
+    like cache_settings(). Returns (done, failed)"""
+    cache = cache or cache_settings()
+    finished = read_state(state_path)
+    pending = [job for job in jobs if job not in finished]
+    logger.info(f"{len(jobs) - len(pending)} jobs already done, {len(pending)} to go")
+
+    done = failed = 0
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(cache["backend"], cache["path"], cache["ttls"]),
+    ) as executor, open(state_path, "a") as state:
+        futures = {executor.submit(warm_job, job, **options): job for job in pending}
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Could not warm {job}: {e}")
+                continue
+            done += 1
+            state.write(job + "\n")
+            state.flush()
+            logger.info(f"[{done + failed}/{len(pending)}] {job}")
+    return done, failed
@@ -0,0 +1,202 @@
+# Compute and job worker functions
+#
+# The cpu bound stages of the api run in spawned processes (topiclib/compute.py, topiclib/jobs.py)
+# which import the module of every function they run. They live here, apart from main, so the
+# workers only import this module and config.py, not the app with its pools and queues.
+# configure() sets topiclib up from config.py: main calls it on import, the workers in
+# init_worker.
+
+import json
+import logging
+from collections import Counter
+
+from networkx.readwrite import json_graph
+
+from config import (CACHE_ASYNC_WORKERS, CACHE_BACKEND, CACHE_COMPRESS_LEVEL, CACHE_COMPRESS_MIN,
+                    CACHE_EVICTION, CACHE_FLUSH_INTERVAL, CACHE_FLUSH_SIZE, CACHE_LEASE_TTL,
+                    CACHE_MAINTENANCE_INTERVAL, CACHE_MAX_SIZE, CACHE_MEMORY_SIZE,
+                    CACHE_MEMORY_TTL, CACHE_NEGATIVE_TTL, CACHE_PATH, CACHE_STATS, CACHE_TTLS,
+                    CACHE_WRITE_BEHIND, FETCH_BACKOFF, FETCH_HEDGE, FETCH_HEDGE_PERCENTILE,
+                    FETCH_RETRIES, FETCH_TIMEOUT, LOGLEVEL, NLP_FALLBACK, NLP_SOCKET,
+                    STATS_INTERVAL, STATS_PATH, VECTORS_PATH, WARM_UP)
+from topiclib import (MISSING, Cache, FetchPolicy, StatsCache, TieredCache, WriteBehindCache,
+                      cachenames, expand_corpus, extract_topics, layout_data, plot_graph,
+                      providers_map, set_async_workers, set_fetch_policy)
+from topiclib import codec, preload, singleflight, stats
+from topiclib.nlp_sidecar import NlpClient
+from topiclib.parser import get_text
+from topiclib.preprocess import set_nlp_client, set_vectors_path
+from topiclib.utils import topics_key
+
+logger = logging.getLogger("topiclib")
+
+
+def configure(maintenance: bool = True) -> None:
+    """Logging, cache stack, codec, single flight, fetch policy, nlp sidecar, vectors and
+    stats table of topiclib as set in config.py. Without maintenance this process never runs the cache
+    maintenance, other processes (the api ones) do"""
+    logger.setLevel(LOGLEVEL)
+    command_line_handler = logging.StreamHandler()
+    command_line_handler.setLevel(logging.DEBUG)
+    formatter = logging.Formatter("%(levelname)s- api - %(asctime)s - %(message)s")
+    command_line_handler.setFormatter(formatter)
+    logger.addHandler(command_line_handler)
+
+    cache = cachenames[CACHE_BACKEND](
+        CACHE_PATH,
+        ttls=CACHE_TTLS,
+        max_size=int(CACHE_MAX_SIZE) or None,
+        eviction=CACHE_EVICTION,
+        maintenance_interval=float(CACHE_MAINTENANCE_INTERVAL),
+        maintain=maintenance,
+    )
+    if int(CACHE_WRITE_BEHIND):
+        cache = WriteBehindCache(cache, int(CACHE_FLUSH_SIZE), float(CACHE_FLUSH_INTERVAL))
+    if int(CACHE_MEMORY_SIZE):
+        cache = TieredCache(
+            cache, int(CACHE_MEMORY_SIZE), float(CACHE_NEGATIVE_TTL), max_age=float(CACHE_MEMORY_TTL)
+        )
+    if int(CACHE_STATS):
+        cache = StatsCache(cache)
+    Cache.set_cache(cache)
+    codec.set_compression(int(CACHE_COMPRESS_MIN), int(CACHE_COMPRESS_LEVEL))
+    set_async_workers(int(CACHE_ASYNC_WORKERS))
+    singleflight.set_single_flight(singleflight.SingleFlight(float(CACHE_LEASE_TTL)))
+    set_fetch_policy(
+        FetchPolicy(
+            timeout=float(FETCH_TIMEOUT),
+            retries=int(FETCH_RETRIES),
+            backoff=float(FETCH_BACKOFF),
+            hedge=bool(int(FETCH_HEDGE)),
+            hedge_percentile=float(FETCH_HEDGE_PERCENTILE),
+        )
+    )
+    if NLP_SOCKET:
+        set_nlp_client(NlpClient(NLP_SOCKET), fallback=bool(int(NLP_FALLBACK)))
+    set_vectors_path(VECTORS_PATH or None)
+    stats.set_stats_table(stats.StatsTable(STATS_PATH, float(STATS_INTERVAL)))
+
+
+def init_worker():
+    """Initializer of the compute and job workers: configured like the api (leaving the cache
+    maintenance to it), then warmed up"""
+    configure(maintenance=False)
+    stats.stats_table.start()
+    if int(WARM_UP):
+        preload.warm_up()
+
+
+# Compute pool jobs
+
+
+def topics_job(text: str, method: str, ngram_size: int) -> bytes:
+    """Encoded topics of text"""
+    return codec.encode(extract_topics(text, method, ngram_size))
+
+
+def graph_job(d: [(str, int)], provider: [str], full: bool = False, **expansion):
+    """Expanded corpus graph of the topics d. expansion are the other expand_corpus arguments"""
+    graph = expand_corpus(d, provider, full, **expansion)
+    # Other workers read the pages from the shared backend
+    Cache.instance().flush()
+    return graph
+
+
+def graph_image_job(
+    d: [(str, int)], width: int, height: int, style: int, **expansion
+) -> (bytes, dict):
+    """Png of the graph of d and its expansion info (see budget_ms) or None"""
+    graph = graph_job(d, **expansion)
+    return plot_graph(graph, width, height, style), graph.graph.get("expansion")
+
+
+def layout_job(d: [(str, int)], style: int, svg: bool, **expansion) -> dict:
+    return layout_data(graph_job(d, **expansion), style, svg=svg)
+
+
+def get_topics(text: str, method: str, ngram_size: int = 1) -> Counter:
+    """Cached topics of text. For background commands, handlers use aget_topics"""
+    cache = Cache.instance()
+    cache_key = topics_key(text, method, ngram_size)
+    cached = cache.get(cache_key, MISSING)
+    if cached is not MISSING:
+        logger.debug(f"Cache hit for {cache_key}")
+        return Counter(codec.decode(cached))
+
+    def compute():
+        return topics_job(text, method, ngram_size)
+
+    value = singleflight.flight.do(cache_key, compute, cache)
+    return Counter(codec.decode(value))
+
+
+# Background commands. They run in the job workers and write their result to a file
+
+
+def generate_graph_image(
+    body: dict,
+    width: int = 600,
+    height: int = 600,
+    ngram_size: int = 2,
+    limit: int = 10,
+    graph_type: str = "network",
+    full: bool = False,
+    provider: [str] = None,
+    method: str = "anygram",
+    path: str = None,
+    provider_policy: str = "merge",
+    provider_weights: [float] = None,
+):
+    """Generate a graph from a request body and writes to a temporary file"""
+
+    text = get_text(body)
+    d = get_topics(text, method, ngram_size).most_common(limit)
+    graph = expand_corpus(
+        d,
+        provider or list(providers_map)[:1],
+        full,
+        provider_weights=provider_weights,
+        provider_policy=provider_policy,
+    )
+
+    if graph_type == "network":
+        image_bytes: bytes = plot_graph(graph, width, height)
+    elif graph_type == "tree":
+        image_bytes: bytes = plot_graph(graph, width, height, 1)
+
+    # Write image to file
+    with open(path, "wb") as f:
+        f.write(image_bytes)
+
+    # Other processes read the pages from the shared backend
+    Cache.instance().flush()
+
+
+def generate_graph(
+    body: dict,
+    provider: [str],
+    full: bool = False,
+    limit: int = 10,
+    ngram_size: int = 2,
+    method: str = "anygram",
+    path: str = "0",
+    provider_policy: str = "merge",
+    provider_weights: [float] = None,
+):
+    """Generate a graph from a request body and writes to a temporary file"""
+
+    text = get_text(body)
+    d = get_topics(text, method, ngram_size).most_common(limit)
+    graph = expand_corpus(
+        d,
+        provider,
+        full,
+        provider_weights=provider_weights,
+        provider_policy=provider_policy,
+    )
+    jgraph = json_graph.node_link_data(graph)
+    with open(path, "w") as f:
+        json.dump(jgraph, f)
+
+    # Other processes read the pages from the shared backend
+    Cache.instance().flush()